@@ -1,33 +1,351 @@
-import folium
-import shapely
+import os
 import numpy as np
 import pandas as pd
-import clean_rtd_data
-import geopandas as gpd
-from folium import plugins
-import scipy.stats as stats
-import branca.colormap as cmp
-import matplotlib.pyplot as plt
-plt.style.use('ggplot')
-font = {'weight': 'bold'
-       ,'size': 16}
-plt.rc('font', **font)
-from shapely.geometry import Point
+import gtfs_static
+import rtd_profile
+from functools import lru_cache
+
+# scipy, matplotlib, folium and geopandas are imported by the functions that use them, so importing this
+# module is cheap and a report whose artifacts are all cached never loads them
+
+def set_plot_style(backend=None):
+    '''
+    Loads matplotlib and applies the style of the report's figures. Call it before creating the axes passed
+    to plot_null_hypothesis and plot_alt_hypothesis.
+
+    Args:
+        backend (str): matplotlib backend to select before pyplot is imported, e.g. 'Agg' to write figures
+            without a display. Default value is None, which keeps matplotlib's default.
+
+    Returns:
+        plt (module): matplotlib.pyplot.
+    '''
+    import matplotlib
+    if backend is not None:
+        matplotlib.use(backend)
+    import matplotlib.pyplot as plt
+    plt.style.use('ggplot')
+    font = {'weight': 'bold'
+           ,'size': 16}
+    plt.rc('font', **font)
+    return plt
+
+# Denver's statistical neighborhoods, which neighborhood_map aggregates stops into
+NEIGHBORHOOD_SHAPES = 'data/statistical_neighborhoods/statistical_neighborhoods.shp'
+
+# Builds each FastMarkerCluster marker in the browser from a [lat, lng, icon_color, icon, popup] row, styled
+# like the folium.Marker icons cluster_map writes when lightweight is False
+CLUSTER_MARKER_CALLBACK = """
+function (row) {
+    var icon = L.AwesomeMarkers.icon({markerColor: 'white', iconColor: row[2], icon: row[3], prefix: 'fa'});
+    return L.marker(new L.LatLng(row[0], row[1]), {icon: icon}).bindPopup(row[4]);
+}
+"""
+
+@lru_cache(maxsize=None)
+def load_neighborhood_shapes(shapes_path=NEIGHBORHOOD_SHAPES):
+    '''
+    Reads the neighborhood shapefile once per process, indexed by NBHD_ID.
+
+    Args:
+        shapes_path (str): Path of the shapefile. Default value is NEIGHBORHOOD_SHAPES.
+
+    Returns:
+        neighborhood_shapes (gpd.GeoDataFrame): The neighborhood polygons.
+    '''
+    import geopandas as gpd
+    return gpd.read_file(shapes_path).set_index('NBHD_ID')
+
+# Minutes before (negative) and after the scheduled departure that still count as on-time for each mode,
+# per RTD's definition. Other agencies' definitions can be passed to calculate_ontime_departure instead.
+ONTIME_THRESHOLDS = {'bus': (-1, 5)
+                    ,'light_rail': (-1, 5)
+                    ,'commuter_rail': (0, 5)}
+DEPARTURE_STATUS = pd.CategoricalDtype(['early', 'on_time', 'late'])
+
+def classify_departures(route_type, minutes_since_departure, thresholds=ONTIME_THRESHOLDS):
+    '''
+    Classifies every departure as early, on_time or late against the bounds for its mode in one vectorized pass.
+
+    Args:
+        route_type (pd.Series): The mode of each departure, e.g. 'bus'.
+        minutes_since_departure (pd.Series): Minutes between the actual and scheduled departure.
+        thresholds (dict): Dictionary of route_type to (earliest, latest) minutes that count as on-time.
+            Default value is ONTIME_THRESHOLDS.
+
+    Returns:
+        departure_status (pd.Series): Categorical of 'early', 'on_time' or 'late', NaN where the departure time
+            is missing or the mode has no thresholds.
+    '''
+    route_type = pd.Series(route_type)
+    earliest = route_type.map({mode: bounds[0] for mode, bounds in thresholds.items()}).astype('float64').to_numpy()
+    latest = route_type.map({mode: bounds[1] for mode, bounds in thresholds.items()}).astype('float64').to_numpy()
+    minutes = pd.Series(minutes_since_departure).astype('float64').to_numpy()
+
+    # Comparisons with NaN are False, so unknown modes and missing times fall through to -1 (NaN)
+    codes = np.select([minutes < earliest, minutes <= latest, minutes > latest], [0, 1, 2], default=-1)
+    return pd.Series(pd.Categorical.from_codes(codes, dtype=DEPARTURE_STATUS), index=route_type.index)
+
+def critical_value(n, p_null, alpha):
+    '''
+    The largest # of on-time departures that rejects the Null Hypothesis p_null at alpha in favour of a lower
+    on-time rate (the test used throughout RTD_analyze). Broadcasts over array arguments.
+
+    Args:
+        n (int or np.array): # of departures.
+        p_null (float or np.array): Null Hypothesis on-time probability.
+        alpha (float or np.array): Significance level between 0.0 and 1.0.
+
+    Returns:
+        critical_value (float or np.array): Critical # of on-time departures.
+    '''
+    import scipy.stats as stats
+    return stats.binom.ppf(alpha, n, p_null)
+
+def binomial_power(n, p_null, p_alt, alpha):
+    '''
+    Power of the one-sided binomial test of p_null against a true on-time probability p_alt, i.e. the 
+    probability of observing at most critical_value on-time departures when p_alt is true. Broadcasts over 
+    array arguments.
+
+    Args:
+        n (int or np.array): # of departures.
+        p_null (float or np.array): Null Hypothesis on-time probability.
+        p_alt (float or np.array): Alternate Hypothesis (observed) on-time probability.
+        alpha (float or np.array): Significance level between 0.0 and 1.0.
+
+    Returns:
+        power (float or np.array): Power of the test.
+    '''
+    import scipy.stats as stats
+    return stats.binom.cdf(critical_value(n, p_null, alpha), n, p_alt)
+
+def normal_p_null(n, p_alt, alpha, power=0.8):
+    '''
+    Closed-form p_null at which the test has the target power under the normal approximation to the binomial.
+    Solves n*p + z_alpha*sqrt(n*p*(1-p)) = n*p_alt + z_power*sqrt(n*p_alt*(1-p_alt)) for p, which is a 
+    quadratic in p. Broadcasts over array arguments.
+
+    Args:
+        n (int or np.array): # of departures.
+        p_alt (float or np.array): Alternate Hypothesis (observed) on-time probability.
+        alpha (float or np.array): Significance level between 0.0 and 1.0.
+        power (float or np.array): Target power between 0.0 and 1.0. Default value is 0.8.
+
+    Returns:
+        p_null (float or np.array): Null Hypothesis on-time probability.
+    '''
+    import scipy.stats as stats
+    n = np.asarray(n, dtype='float64')
+    z_alpha = stats.norm.ppf(alpha)
+    target = n * p_alt + stats.norm.ppf(power) * np.sqrt(n * p_alt * (1 - p_alt))
+    a = n**2 + z_alpha**2 * n
+    b = 2 * n * target + z_alpha**2 * n
+    c = target**2
+    # The larger root is the one where n*p >= target, i.e. the null sits above the observed rate
+    return np.clip((b + np.sqrt(np.maximum(b**2 - 4 * a * c, 0))) / (2 * a), p_alt, 1)
+
+def solve_p_null(n, p_alt, alpha, power=0.8, method='auto', normal_min_n=100000, tol=1e-7):
+    '''
+    Solves for the smallest Null Hypothesis on-time probability at which the one-sided binomial test of the 
+    observed rate p_alt reaches the target power. Every argument broadcasts, so a grid of alphas and powers 
+    is solved at once. The exact method bisects binomial_power, which is non-decreasing in p_null, between 
+    p_alt and 1.
+
+    Args:
+        n (int or np.array): # of departures.
+        p_alt (float or np.array): Alternate Hypothesis (observed) on-time probability.
+        alpha (float or np.array): Significance level between 0.0 and 1.0.
+        power (float or np.array): Target power between 0.0 and 1.0. Default value is 0.8.
+        method (str): 'exact' to bisect the binomial power, 'normal' for the closed-form normal approximation
+            or 'auto' to use 'normal' for every element with n >= normal_min_n and 'exact' for the rest. 
+            Default value is 'auto'.
+        normal_min_n (int): Smallest n that 'auto' solves with the normal approximation. Default value is 
+            100,000.
+        tol (float): Width of the bisection bracket at which the exact method stops. Default value is 1e-7.
+
+    Returns:
+        p_null (float or np.array): Null Hypothesis on-time probability, with the shape of the broadcast 
+            arguments.
+    '''
+    if method not in ('exact', 'normal', 'auto'):
+        raise ValueError(f"method must be 'exact', 'normal' or 'auto', not {method!r}")
+    if method == 'normal':
+        return normal_p_null(n, p_alt, alpha, power)
+
+    n, p_alt, alpha, power = np.broadcast_arrays(*[np.asarray(arg, dtype='float64') for arg in (n, p_alt, alpha, power)])
+    if method == 'auto':
+        p_null = np.array(normal_p_null(n, p_alt, alpha, power), dtype='float64')
+        exact = n < normal_min_n
+    else:
+        p_null = np.empty_like(p_alt)
+        exact = np.ones(p_alt.shape, dtype=bool)
+
+    # Bisect only the elements that need the exact binomial
+    n, p_alt, alpha, power = n[exact], p_alt[exact], alpha[exact], power[exact]
+    low = p_alt.copy()
+    high = np.ones_like(p_alt)
+    for _ in range(int(np.ceil(np.log2(1 / tol)))):
+        mid = (low + high) / 2
+        reached = binomial_power(n, mid, p_alt, alpha) >= power
+        high = np.where(reached, mid, high)
+        low = np.where(reached, low, mid)
+    p_null[exact] = high
+    return p_null if p_null.ndim else p_null.item()
+
+# Plots of the hypotheses only cover the part of each distribution between these quantiles, drawn with at most
+# PLOT_POINTS points, and use the normal approximation to the binomial from PLOT_NORMAL_MIN_N departures
+PLOT_WINDOW = (0.00001, 0.99999)
+PLOT_POINTS = 2000
+PLOT_NORMAL_MIN_N = 1000000
+
+@lru_cache(maxsize=64)
+def pmf_arrays(n, null_percent, alt_percent, points=PLOT_POINTS, normal_min_n=PLOT_NORMAL_MIN_N):
+    '''
+    Evaluates the Null and Alternate Hypothesis distributions over the window the hypothesis plots show, so
+    the cost of a plot does not grow with n. The arrays are cached, so plot_null_hypothesis and 
+    plot_alt_hypothesis of the same hypotheses share them.
+
+    Args:
+        n (int): # of departures.
+        null_percent (float): Null Hypothesis on-time probability.
+        alt_percent (float): Alternate Hypothesis (observed) on-time probability.
+        points (int): Maximum # of points evaluated. Windows narrower than this use every integer. Default 
+            value is PLOT_POINTS.
+        normal_min_n (int): Smallest n that uses the normal approximation. Default value is PLOT_NORMAL_MIN_N.
+
+    Returns:
+        x (np.array): # of on-time departures the distributions are evaluated at (read-only).
+        null_pmf (np.array): Null Hypothesis probability of each x (read-only).
+        alt_pmf (np.array): Alternate Hypothesis probability of each x (read-only).
+        null_window (tuple): PLOT_WINDOW quantiles of the Null Hypothesis distribution.
+        window (tuple): Smallest window holding PLOT_WINDOW of both distributions.
+    '''
+    import scipy.stats as stats
+    percents = np.array([null_percent, alt_percent])
+    if n >= normal_min_n:
+        mean = n * percents
+        sd = np.sqrt(n * percents * (1 - percents))
+        lows = np.floor(stats.norm.ppf(PLOT_WINDOW[0], mean, sd))
+        highs = np.ceil(stats.norm.ppf(PLOT_WINDOW[1], mean, sd))
+    else:
+        lows = stats.binom.ppf(PLOT_WINDOW[0], n, percents)
+        highs = stats.binom.ppf(PLOT_WINDOW[1], n, percents)
+    low, high = max(lows.min(), 0), min(highs.max(), n)
+
+    if high - low + 1 <= points:
+        x = np.arange(low, high + 1)
+    else:
+        x = np.unique(np.round(np.linspace(low, high, points)))
+
+    if n >= normal_min_n:
+        null_pmf, alt_pmf = (stats.norm.pdf(x, mu, sigma) for mu, sigma in zip(mean, sd))
+    else:
+        null_pmf, alt_pmf = (stats.binom.pmf(x, n, percent) for percent in percents)
+
+    for array in (x, null_pmf, alt_pmf):
+        array.setflags(write=False)
+    return x, null_pmf, alt_pmf, (lows[0], highs[0]), (low, high)
+
+# Grouping columns of each level of ontime_stats. Every level is rolled up from one groupby over the union
+# of these columns, so adding a level costs a groupby of the aggregated counts rather than of the data.
+STATS_LEVELS = {'all': []
+               ,'route_type': ['route_type']
+               ,'route': ['route_type', 'route_short_name']
+               ,'direction': ['route_type', 'route_short_name', 'direction_id']
+               ,'stop': ['route_type', 'stop_id', 'stop_name']}
+
+@rtd_profile.profiled()
+def ontime_stats(df, levels=STATS_LEVELS, thresholds=ONTIME_THRESHOLDS, null_percent=0.86, alpha=0.05, power=0.8):
+    '''
+    Calculates on-time departure counts, rates, p-values and power for every group of every level (e.g. every
+    route, mode, stop and direction) from a single groupby pass over the cleaned data.
+
+    Args:
+        df (pd.DataFrame): The cleaned RTD_df.df. A departure_status column is used if present, otherwise 
+            departures are classified with thresholds.
+        levels (dict): Dictionary of level name to the columns it groups by. Default value is STATS_LEVELS.
+        thresholds (dict): Passed to classify_departures. Default value is ONTIME_THRESHOLDS.
+        null_percent (float): Null Hypothesis on-time probability each group is tested against. Default value 
+            is 0.86.
+        alpha (float): Significance level of the tests. Default value is 0.05.
+        power (float): Target power used to solve each group's p_null. Default value is 0.8.
+
+    Returns:
+        stats_df (pd.DataFrame): One row per group with its level, grouping columns (NaN where the level does
+            not group by them), total_stops, ontime_stops, ontime_departure_rate, p_value (probability of at
+            most ontime_stops under the Null Hypothesis), power (of the test of null_percent if the observed
+            rate is true) and p_null (the null proportion the group has the target power against).
+    '''
+    if 'departure_status' in df.columns:
+        departure_status = df.departure_status
+    else:
+        departure_status = classify_departures(df.route_type, df.minutes_since_departure, thresholds)
+    keys = list(dict.fromkeys(col for columns in levels.values() for col in columns))
+
+    # Only the categorical codes of the keys are copied, and the finest groups are counted once
+    counts = df[keys].assign(total_stops=departure_status.notnull(), ontime_stops=departure_status == 'on_time')
+    counts = counts.groupby(keys, observed=True, dropna=False).sum().reset_index()
+    return rollup_ontime_stats(counts, levels, null_percent, alpha, power)
+
+@rtd_profile.profiled()
+def rollup_ontime_stats(counts, levels=STATS_LEVELS, null_percent=0.86, alpha=0.05, power=0.8):
+    '''
+    Rolls counts of departures up to every level and tests each group, as ontime_stats does. Counts can come
+    from ontime_stats or from running counters such as rtd_live's.
+
+    Args:
+        counts (pd.DataFrame): total_stops and ontime_stops of the finest groups, with a column for every
+            column in levels.
+        levels (dict): Dictionary of level name to the columns it groups by. Default value is STATS_LEVELS.
+        null_percent (float): Null Hypothesis on-time probability each group is tested against. Default value 
+            is 0.86.
+        alpha (float): Significance level of the tests. Default value is 0.05.
+        power (float): Target power used to solve each group's p_null. Default value is 0.8.
+
+    Returns:
+        stats_df (pd.DataFrame): The table described in ontime_stats.
+    '''
+    import scipy.stats as stats
+    keys = list(dict.fromkeys(col for columns in levels.values() for col in columns))
+    # Counts with no rows (e.g. a live window without departures) can come in untyped
+    counts = counts.astype({'total_stops': 'int64', 'ontime_stops': 'int64'})
+    tables = []
+    for level, columns in levels.items():
+        if columns:
+            table = counts.groupby(columns, observed=True, dropna=False)[['total_stops', 'ontime_stops']].sum().reset_index()
+        else:
+            table = counts[['total_stops', 'ontime_stops']].sum().to_frame().T
+        tables.append(table.assign(level=level))
+    stats_df = pd.concat(tables, ignore_index=True)
+    stats_df = stats_df[stats_df.total_stops > 0].reset_index(drop=True)
+
+    n = stats_df.total_stops.to_numpy()
+    rate = stats_df.ontime_stops.to_numpy() / n
+    stats_df = stats_df.loc[:, ['level'] + keys + ['total_stops', 'ontime_stops']]
+    stats_df['ontime_departure_rate'] = rate
+    stats_df['p_value'] = stats.binom.cdf(stats_df.ontime_stops, n, null_percent)
+    stats_df['power'] = binomial_power(n, null_percent, rate, alpha)
+    stats_df['p_null'] = solve_p_null(n, rate, alpha, power)
+    return stats_df
 
 class RTD_analyze(object):
 
-    def __init__(self, rtd_data, route_type='All', route_label='All'):
+    def __init__(self, rtd_data, route_type='All', route_label='All', map_dir='html'):
         '''
         Initialize instance of RTD_analyze class that will be used to calculate on-time arrival rate
 
         Args: 
-            rtd_data (RTD_df): The cleaned RTD_df class to analyze
+            rtd_data (RTD_df): The cleaned RTD_df class to analyze. The maps use the GTFS feed at its gtfs_path.
             route_type (string): The different route types to analyze. Can be 'bus' or 'light_rail'.
             route_label (string): The specific route to analyze within a route_type. 
                                  If left blank, all routes will be analyzed and aggregated.
+            map_dir (string): Directory the maps are saved to. Default value is 'html'.
         '''
         self.route_type = route_type
         self.route_label = route_label
+        self.gtfs_path = rtd_data.gtfs_path
+        self.map_dir = map_dir
         if (self.route_type == 'All') & (self.route_label == 'All'):
             self.data = rtd_data.df
         elif ~(self.route_type == 'All') & (self.route_label == 'All'):
@@ -35,39 +353,33 @@ class RTD_analyze(object):
         else:
             self.data = rtd_data.df[rtd_data.df.route_short_name == self.route_label]
 
-    def calculate_ontime_departure(self):
+    @classmethod
+    def from_stats(cls, row, route_type='All', route_label='All'):
         '''
-        Calculate the # of times in the RTD_analyze.data that a vehicle was on_time vs not according to RTD's
-            definition of on-time departure: 
-                - Bus & Light Rail are considered on-time if a departure from a location is no more than 1 minute
-                    early or 5 minutes after the scheduled departure time
-                - Commuter Rial is considered on-time if a departure from a location is no more than 0 minutes 
-                    early or 5 minutes after the scheduled departure time.
+        Creates an RTD_analyze from a row of ontime_stats without filtering or classifying the data again. The
+        instance can be plotted and tested but has no .data for the maps.
 
         Args:
-            None
-        '''
-        self.ontime_departure = []
-    
-        for rt, dt in zip(self.data.route_type, self.data.minutes_since_departure):
-            if ((rt == 'bus') | (rt == 'light_rail')) & (dt >= -1) & (dt <= 5):
-                self.ontime_departure.append('on_time')
-            elif (rt == 'commuter_rail') & (dt >= 0) & (dt <= 5):
-                self.ontime_departure.append('on_time')
-            elif ((rt == 'bus') | (rt == 'light_rail')) & (dt < -1):
-                self.ontime_departure.append('early')
-            elif (rt == 'commuter_rail') & (dt < 0):
-                self.ontime_departure.append('early')
-            elif ((rt == 'bus') | (rt == 'light_rail')) & (dt > 5):
-                self.ontime_departure.append('late')
-            elif (rt == 'commuter_rail') & (dt > 5):
-                self.ontime_departure.append('late')
-        self.data.loc[:, 'departure_status'] = self.ontime_departure
-        self.total_stops = self.data.shape[0]
-        self.ontime_stops = sum(self.data.departure_status == 'on_time')
-        self.ontime_departure_rate = self.ontime_stops / self.total_stops
+            row (pd.Series): A row of the table returned by ontime_stats.
+            route_type (string): The route type the row describes. Default value is 'All'.
+            route_label (string): The route the row describes. Default value is 'All'.
 
-    def calculate_p_null(self, alpha=0.05):
+        Returns:
+            rtd_analyze (RTD_analyze): The analysis of the row's group.
+        '''
+        rtd_analyze = cls.__new__(cls)
+        rtd_analyze.route_type = route_type
+        rtd_analyze.route_label = route_label
+        rtd_analyze.data = None
+        rtd_analyze.gtfs_path = None
+        rtd_analyze.map_dir = 'html'
+        rtd_analyze.total_stops = int(row.total_stops)
+        rtd_analyze.ontime_stops = int(row.ontime_stops)
+        rtd_analyze.ontime_departure_rate = row.ontime_departure_rate
+        return rtd_analyze
+
+    @rtd_profile.profiled(frame='data')
+    def calculate_ontime_departure(self, thresholds=ONTIME_THRESHOLDS):
         '''
         Calculate the # of times in the RTD_analyze.data that a vehicle was on_time vs not according to RTD's
             definition of on-time departure: 
@@ -75,30 +387,41 @@ class RTD_analyze(object):
                     early or 5 minutes after the scheduled departure time
                 - Commuter Rial is considered on-time if a departure from a location is no more than 0 minutes 
                     early or 5 minutes after the scheduled departure time.
+            Rows without a departure time or with a mode missing from thresholds are left unclassified (NaN) 
+            and are not counted.
 
         Args:
-            alpha (float) = The alpha value you want to calculate your Null Hypothesis using. Must be a number
-                between 0.0 and 1.0. Default value is 0.05.
+            thresholds (dict): Dictionary of route_type to (earliest, latest) minutes from the scheduled 
+                departure that still count as on-time. Default value is ONTIME_THRESHOLDS (RTD's definition).
         '''
-        n = self.total_stops
-        p_alt = self.ontime_departure_rate
-        p_null = np.linspace(p_alt, p_alt + 0.1, 100000)
-        alpha = alpha
-        
-        alt_dist = stats.binom(n, p_alt)
-
-        power_dict = {}
+        self.data = self.data.assign(departure_status=classify_departures(self.data.route_type
+                                                                          ,self.data.minutes_since_departure
+                                                                          ,thresholds))
+        self.total_stops = self.data.departure_status.notnull().sum()
+        self.ontime_stops = (self.data.departure_status == 'on_time').sum()
+        self.ontime_departure_rate = self.ontime_stops / self.total_stops
 
-        for p in p_null:
-            null_dist = stats.binom(n, p)
-            power_dict[p] = alt_dist.cdf(null_dist.ppf(alpha)) 
+    @rtd_profile.profiled()
+    def calculate_p_null(self, alpha=0.05, power=0.8, method='auto'):
+        '''
+        Calculate the Null Hypothesis on-time probability at which a one-sided test of the observed on-time
+            departure rate has the target power, i.e. the smallest on-time rate that this much data can show
+            RTD falls short of. Alphas and powers may be arrays to solve a whole grid at once.
 
-        for k,v in power_dict.items():
-            if round(v, 2) == 0.80:
-                self.p_null = k
-        
+        Args:
+            alpha (float or np.array) = The alpha value you want to calculate your Null Hypothesis using. Must be 
+                a number between 0.0 and 1.0. Default value is 0.05.
+            power (float or np.array) = The target power. Must be a number between 0.0 and 1.0. Default value 
+                is 0.8.
+            method (str): 'exact', 'normal' or 'auto', see solve_p_null. Default value is 'auto'.
+
+        Returns:
+            p_null (float or np.array): The Null Hypothesis on-time probability.
+        '''
+        self.p_null = solve_p_null(self.total_stops, self.ontime_departure_rate, alpha, power, method)
         return self.p_null
 
+    @rtd_profile.profiled()
     def plot_null_hypothesis(self, ax, alpha_value, null_percent):
         '''
         Plots the Null Hypothesis distribution along with the alpha_value as a dashed vertical line and 
@@ -109,29 +432,31 @@ class RTD_analyze(object):
                 between 0.0 and 1.0. Default value is 0.05.
             null_percent: The Null Hypothesis probability to use for the experiment.
         '''
+        import scipy.stats as stats
+        from matplotlib.ticker import FormatStrFormatter, FuncFormatter
+
         def thousands(x, pos):
             'The two args are the value and tick position'
             return '%3.0f' % (x/1000)
 
         graph_fontsize = 25
 
-        null_dist = stats.binom(n=self.total_stops, p=null_percent)
-        x = np.linspace(0, self.total_stops, self.total_stops+1)
+        x, null_pmf, _, null_window, _ = pmf_arrays(int(self.total_stops), float(null_percent), float(self.ontime_departure_rate))
         observed_data = self.ontime_stops
         
-        ax.plot(x, null_dist.pmf(x), label=f"$H_0$ = {null_percent:.2%}")
-        ax.yaxis.set_major_formatter(plt.FormatStrFormatter('%1.1e'))
-        ax.xaxis.set_major_formatter(plt.FuncFormatter(thousands))
-        ax.set_xlim(null_dist.ppf(0.00001), null_dist.ppf(0.99999))
-        ax.axvline(null_dist.ppf(alpha_value)
+        ax.plot(x, null_pmf, label=f"$H_0$ = {null_percent:.2%}")
+        ax.yaxis.set_major_formatter(FormatStrFormatter('%1.1e'))
+        ax.xaxis.set_major_formatter(FuncFormatter(thousands))
+        ax.set_xlim(*null_window)
+        ax.axvline(critical_value(self.total_stops, null_percent, alpha_value)
                   ,linestyle='--'
                   ,color='grey'
                   ,label=f"$\\alpha$ = {alpha_value:.3f}")
         ax.fill_between(x
-                        ,null_dist.pmf(x)
+                        ,null_pmf
                         ,where= x <= observed_data
                         ,alpha=0.25
-                        ,label=f"p-value = {null_dist.cdf(observed_data):1.1e}")
+                        ,label=f"p-value = {stats.binom.cdf(observed_data, self.total_stops, null_percent):1.1e}")
         ax.legend(loc='upper right', fontsize=graph_fontsize-10)
         ax.set_xlabel('# of On-Time Vehicles (000s)', fontsize=graph_fontsize)
         if (self.route_type == 'All') & ~(self.route_label == 'All'): 
@@ -139,6 +464,7 @@ class RTD_analyze(object):
         else:
             ax.set_title(f"{self.route_type.replace('_', ' ').title()} Routes", fontsize=graph_fontsize)
 
+    @rtd_profile.profiled()
     def plot_alt_hypothesis(self, ax, alpha_value, null_percent, legend_loc):
         '''
         Plots the Null and Alternate Hypothesis distributions along with the alpha_value as a dashed vertical line 
@@ -152,36 +478,37 @@ class RTD_analyze(object):
             legend_loc (matplotlib Legend parameter): Used to move the legend location around to de-conflict with the
                 distributions.
         '''
+        from matplotlib.ticker import FormatStrFormatter, FuncFormatter
+
         def thousands(x, pos):
             'The two args are the value and tick position'
             return '%3.0f' % (x/1000)
         
         graph_fontsize = 25
 
-        null_dist = stats.binom(n=self.total_stops, p=null_percent)
-        alt_dist = stats.binom(n=self.total_stops, p=self.ontime_departure_rate)
-        x = np.linspace(0, self.total_stops, self.total_stops+1)
-        observed_data = self.ontime_stops
-
-        ax.plot(x, null_dist.pmf(x), label=f"$H_0$ = {null_percent:.2%}")
-        ax.plot(x, alt_dist.pmf(x), label=f"$H_A$ = {self.ontime_departure_rate:.2%}")
-        ax.yaxis.set_major_formatter(plt.FormatStrFormatter('%1.1e'))
-        ax.xaxis.set_major_formatter(plt.FuncFormatter(thousands))
-        ax.set_xlim(min(alt_dist.ppf(0.00001), null_dist.ppf(0.00001)), max(alt_dist.ppf(0.99999), null_dist.ppf(0.99999)))
-        ax.axvline(null_dist.ppf(alpha_value), linestyle='--', color='grey', label='critical value')
-        ax.fill_between(x, null_dist.pmf(x)
-                       ,where= (x <= null_dist.ppf(alpha_value))
+        x, null_pmf, alt_pmf, _, window = pmf_arrays(int(self.total_stops), float(null_percent), float(self.ontime_departure_rate))
+        critical = critical_value(self.total_stops, null_percent, alpha_value)
+        power = binomial_power(self.total_stops, null_percent, self.ontime_departure_rate, alpha_value)
+
+        ax.plot(x, null_pmf, label=f"$H_0$ = {null_percent:.2%}")
+        ax.plot(x, alt_pmf, label=f"$H_A$ = {self.ontime_departure_rate:.2%}")
+        ax.yaxis.set_major_formatter(FormatStrFormatter('%1.1e'))
+        ax.xaxis.set_major_formatter(FuncFormatter(thousands))
+        ax.set_xlim(*window)
+        ax.axvline(critical, linestyle='--', color='grey', label='critical value')
+        ax.fill_between(x, null_pmf
+                       ,where= (x <= critical)
                        ,alpha=0.25
                        ,label=f"$\\alpha$ = Type I Error")
-        ax.fill_between(x, alt_dist.pmf(x)
-                       ,where= (x >= null_dist.ppf(alpha_value))
+        ax.fill_between(x, alt_pmf
+                       ,where= (x >= critical)
                        ,alpha=0.25
                        ,label='$\\beta$ = Type II Error')
-        ax.fill_between(x, alt_dist.pmf(x)
-                       ,where= (x < null_dist.ppf(alpha_value))
+        ax.fill_between(x, alt_pmf
+                       ,where= (x < critical)
                        ,alpha=0.25
                        ,color='Green'
-                       ,label=f"Power = {alt_dist.cdf(null_dist.ppf(alpha_value)):.1%}") 
+                       ,label=f"Power = {power:.1%}") 
         ax.legend(loc=legend_loc, fontsize=graph_fontsize-10)
         ax.set_xlabel(f"# of On-Time Vehicles (000s)", fontsize=graph_fontsize)
         if (self.route_type == 'All') & ~(self.route_label == 'All'): 
@@ -189,20 +516,37 @@ class RTD_analyze(object):
         else:
             ax.set_title(f"{self.route_type.replace('_', ' ').title()} Routes", fontsize=graph_fontsize)
 
-    def cluster_map(self):
+    def _save_map(self, folium_map, map_name):
+        '''
+        Saves a folium map to map_dir named after the route_type, or the route_label if there is one.
+        '''
+        if self.route_label == 'All':
+            folium_map.save(os.path.join(self.map_dir, f"{self.route_type}_{map_name}.html"))
+        else:
+            folium_map.save(os.path.join(self.map_dir, f"{self.route_label}_{map_name}.html"))
+
+    @rtd_profile.profiled(frame='data')
+    def cluster_map(self, lightweight=True):
         '''
         Creates and saves a map that shows a cluster of stop lat/lng points that have over 50 data points and
         assigns them an icon based on their mode of transportation. The icon is also shaded to represent the 
         on-time departure distribution with red being low and green being high.
 
         Args:
-            None
+            lightweight (bool): If True, the stops are written once as a single data array that FastMarkerCluster
+                turns into markers in the browser. If False, every stop is written as its own folium.Marker, 
+                which is several times larger and slower to save and load. Default value is True.
         '''
-        # Cluster of Stops with On-Time Departure %
-        on_time = self.data.groupby(['stop_id', 'stop_name', 'stop_lat', 'stop_lng', 'route_type']).departure_status.apply(lambda x: (x == 'on_time').sum()).reset_index(name='on_time_stops')
-        total = self.data.groupby(['stop_id', 'stop_name', 'stop_lat', 'stop_lng', 'route_type']).size().reset_index(name='total_stops')
+        import folium
+        import branca.colormap as cmp
+        from folium import plugins
 
-        map_data = pd.merge(on_time, total, on=['stop_id', 'stop_name', 'stop_lat', 'stop_lng', 'route_type'])
+        # Cluster of Stops with On-Time Departure %
+        on_time = self.data.departure_status == 'on_time'
+        stop_columns = [self.data[col] for col in ['stop_id', 'stop_name', 'stop_lat', 'stop_lng', 'route_type']]
+        map_data = on_time.groupby(stop_columns, observed=True).agg(['sum', 'size'])
+        map_data.columns = ['on_time_stops', 'total_stops']
+        map_data = map_data.reset_index()
         map_data['on_time_percent'] = map_data.on_time_stops / map_data.total_stops
         map_data['on_time_str'] = map_data.on_time_percent.apply(lambda x: f"{x:.1%}")
         map_data['map_icon'] = map_data.route_type.apply(lambda x: x if x=='bus' else 'train')
@@ -222,7 +566,14 @@ class RTD_analyze(object):
         name_list = map_data.stop_name.tolist()
 
         stop_map = folium.Map(location=[39.7426534, -104.9904138]
-                             ,tiles='Stamen Terrain')
+                             ,tiles='OpenStreetMap')
+
+        if lightweight:
+            marker_data = [[lat, lng, step(on_time), icon, f"{name}: {on_time:.1%}"] 
+                           for (lat, lng), icon, on_time, name in zip(stop_list, icon_list, on_time_list, name_list)]
+            plugins.FastMarkerCluster(marker_data, callback=CLUSTER_MARKER_CALLBACK).add_to(stop_map)
+            self._save_map(stop_map, 'cluster_map')
+            return
 
         marker_cluster = plugins.MarkerCluster().add_to(stop_map)
 
@@ -236,29 +587,38 @@ class RTD_analyze(object):
                             ,popup=f"{name_list[stop]}: {on_time_list[stop]:.1%}"
                         ).add_to(marker_cluster)
         
-        if self.route_label == 'All':
-            stop_map.save(f"html/{self.route_type}_cluster_map.html")
-        else:
-            stop_map.save(f"html/{self.route_label}_cluster_map.html")
+        self._save_map(stop_map, 'cluster_map')
 
-    def neighborhood_map(self):
+    @rtd_profile.profiled(frame='data')
+    def neighborhood_map(self, lightweight=True, simplify_tolerance=None, shapes_path=NEIGHBORHOOD_SHAPES):
         '''
         Creates and saves a map that shows a map of Denver neighborhoods with shading to indicate the average
         on-time departure percentage for all the stops in that neighborhood.
         
         Args:
-            None
+            lightweight (bool): If True, the popups are attached to the Choropleth's own GeoJSON layer. If False,
+                every neighborhood's polygon is written a second time as a separate GeoJson layer to hold its 
+                popup. Default value is True.
+            simplify_tolerance (float): If given, the polygons are simplified to this tolerance (in degrees, 
+                e.g. 0.0001 is about 10 meters) before they are written. Default value is None.
+            shapes_path (str): Path of the neighborhood shapefile. Default value is NEIGHBORHOOD_SHAPES.
         '''
-
-        neighborhood_shapes = gpd.read_file('data/statistical_neighborhoods/statistical_neighborhoods.shp').set_index('NBHD_ID')
-        geo_rtd = gpd.GeoSeries(self.data.apply(lambda z: Point(z['stop_lng'], z['stop_lat']), 1),crs={'init': 'epsg:4326'})
-        geo_stops = gpd.GeoDataFrame(self.data.drop(['stop_lat', 'stop_lng'], 1), geometry=geo_rtd)
-        geo_stops = geo_stops[['departure_status', 'geometry']].reset_index()
-        neighborhood_stop_data = gpd.tools.sjoin(neighborhood_shapes, geo_stops.to_crs(neighborhood_shapes.crs), how='inner')
-
-        neighborhood_on_time = neighborhood_stop_data.groupby(['NBHD_NAME']).departure_status.apply(lambda x: (x=='on_time').sum()).reset_index(name='on_time_stops')
-        neighborhood_total = neighborhood_stop_data.groupby(['NBHD_NAME']).departure_status.size().reset_index(name='total_stops')
-        neighborhood_data = pd.merge(neighborhood_on_time, neighborhood_total, on=['NBHD_NAME'])
+        import folium
+
+        neighborhood_shapes = load_neighborhood_shapes(shapes_path)
+
+        # Count departures per stop, then map each stop to its neighborhood with the cached stop index
+        gtfs = gtfs_static.GTFS_Static.load(self.gtfs_path)
+        stop_neighborhoods = gtfs.stop_neighborhoods(shapes_path)
+        on_time = self.data.departure_status == 'on_time'
+        stop_data = on_time.groupby(self.data.stop_id, observed=True).agg(['sum', 'size'])
+        stop_data.index = stop_data.index.astype(str)
+        stop_data['NBHD_ID'] = stop_neighborhoods.reindex(stop_data.index).to_numpy()
+
+        neighborhood_data = stop_data.groupby('NBHD_ID')[['sum', 'size']].sum()
+        neighborhood_data.columns = ['on_time_stops', 'total_stops']
+        neighborhood_data = neighborhood_data.join(neighborhood_shapes.NBHD_NAME).reset_index(drop=True)
+        neighborhood_data = neighborhood_data.loc[:, ['NBHD_NAME', 'on_time_stops', 'total_stops']]
         neighborhood_data['on_time_percent'] = neighborhood_data.on_time_stops / neighborhood_data.total_stops
         neighborhood_data = neighborhood_data[neighborhood_data.total_stops > 100]
 
@@ -266,7 +626,16 @@ class RTD_analyze(object):
               ,tiles='https://tiles.stadiamaps.com/tiles/alidade_smooth_dark/{z}/{x}/{y}{r}.png'
               ,attr='&copy; <a href="https://stadiamaps.com/">Stadia Maps</a>, &copy; <a href="https://openmaptiles.org/">OpenMapTiles</a> &copy; <a href="http://openstreetmap.org">OpenStreetMap</a> contributors')
 
-        folium.Choropleth(neighborhood_shapes
+        if simplify_tolerance is not None:
+            neighborhood_shapes = neighborhood_shapes.assign(geometry=neighborhood_shapes.simplify(simplify_tolerance))
+
+        if lightweight:
+            # Only the properties the choropleth and popup use are written with the polygons
+            popup_data = neighborhood_data.set_index('NBHD_NAME').on_time_percent.map('{:.1%}'.format)
+            neighborhood_shapes = neighborhood_shapes.loc[:, ['NBHD_NAME', 'geometry']]
+            neighborhood_shapes['on_time_str'] = neighborhood_shapes.NBHD_NAME.map(popup_data).fillna('Not enough data')
+
+        choropleth = folium.Choropleth(neighborhood_shapes
                         ,data=neighborhood_data
                         ,columns=['NBHD_NAME', 'on_time_percent']
                         ,key_on = 'feature.properties.NBHD_NAME'
@@ -274,6 +643,12 @@ class RTD_analyze(object):
                         ,fill_opacity = 0.7
                         ,line_opacity = 0.5
                         ).add_to(neighborhood_map)
+
+        if lightweight:
+            choropleth.geojson.add_child(folium.GeoJsonPopup(fields=['NBHD_NAME', 'on_time_str'], labels=False))
+            self._save_map(neighborhood_map, 'neighborhood_map')
+            return
+
         geo_style = {
             "color": "#fffff"
             ,"weight": 0
@@ -286,121 +661,10 @@ class RTD_analyze(object):
                                             ).add_to(neighborhood_map)
             neighborhood_json.add_child(folium.Popup(f"{name}: {ot_departure:.1%}"))
         
-        if self.route_label == 'All':
-            neighborhood_map.save(f"html/{self.route_type}_neighborhood_map.html")
-        else:
-            neighborhood_map.save(f"html/{self.route_label}_neighborhood_map.html")
+        self._save_map(neighborhood_map, 'neighborhood_map')
 
 if __name__ == '__main__':
 
-    rtd_data = clean_rtd_data.RTD_df(bucket_name='rtd-on-time-departure', file_name='rtd_data.csv')
-    rtd_data.clean_my_data()
-
-    all_routes = RTD_analyze(rtd_data)
-    all_routes.calculate_ontime_departure()
-
-    light_rail = RTD_analyze(rtd_data, route_type='light_rail')
-    light_rail.calculate_ontime_departure()
-    
-    bus = RTD_analyze(rtd_data, route_type='bus')
-    bus.calculate_ontime_departure()
-    
-    fig, ax = plt.subplots(figsize=(15,10))
-
-    ax.hist(all_routes.data.minutes_since_departure, bins=250)
-    ax.set_xlabel('Minutes Before/After Schedule')
-    ax.set_title('Histogram of Departure Time Before/After Schedule ')
-    plt.xlim((-20,20))
-    plt.savefig('images/departure_time_histogram.png')
-
-    # Original Null Hypothesis
-    set_figsize = (20,30)
-    set_fontsize = 35
-    plt.rc('xtick',labelsize=25)
-    plt.rc('ytick',labelsize=25)
-    alpha_value = 0.01/3
-    
-    fig, axs = plt.subplots(3,1,figsize=set_figsize, constrained_layout=True)
-
-    all_routes.plot_null_hypothesis(ax=axs[0], alpha_value=alpha_value, null_percent=0.86)
-    light_rail.plot_null_hypothesis(ax=axs[1], alpha_value=alpha_value, null_percent=0.90)
-    bus.plot_null_hypothesis(ax=axs[2], alpha_value=alpha_value, null_percent=0.86)
-    fig.suptitle(f"Binomial Distributions of Null Hypotheses"
-                ,fontsize=set_fontsize)
-    plt.savefig(f"images/original_null_hypothesis.png")
-    
-    # Original Alt Hypothesis
-    fig, axs = plt.subplots(3,1,figsize=set_figsize, constrained_layout=True)
-    
-    all_routes.plot_alt_hypothesis(ax=axs[0], alpha_value=alpha_value, null_percent=0.86, legend_loc='upper center')
-    light_rail.plot_alt_hypothesis(ax=axs[1], alpha_value=alpha_value, null_percent=0.90, legend_loc='upper center')
-    bus.plot_alt_hypothesis(ax=axs[2], alpha_value=alpha_value, null_percent=0.86, legend_loc='upper center')
-    fig.suptitle(f"Binomial Distributions of Null and Alternate Hypotheses"
-                ,fontsize=set_fontsize)
-    plt.savefig(f"images/original_alt_hypothesis.png")
-
-    # Modified Null Hypothesis
-    all_routes_null_p = all_routes.calculate_p_null(alpha_value)
-    light_rail_null_p = light_rail.calculate_p_null(alpha_value)
-    bus_null_p = bus.calculate_p_null(alpha_value)
-
-    fig, axs = plt.subplots(3,1,figsize=set_figsize, constrained_layout=True)
-    
-    all_routes.plot_null_hypothesis(ax=axs[0], alpha_value=alpha_value, null_percent=all_routes_null_p)
-    light_rail.plot_null_hypothesis(ax=axs[1], alpha_value=alpha_value, null_percent=light_rail_null_p)
-    bus.plot_null_hypothesis(ax=axs[2], alpha_value=alpha_value, null_percent=bus_null_p)
-    fig.suptitle(f"Binomial Distributions of Null Hypotheses"
-                ,fontsize=set_fontsize)
-    plt.savefig(f"images/modified_null_hypothesis.png")
-
-    # Modified Alt Hypothesis
-    fig, axs = plt.subplots(3,1,figsize=set_figsize, constrained_layout=True)
-    
-    all_routes.plot_alt_hypothesis(ax=axs[0], alpha_value=alpha_value, null_percent=all_routes_null_p, legend_loc='upper right')
-    light_rail.plot_alt_hypothesis(ax=axs[1], alpha_value=alpha_value, null_percent=light_rail_null_p, legend_loc='upper right')
-    bus.plot_alt_hypothesis(ax=axs[2], alpha_value=alpha_value, null_percent=bus_null_p, legend_loc='upper right')
-    fig.suptitle(f"Binomial Distributions of Null and Alternate Hypotheses"
-                ,fontsize=set_fontsize)
-    plt.savefig(f"images/modified_alt_hypothesis.png")
-
-    # Top 10 Routes
-    top_10_routes = list(all_routes.data.groupby('route_short_name').size().sort_values(ascending=False)[0:10].index)
-    alpha_value = 0.01/10
-    set_figsize = (20,70)
-    plt.rc('xtick',labelsize=15)
-    plt.rc('ytick',labelsize=15)
-   
-    fig, axs = plt.subplots(10,1, figsize=set_figsize, constrained_layout=True)
-    
-    for idx, route in enumerate(top_10_routes):
-        route_data = RTD_analyze(rtd_data, route_label=route)
-        route_data.calculate_ontime_departure()
-        route_data.plot_null_hypothesis(ax=axs[idx], alpha_value=alpha_value, null_percent=0.86)
-    
-    fig.suptitle(f"Binomial Distributions of Null Hypotheses"
-                ,fontsize=set_fontsize)
-    plt.savefig(f"images/top_10_routes_null_hypothesis.png")
-
-    fig, axs = plt.subplots(10,1, figsize=set_figsize, constrained_layout=True)
-    
-    for idx, route in enumerate(top_10_routes):
-        route_data = RTD_analyze(rtd_data, route_label=route)
-        route_data.calculate_ontime_departure()
-        if route == '40':
-            route_data.plot_alt_hypothesis(ax=axs[idx], alpha_value=alpha_value, null_percent=0.86, legend_loc='upper right')
-        else:
-            route_data.plot_alt_hypothesis(ax=axs[idx], alpha_value=alpha_value, null_percent=0.86, legend_loc='upper center')
-    
-    fig.suptitle(f"Binomial Distributions of Null and Alternate Hypotheses"
-                ,fontsize=set_fontsize)
-    plt.savefig(f"images/top_10_routes_alt_hypothesis.png")
-
-    # Cluster Maps
-    all_routes.cluster_map()
-    light_rail.cluster_map()
-    bus.cluster_map()
-
-    # Neighborhood Maps
-    all_routes.neighborhood_map()
-    light_rail.neighborhood_map()
-    bus.neighborhood_map()
\ No newline at end of file
+    # The figures, maps and tables are built in parallel by rtd_report (see python rtd_report.py --help)
+    import rtd_report
+    rtd_report.main()
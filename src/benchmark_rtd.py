@@ -0,0 +1,721 @@
+#!/opt/anaconda3/bin/python3
+
+import os
+import re
+import time
+import timeit
+import argparse
+import tempfile
+import traceback
+import subprocess
+import numpy as np
+import pandas as pd
+import scipy.stats as stats
+import rtd_profile
+import gtfs_static
+import rtd_schema
+import clean_rtd_data
+import analyze_rtd_data
+from rtd_feed import RTD_Feed
+from rtd_archive import RTD_Archive
+from rtd_live import RTD_Live
+import synthetic_rtd_data
+
+def time_it(func, repeat=5, number=1):
+    '''
+    Times a function and returns the best run, which is the least noisy estimate of its cost.
+
+    Args:
+        func (callable): Function with no arguments to time.
+        repeat (int): Number of times to repeat the timing. Default value is 5.
+        number (int): Number of calls per repeat. Default value is 1.
+
+    Returns:
+        seconds (float): The fastest time of a single call in seconds.
+    '''
+    return min(timeit.repeat(func, repeat=repeat, number=number)) / number
+
+def legacy_parse_to_df(rtd_feed):
+    '''
+    The original dict-of-dicts implementation of RTD_Feed.parse_to_df, kept as the benchmark baseline.
+
+    Args:
+        rtd_feed (RTD_Feed): The feed to parse.
+
+    Returns:
+        pandas DataFrame (pd.DataFrame): The parsed vehicle positions.
+    '''
+    vehicle_dict = {}
+
+    for entity in rtd_feed.feed.entity:
+        if (entity.HasField('id')) & (entity.vehicle.HasField('trip')):
+            vehicle_dict[entity.id] = {}
+            vehicle_dict[entity.id]['trip_id'] = entity.vehicle.trip.trip_id
+            vehicle_dict[entity.id]['schedule_relationship'] = entity.vehicle.trip.schedule_relationship
+            vehicle_dict[entity.id]['route_id'] = entity.vehicle.trip.route_id
+            vehicle_dict[entity.id]['direction_id'] = entity.vehicle.trip.direction_id
+            vehicle_dict[entity.id]['vehicle_lat'] = entity.vehicle.position.latitude
+            vehicle_dict[entity.id]['vehicle_lng'] = entity.vehicle.position.longitude
+            vehicle_dict[entity.id]['bearing'] = round(entity.vehicle.position.bearing)
+            vehicle_dict[entity.id]['current_status'] = entity.vehicle.current_status
+            vehicle_dict[entity.id]['timestamp'] = entity.vehicle.timestamp
+            vehicle_dict[entity.id]['stop_id'] = entity.vehicle.stop_id
+            vehicle_dict[entity.id]['vehicle_id'] = entity.vehicle.vehicle.id
+            vehicle_dict[entity.id]['vehicle_label'] = entity.vehicle.vehicle.label
+
+    return pd.DataFrame.from_dict(vehicle_dict, orient='index').rename_axis('entity_id').reset_index()
+
+def benchmark_parse_to_df(n_vehicles=10000):
+    '''
+    Compares the legacy parse against each output of the columnar RTD_Feed.parse_to_df on a synthetic feed.
+
+    Args:
+        n_vehicles (int): Number of vehicle entities in the synthetic feed. Default value is 10,000.
+
+    Returns:
+        results (pd.DataFrame): Seconds per parse and speedup over the legacy parse for each method.
+    '''
+    content = synthetic_rtd_data.make_vehicle_feed(n_vehicles).SerializeToString()
+    rtd_feed = RTD_Feed.from_content(content)
+
+    pd.testing.assert_frame_equal(legacy_parse_to_df(rtd_feed), rtd_feed.parse_to_df(), check_dtype=False)
+
+    timings = {'legacy dict-of-dicts': time_it(lambda: legacy_parse_to_df(rtd_feed))
+              ,'columnar pandas': time_it(lambda: rtd_feed.parse_to_df())
+              ,'columnar numpy': time_it(lambda: rtd_feed.parse_to_df(output='numpy'))}
+    try:
+        import pyarrow
+        timings['columnar arrow'] = time_it(lambda: rtd_feed.parse_to_df(output='arrow'))
+    except ImportError:
+        pass
+
+    results = pd.DataFrame({'seconds': timings})
+    results['speedup'] = results.seconds['legacy dict-of-dicts'] / results.seconds
+    return results
+
+def benchmark_distance(n_rows=1000000, n_geopy_rows=20000, seed=0):
+    '''
+    Times calculate_distance's methods on vehicle/stop pairs around Denver and compares the vectorized 
+    methods' accuracy against geopy's geodesic distance. geopy is timed on a subset and scaled to n_rows.
+
+    Args:
+        n_rows (int): Number of point pairs to time the vectorized methods on. Default value is 1,000,000.
+        n_geopy_rows (int): Number of point pairs to run through geopy. Default value is 20,000.
+        seed (int): Seed for the random points. Default value is 0.
+
+    Returns:
+        results (pd.DataFrame): Seconds for n_rows, speedup over geopy and max/mean absolute error in meters.
+    '''
+    rng = np.random.default_rng(seed)
+    stop_lat = rng.uniform(39.5, 40.1, n_rows)
+    stop_lng = rng.uniform(-105.3, -104.6, n_rows)
+    # Vehicles are mostly within a few hundred meters of the stop, sometimes several kilometers away
+    offset = rng.exponential(0.003, (2, n_rows)) * rng.choice([-1, 1], (2, n_rows))
+    rtd_data = clean_rtd_data.RTD_df.__new__(clean_rtd_data.RTD_df)
+    rtd_data.df = pd.DataFrame({'vehicle_lat': stop_lat + offset[0], 'vehicle_lng': stop_lng + offset[1]
+                               ,'stop_lat': stop_lat, 'stop_lng': stop_lng})
+    args = ('vehicle_lat', 'vehicle_lng', 'stop_lat', 'stop_lng')
+
+    full_df = rtd_data.df
+    rtd_data.df = full_df.iloc[:n_geopy_rows].copy()
+    geopy_seconds = time_it(lambda: rtd_data.calculate_distance(*args, 'meters', method='geodesic'), repeat=1)
+    geodesic = rtd_data.df.meters.to_numpy()
+
+    timings = {'geodesic (geopy)': geopy_seconds * n_rows / n_geopy_rows}
+    errors = {'geodesic (geopy)': (0.0, 0.0)}
+    for method in ['vincenty', 'haversine']:
+        rtd_data.df = full_df.iloc[:n_geopy_rows].copy()
+        rtd_data.calculate_distance(*args, 'meters', method=method)
+        error = np.abs(rtd_data.df.meters.to_numpy() - geodesic)
+        errors[method] = (error.max(), error.mean())
+
+        rtd_data.df = full_df.copy()
+        timings[method] = time_it(lambda: rtd_data.calculate_distance(*args, 'meters', method=method), repeat=3)
+
+    results = pd.DataFrame({'seconds': timings})
+    results['speedup'] = results.seconds['geodesic (geopy)'] / results.seconds
+    results['max_error_m'] = [errors[method][0] for method in results.index]
+    results['mean_error_m'] = [errors[method][1] for method in results.index]
+    return results
+
+def legacy_calculate_time(df, time_1, time_2, new_column):
+    '''
+    The original row-by-row implementation of RTD_df.calculate_time (including clean_my_data's rewrite of
+    24:xx/25:xx hours to 00:xx), kept as the benchmark baseline.
+
+    Args:
+        df (pd.DataFrame): DataFrame with a tz-aware timestamp column and a %H:%M:%S string column.
+        time_1 (str): The name of the timestamp column.
+        time_2 (str): The name of the schedule time column.
+        new_column (str): The name of the new column created from the difference in times.
+    '''
+    df[time_2] = df[time_2].replace({r'^24': '00', r'^25': '00'}, regex=True)
+    p = re.compile(r'00:\d{2}')
+    overnight = ((df[time_2].apply(lambda x: bool(p.match(x[0:5])))) & (df[time_1].apply(lambda x: x.hour) == 23))
+    df.loc[~overnight, 'day_date'] = (df[time_1].dt.tz_localize(None).dt.to_period('D')).astype(str)
+    df.loc[overnight, 'day_date'] = (df[time_1].dt.tz_localize(None).dt.to_period('D') + np.timedelta64(1,'D')).astype(str)
+    scheduled_timestamp = pd.to_datetime(df.day_date + ' ' + df[time_2])
+    time_diff = df[time_1].dt.tz_localize(None) - scheduled_timestamp.apply(lambda x: pd.Timestamp(x))
+    df[new_column] = time_diff.apply(lambda x: x.total_seconds()/60)
+
+def make_schedule_frame(n_rows, seed=0):
+    '''
+    Creates departures spread over a month of service with schedule times a few minutes off the observed
+    time, including trips past midnight written as 24:xx/25:xx.
+
+    Args:
+        n_rows (int): Number of rows.
+        seed (int): Seed for the random times. Default value is 0.
+
+    Returns:
+        df (pd.DataFrame): Columns departure_timestamp (tz-aware) and scheduled_departure_time (%H:%M:%S).
+    '''
+    rng = np.random.default_rng(seed)
+    service_day = rng.integers(0, 28, n_rows)
+    scheduled = rng.integers(4 * 3600, 26 * 3600, n_rows)
+    observed = scheduled + rng.integers(-120, 600, n_rows)
+    start = pd.Timestamp('2021-02-01')
+    departure_timestamp = (start + pd.to_timedelta(service_day, unit='D') + pd.to_timedelta(observed, unit='s')).tz_localize('US/Mountain')
+    scheduled_time = [f"{s // 3600:02d}:{s % 3600 // 60:02d}:{s % 60:02d}" for s in scheduled]
+    return pd.DataFrame({'departure_timestamp': departure_timestamp, 'scheduled_departure_time': scheduled_time})
+
+def benchmark_calculate_time(n_rows=2000000, n_legacy_rows=200000):
+    '''
+    Compares the legacy row-by-row calculate_time against the vectorized RTD_df.calculate_time. The legacy 
+    version is timed on a subset and scaled to n_rows.
+
+    Args:
+        n_rows (int): Number of rows to time the vectorized version on. Default value is 2,000,000.
+        n_legacy_rows (int): Number of rows to run through the legacy version. Default value is 200,000.
+
+    Returns:
+        results (pd.DataFrame): Seconds for n_rows and speedup over the legacy version.
+    '''
+    df = make_schedule_frame(n_rows)
+    args = ('departure_timestamp', 'scheduled_departure_time', 'minutes_since_departure')
+
+    legacy_df = df.iloc[:n_legacy_rows].copy()
+    legacy_seconds = time_it(lambda: legacy_calculate_time(legacy_df.copy(), *args), repeat=1)
+
+    rtd_data = clean_rtd_data.RTD_df.__new__(clean_rtd_data.RTD_df)
+    rtd_data.df = df
+    timings = {'legacy apply/regex': legacy_seconds * n_rows / n_legacy_rows
+              ,'vectorized': time_it(lambda: rtd_data.calculate_time(*args), repeat=3)}
+
+    results = pd.DataFrame({'seconds': timings})
+    results['speedup'] = results.seconds['legacy apply/regex'] / results.seconds
+    return results
+
+def benchmark_memory(n_rows=1000000):
+    '''
+    Compares the memory of a cleaned frame with the dtypes the pipeline used to produce against the same
+    frame with rtd_schema.CLEAN_DTYPES applied.
+
+    Args:
+        n_rows (int): Number of cleaned departures. Default value is 1,000,000 (roughly a week of RTD data).
+
+    Returns:
+        results (pd.DataFrame): Bytes per column before and after the schema, and the reduction factor.
+    '''
+    before = synthetic_rtd_data.make_cleaned_frame(n_rows)
+    after = before.assign(scheduled_arrival_time=clean_rtd_data.gtfs_time_to_seconds(before.scheduled_arrival_time)
+                         ,scheduled_departure_time=clean_rtd_data.gtfs_time_to_seconds(before.scheduled_departure_time))
+    after = rtd_schema.apply_schema(after, rtd_schema.CLEAN_DTYPES)
+
+    results = pd.DataFrame({'before_bytes': rtd_schema.memory_report(before).bytes
+                           ,'after_bytes': rtd_schema.memory_report(after).bytes})
+    results['reduction'] = results.before_bytes / results.after_bytes
+    return results.sort_values('before_bytes', ascending=False)
+
+def legacy_classify_departures(route_type, minutes_since_departure):
+    '''
+    The original loop from RTD_analyze.calculate_ontime_departure, kept as the benchmark baseline. Rows that
+    match no condition (e.g. NaN minutes) are skipped, so the result can be shorter than the input.
+
+    Args:
+        route_type (pd.Series): The mode of each departure.
+        minutes_since_departure (pd.Series): Minutes between the actual and scheduled departure.
+
+    Returns:
+        ontime_departure (list): 'on_time', 'early' or 'late' for each classified departure.
+    '''
+    ontime_departure = []
+
+    for rt, dt in zip(route_type, minutes_since_departure):
+        if ((rt == 'bus') | (rt == 'light_rail')) & (dt >= -1) & (dt <= 5):
+            ontime_departure.append('on_time')
+        elif (rt == 'commuter_rail') & (dt >= 0) & (dt <= 5):
+            ontime_departure.append('on_time')
+        elif ((rt == 'bus') | (rt == 'light_rail')) & (dt < -1):
+            ontime_departure.append('early')
+        elif (rt == 'commuter_rail') & (dt < 0):
+            ontime_departure.append('early')
+        elif ((rt == 'bus') | (rt == 'light_rail')) & (dt > 5):
+            ontime_departure.append('late')
+        elif (rt == 'commuter_rail') & (dt > 5):
+            ontime_departure.append('late')
+    return ontime_departure
+
+def benchmark_classify_departures(n_rows=2000000):
+    '''
+    Compares the legacy classification loop against the vectorized analyze_rtd_data.classify_departures.
+
+    Args:
+        n_rows (int): Number of departures. Default value is 2,000,000.
+
+    Returns:
+        results (pd.DataFrame): Seconds per classification and speedup over the loop.
+    '''
+    df = synthetic_rtd_data.make_cleaned_frame(n_rows)[['route_type', 'minutes_since_departure']]
+    df = rtd_schema.apply_schema(df, rtd_schema.CLEAN_DTYPES)
+    route_type = df.route_type
+    minutes = df.minutes_since_departure.round()
+
+    legacy = legacy_classify_departures(route_type, minutes)
+    vectorized = analyze_rtd_data.classify_departures(route_type, minutes)
+    assert legacy == vectorized.astype(str).tolist()
+
+    timings = {'legacy loop': time_it(lambda: legacy_classify_departures(route_type, minutes), repeat=1)
+              ,'vectorized np.select': time_it(lambda: analyze_rtd_data.classify_departures(route_type, minutes))}
+
+    results = pd.DataFrame({'seconds': timings})
+    results['speedup'] = results.seconds['legacy loop'] / results.seconds
+    return results
+
+def legacy_calculate_p_null(n, p_alt, alpha, n_grid=100000):
+    '''
+    The original grid search of RTD_analyze.calculate_p_null, kept as the benchmark baseline. n_grid was
+    fixed at 100,000.
+
+    Returns:
+        p_null (float): The last grid point whose power rounds to 0.80, or None if no point does.
+    '''
+    alt_dist = stats.binom(n, p_alt)
+    power_dict = {}
+    for p in np.linspace(p_alt, p_alt + 0.1, n_grid):
+        null_dist = stats.binom(n, p)
+        power_dict[p] = alt_dist.cdf(null_dist.ppf(alpha))
+
+    p_null = None
+    for k, v in power_dict.items():
+        if round(v, 2) == 0.80:
+            p_null = k
+    return p_null
+
+def benchmark_calculate_p_null(n=2000000, p_alt=0.86, alpha=0.01/3, n_legacy_grid=2000):
+    '''
+    Times the legacy grid search against solve_p_null for one route-sized sample, and the exact solver on a
+    grid of 20 alphas by 20 powers. The legacy search is run on n_legacy_grid points and scaled to 100,000.
+
+    Returns:
+        results (pd.DataFrame): Seconds and p_null found by each approach.
+    '''
+    legacy_seconds = time_it(lambda: legacy_calculate_p_null(n, p_alt, alpha, n_legacy_grid), repeat=1)
+    alphas = np.linspace(0.001, 0.05, 20)[:, None]
+    powers = np.linspace(0.5, 0.95, 20)[None, :]
+
+    timings = {'legacy grid (100k points)': legacy_seconds * 100000 / n_legacy_grid
+              ,'bisection': time_it(lambda: analyze_rtd_data.solve_p_null(n, p_alt, alpha, method='exact'))
+              ,'normal approximation': time_it(lambda: analyze_rtd_data.solve_p_null(n, p_alt, alpha, method='normal'))
+              ,'bisection, 20x20 grid': time_it(lambda: analyze_rtd_data.solve_p_null(n, p_alt, alphas, powers, method='exact'))}
+    p_nulls = {'legacy grid (100k points)': legacy_calculate_p_null(n, p_alt, alpha, n_legacy_grid)
+              ,'bisection': analyze_rtd_data.solve_p_null(n, p_alt, alpha, method='exact')
+              ,'normal approximation': analyze_rtd_data.solve_p_null(n, p_alt, alpha, method='normal')
+              ,'bisection, 20x20 grid': np.nan}
+
+    results = pd.DataFrame({'seconds': timings, 'p_null': p_nulls})
+    results['speedup'] = results.seconds['legacy grid (100k points)'] / results.seconds
+    return results
+
+def benchmark_ontime_stats(n_rows=2000000, alpha=0.01/10):
+    '''
+    Times analyzing every route one RTD_analyze at a time, the way analyze_rtd_data.py's __main__ used to,
+    against one call of ontime_stats that also covers every mode, direction and stop. Checks the route counts
+    agree.
+
+    Args:
+        n_rows (int): Number of cleaned departures. Default value is 2,000,000.
+        alpha (float): Significance level of the tests. Default value is 0.001.
+
+    Returns:
+        results (pd.DataFrame): Seconds, # of groups analyzed and seconds per group of each approach.
+    '''
+    rtd_data = clean_rtd_data.RTD_df.__new__(clean_rtd_data.RTD_df)
+    df = synthetic_rtd_data.make_cleaned_frame(n_rows)
+    df = df.assign(scheduled_arrival_time=clean_rtd_data.gtfs_time_to_seconds(df.scheduled_arrival_time)
+                  ,scheduled_departure_time=clean_rtd_data.gtfs_time_to_seconds(df.scheduled_departure_time))
+    rtd_data.df = rtd_schema.apply_schema(df, rtd_schema.CLEAN_DTYPES)
+    routes = rtd_data.df.route_short_name.cat.categories
+
+    def per_route():
+        results = {}
+        for route in routes:
+            route_data = analyze_rtd_data.RTD_analyze(rtd_data, route_label=route)
+            route_data.calculate_ontime_departure()
+            results[route] = (route_data.total_stops, route_data.ontime_stops, route_data.calculate_p_null(alpha))
+        return results
+
+    legacy = per_route()
+    grouped = analyze_rtd_data.ontime_stats(rtd_data.df, alpha=alpha)
+    by_route = grouped[grouped.level == 'route'].set_index('route_short_name')
+    assert all((by_route.total_stops[route], by_route.ontime_stops[route]) == legacy[route][:2] for route in routes)
+
+    timings = {'RTD_analyze per route': time_it(per_route, repeat=1)
+              ,'ontime_stats': time_it(lambda: analyze_rtd_data.ontime_stats(rtd_data.df, alpha=alpha), repeat=3)}
+    results = pd.DataFrame({'seconds': timings
+                           ,'groups': {'RTD_analyze per route': len(routes), 'ontime_stats': len(grouped)}})
+    results['seconds_per_group'] = results.seconds / results.groups
+    return results
+
+def legacy_plot_alt_hypothesis(ax, n, null_percent, alt_percent, alpha_value):
+    '''
+    The original plotting of RTD_analyze.plot_alt_hypothesis, which evaluates both distributions at every
+    integer from 0 to n, kept as the benchmark baseline.
+    '''
+    null_dist = stats.binom(n=n, p=null_percent)
+    alt_dist = stats.binom(n=n, p=alt_percent)
+    x = np.linspace(0, n, n+1)
+    ax.plot(x, null_dist.pmf(x))
+    ax.plot(x, alt_dist.pmf(x))
+    ax.set_xlim(min(alt_dist.ppf(0.00001), null_dist.ppf(0.00001)), max(alt_dist.ppf(0.99999), null_dist.ppf(0.99999)))
+    ax.axvline(null_dist.ppf(alpha_value), linestyle='--', color='grey')
+    ax.fill_between(x, null_dist.pmf(x), where= (x <= null_dist.ppf(alpha_value)), alpha=0.25)
+    ax.fill_between(x, alt_dist.pmf(x), where= (x >= null_dist.ppf(alpha_value)), alpha=0.25)
+    ax.fill_between(x, alt_dist.pmf(x), where= (x < null_dist.ppf(alpha_value)), alpha=0.25, color='Green')
+
+def benchmark_plot_hypothesis(n_values=(10000, 100000, 1000000, 10000000), n_legacy_max=1000000, alpha_value=0.01/3):
+    '''
+    Times drawing and rendering plot_alt_hypothesis (to an Agg canvas) as the # of departures grows, against
+    the original plotting up to n_legacy_max departures.
+
+    Returns:
+        results (pd.DataFrame): Seconds of the legacy and windowed plots for each n.
+    '''
+    plt = analyze_rtd_data.set_plot_style('Agg')
+
+    def render(plot):
+        fig, ax = plt.subplots(figsize=(20,10))
+        plot(ax)
+        fig.canvas.draw()
+        plt.close(fig)
+
+    results = {}
+    for n in n_values:
+        rtd_analyze = analyze_rtd_data.RTD_analyze.__new__(analyze_rtd_data.RTD_analyze)
+        rtd_analyze.route_type, rtd_analyze.route_label = 'All', 'All'
+        rtd_analyze.total_stops, rtd_analyze.ontime_stops = n, int(n * 0.85)
+        rtd_analyze.ontime_departure_rate = rtd_analyze.ontime_stops / n
+        null_percent = analyze_rtd_data.solve_p_null(n, rtd_analyze.ontime_departure_rate, alpha_value)
+
+        analyze_rtd_data.pmf_arrays.cache_clear()
+        windowed = time_it(lambda: render(lambda ax: rtd_analyze.plot_alt_hypothesis(ax, alpha_value, null_percent, 'upper right')), repeat=1)
+        legacy = np.nan
+        if n <= n_legacy_max:
+            legacy = time_it(lambda: render(lambda ax: legacy_plot_alt_hypothesis(ax, n, null_percent, rtd_analyze.ontime_departure_rate, alpha_value)), repeat=1)
+        results[n] = {'legacy_seconds': legacy, 'windowed_seconds': windowed}
+
+    results = pd.DataFrame(results).T
+    results.index.name = 'n'
+    return results
+
+def benchmark_archive(n_snapshots=360, n_vehicles=1000, interval=10):
+    '''
+    Archives an hour of synthetic Vehicle Position snapshots with RTD_Archive and times writing them, reading
+    them back, replaying them through RTD_Feed and parsing them with parse_to_df.
+
+    Args:
+        n_snapshots (int): Number of snapshots archived. Default value is 360.
+        n_vehicles (int): Number of vehicle entities in each snapshot. Default value is 1,000.
+        interval (int): Seconds of feed time between snapshots. Default value is 10.
+
+    Returns:
+        results (pd.DataFrame): Seconds per snapshot and multiple of real time of each step, and the
+            compression ratio of the archive.
+    '''
+    contents = [synthetic_rtd_data.make_vehicle_feed(n_vehicles, timestamp=1612900800 + idx * interval, seed=idx).SerializeToString()
+                for idx in range(n_snapshots)]
+
+    with tempfile.TemporaryDirectory() as root:
+        archive = RTD_Archive(root)
+        timings = {'append': time_it(lambda: [archive.append(content) for content in contents], repeat=1)}
+        archived_bytes = sum(os.path.getsize(f"{segment}.seg") for segment in archive.segments())
+
+        timings['read'] = time_it(lambda: list(archive.read()), repeat=3)
+        timings['replay through RTD_Feed'] = time_it(lambda: list(archive.replay()), repeat=3)
+        timings['replay + parse_to_df'] = time_it(lambda: [rtd_feed.parse_to_df() for rtd_feed in archive.replay()], repeat=3)
+
+    results = pd.DataFrame({'seconds_per_snapshot': timings}) / n_snapshots
+    results['x_real_time'] = interval / results.seconds_per_snapshot
+    results['compression_ratio'] = sum(len(content) for content in contents) / archived_bytes
+    return results
+
+def make_synthetic_rtd_data(root, n_routes=150, days=1, poll_seconds=60, seed=0):
+    '''
+    Writes a synthetic GTFS static feed to root/google_transit and simulates the raw vehicle positions of its
+    trips, so the whole pipeline can be benchmarked offline at any scale.
+
+    Args:
+        root (str): Directory to write the feed to.
+        n_routes (int): Number of routes, 40 trips each per day. Default value is 150.
+        days (int): Number of service days of raw data. Default value is 1.
+        poll_seconds (int): Seconds between polls. Default value is 60.
+        seed (int): Seed for the random number generators. Default value is 0.
+
+    Returns:
+        rtd_data (RTD_df): An RTD_df with the raw rows in .df and the synthetic feed as its gtfs_path.
+    '''
+    gtfs_path = os.path.join(root, 'google_transit')
+    gtfs = synthetic_rtd_data.make_gtfs_static(gtfs_path, n_routes=n_routes, seed=seed)
+    rtd_data = clean_rtd_data.RTD_df.__new__(clean_rtd_data.RTD_df)
+    rtd_data.gtfs_path = gtfs_path
+    rtd_data.df = synthetic_rtd_data.make_raw_frame(gtfs, days=days, poll_seconds=poll_seconds, seed=seed)
+    return rtd_data
+
+def benchmark_clean_stages(n_routes=150, days=2, poll_seconds=60):
+    '''
+    Runs clean_my_data on synthetic raw data with rtd_profile enabled and reports every stage, after
+    timing a parse of the synthetic GTFS feed without its Parquet cache on its own.
+
+    Args:
+        n_routes (int): Number of routes, 40 trips each per day. Default value is 150.
+        days (int): Number of service days of raw data. Default value is 2.
+        poll_seconds (int): Seconds between polls. Default value is 60.
+
+    Returns:
+        results (pd.DataFrame): calls, wall and CPU seconds and rows in and out of each stage.
+    '''
+    with tempfile.TemporaryDirectory() as root:
+        rtd_data = make_synthetic_rtd_data(root, n_routes, days, poll_seconds)
+        start = time.perf_counter()
+        gtfs_static.GTFS_Static(rtd_data.gtfs_path)
+        gtfs_seconds = time.perf_counter() - start
+
+        profiler = rtd_profile.enable(memory=False)
+        try:
+            rtd_data.clean_my_data()
+        finally:
+            rtd_profile.disable()
+
+    results = profiler.report().loc[:, ['calls', 'wall_seconds', 'cpu_seconds', 'rows_in', 'rows_out']]
+    results.index = [path.replace('RTD_df.clean_my_data/', '  ') for path in results.index]
+    results.loc['GTFS_Static (uncached parse)', ['calls', 'wall_seconds']] = [1, gtfs_seconds]
+    return results
+
+def benchmark_analyze(n_routes=150, days=2, poll_seconds=60, alpha=0.01/3):
+    '''
+    Cleans synthetic raw data once, then times RTD_analyze's statistics and maps on it. The maps are written
+    to a temporary directory; neighborhood_map reads NEIGHBORHOOD_SHAPES from data/, so run it from the
+    repository root.
+
+    Args:
+        n_routes (int): Number of routes, 40 trips each per day. Default value is 150.
+        days (int): Number of service days of raw data. Default value is 2.
+        poll_seconds (int): Seconds between polls. Default value is 60.
+        alpha (float): Significance level of the tests. Default value is 0.01/3.
+
+    Returns:
+        results (pd.DataFrame): Seconds of each step, NaN for a step that failed (its error is printed).
+    '''
+    timings = {}
+    with tempfile.TemporaryDirectory() as root:
+        rtd_data = make_synthetic_rtd_data(root, n_routes, days, poll_seconds)
+        rtd_data.clean_my_data()
+        # The maps look the stops up in the synthetic feed at rtd_data.gtfs_path and are saved under root
+        map_dir = os.path.join(root, 'html')
+        os.makedirs(map_dir)
+        rtd_analyze = analyze_rtd_data.RTD_analyze(rtd_data, map_dir=map_dir)
+
+        steps = {'calculate_ontime_departure': rtd_analyze.calculate_ontime_departure
+                ,'calculate_p_null': lambda: rtd_analyze.calculate_p_null(alpha)
+                ,'ontime_stats': lambda: analyze_rtd_data.ontime_stats(rtd_data.df, alpha=alpha)
+                ,'cluster_map': rtd_analyze.cluster_map
+                ,'neighborhood_map': rtd_analyze.neighborhood_map}
+
+        for step, func in steps.items():
+            try:
+                timings[step] = time_it(func, repeat=1)
+            except Exception:
+                print(f"{step} failed:\n{traceback.format_exc()}")
+                timings[step] = np.nan
+
+    results = pd.DataFrame({'seconds': timings})
+    results['rows_per_second'] = rtd_analyze.data.shape[0] / results.seconds
+    return results
+
+def benchmark_live(n_routes=20, poll_seconds=60, window_minutes=60):
+    '''
+    Replays a day of synthetic Vehicle Position snapshots through RTD_Live and times updating the live state
+    and computing its metrics. The metrics are checked to be empty, not to fail, until the first departure,
+    and to count exactly the departures of the first snapshot that has any.
+
+    Args:
+        n_routes (int): Number of routes, 40 trips each per day. Default value is 20.
+        poll_seconds (int): Seconds between snapshots. Default value is 60.
+        window_minutes (int): Rolling window of the metrics, in minutes. Default value is 60.
+
+    Returns:
+        results (pd.DataFrame): Seconds per snapshot of update and metrics, and the multiple of real time.
+    '''
+    with tempfile.TemporaryDirectory() as root:
+        gtfs_path = os.path.join(root, 'google_transit')
+        gtfs = synthetic_rtd_data.make_gtfs_static(gtfs_path, n_routes=n_routes)
+        live = RTD_Live(gtfs_path, window_minutes=window_minutes)
+
+        metrics = live.metrics()
+        assert metrics.empty and (metrics.total_stops.dtype == 'int64')
+
+        timings = {'update': 0.0, 'metrics': 0.0}
+        n_snapshots, first_departures = 0, None
+        for feed in synthetic_rtd_data.make_vehicle_feeds(gtfs, poll_seconds=poll_seconds):
+            rtd_feed = RTD_Feed.from_content(feed.SerializeToString())
+            start = time.perf_counter()
+            departures = live.update(rtd_feed)
+            timings['update'] += time.perf_counter() - start
+            start = time.perf_counter()
+            metrics = live.metrics()
+            timings['metrics'] += time.perf_counter() - start
+            n_snapshots += 1
+
+            if first_departures is None:
+                if departures.empty:
+                    assert metrics.empty
+                else:
+                    first_departures = departures.departure_status.notnull().sum()
+                    assert metrics[metrics.level == 'all'].total_stops.item() == first_departures
+        assert first_departures is not None
+
+    results = pd.DataFrame({'seconds_per_snapshot': timings}) / n_snapshots
+    results['x_real_time'] = poll_seconds / results.seconds_per_snapshot
+    return results
+
+# Every benchmark: name -> (title, function). The synthetic pipeline benchmarks take the --routes/--days scale.
+BENCHMARKS = {'parse_to_df': ('parse_to_df on a 10k-entity synthetic feed', benchmark_parse_to_df)
+             ,'distance': ('calculate_distance on 1M vehicle/stop pairs around Denver', benchmark_distance)
+             ,'calculate_time': ('calculate_time on 2M departures', benchmark_calculate_time)
+             ,'memory': ('Memory of 1M cleaned departures before/after rtd_schema.CLEAN_DTYPES', benchmark_memory)
+             ,'classify_departures': ('Departure classification on 2M departures', benchmark_classify_departures)
+             ,'calculate_p_null': ('calculate_p_null for 2M departures', benchmark_calculate_p_null)
+             ,'ontime_stats': ('On-time statistics for every route on 2M departures', benchmark_ontime_stats)
+             ,'plot_hypothesis': ('plot_alt_hypothesis as the # of departures grows', benchmark_plot_hypothesis)
+             ,'archive': ('Raw snapshot archive on an hour of 1k-vehicle snapshots', benchmark_archive)
+             ,'live': ('RTD_Live on a day of synthetic snapshots, checking metrics before and after the first departure', benchmark_live)
+             ,'clean_stages': ('clean_my_data stage by stage on synthetic GTFS and vehicle positions', benchmark_clean_stages)
+             ,'analyze': ('RTD_analyze statistics and maps on synthetic cleaned data', benchmark_analyze)}
+
+SCALED_BENCHMARKS = ['clean_stages', 'analyze']
+
+# Where --save appends results, one row per benchmark, result row and metric of every run
+RESULTS_PATH = 'data/benchmark_results.csv'
+
+def git_commit():
+    '''
+    The commit the benchmarks run on, marked -dirty when the working tree has uncommitted changes.
+    '''
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True
+                             ,check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def save_results(name, results, commit, results_path=RESULTS_PATH):
+    '''
+    Appends the numeric values of a benchmark's results to the results csv, so runs of different commits
+    can be compared with compare_results.
+
+    Args:
+        name (str): Name of the benchmark.
+        results (pd.DataFrame): The DataFrame the benchmark returned.
+        commit (str): The commit the benchmark ran on.
+        results_path (str): The results csv. Default value is RESULTS_PATH.
+    '''
+    values = results.select_dtypes('number').astype('float64').stack().rename('value').reset_index()
+    values.columns = ['row', 'metric', 'value']
+    values.insert(0, 'benchmark', name)
+    values.insert(0, 'commit', commit)
+    values.insert(0, 'run_at', pd.Timestamp.now(tz='UTC').strftime('%Y-%m-%dT%H:%M:%SZ'))
+    values['row'] = values.row.astype(str).str.strip()
+    os.makedirs(os.path.dirname(os.path.abspath(results_path)), exist_ok=True)
+    values.to_csv(results_path, mode='a', header=not os.path.exists(results_path), index=False)
+
+def compare_results(base, head=None, results_path=RESULTS_PATH, metric_pattern='seconds'):
+    '''
+    Compares the latest saved run of two commits, metric by metric.
+
+    Args:
+        base (str): Commit to compare against.
+        head (str): Commit to compare. Default value is None, which uses the most recently saved commit.
+        results_path (str): The results csv. Default value is RESULTS_PATH.
+        metric_pattern (str): Regular expression selecting the metrics to compare. Default value is
+            'seconds', which compares every timing.
+
+    Returns:
+        comparison (pd.DataFrame): base and head values of each benchmark, row and metric and their ratio,
+            largest slowdowns first.
+    '''
+    saved = pd.read_csv(results_path, dtype={'commit': str})
+    head = saved.commit.iloc[-1] if head is None else head
+    saved = saved[saved.metric.str.contains(metric_pattern)]
+
+    def latest(commit):
+        runs = saved[saved.commit == commit]
+        if runs.empty:
+            raise ValueError(f"No saved results for commit {commit} in {results_path}")
+        # The latest run of each benchmark, since benchmarks can be run and saved separately
+        runs = runs[runs.run_at == runs.groupby('benchmark').run_at.transform('max')]
+        return runs.set_index(['benchmark', 'row', 'metric']).value
+
+    comparison = pd.DataFrame({'base': latest(base), 'head': latest(head)}).dropna()
+    comparison['ratio'] = comparison['head'] / comparison['base']
+    return comparison.sort_values('ratio', ascending=False)
+
+def parse_args(args=None):
+    '''
+    Parses the command line of the benchmark suite.
+    '''
+    parser = argparse.ArgumentParser(description='Runs the benchmarks, optionally saving the results by commit '
+                                                 'and comparing them against an earlier commit.')
+    parser.add_argument('benchmarks', nargs='*', help='Benchmarks to run (see --list). Default is all of them.')
+    parser.add_argument('--routes', type=int, default=150
+                       ,help='Routes of the synthetic GTFS feed (40 trips each per day). Default is 150.')
+    parser.add_argument('--days', type=int, default=2, help='Days of synthetic vehicle positions. Default is 2.')
+    parser.add_argument('--save', action='store_true', help="Append the results to --results-path.")
+    parser.add_argument('--results-path', default=RESULTS_PATH, help=f"Results csv. Default is {RESULTS_PATH}.")
+    parser.add_argument('--compare', default=None, metavar='COMMIT'
+                       ,help='Compare the latest saved results against those of COMMIT and exit.')
+    parser.add_argument('--list', action='store_true', help='List the benchmarks and exit.')
+    args = parser.parse_args(args)
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(unknown)}. Use --list to see the benchmarks.")
+    return args
+
+def main(args=None):
+    '''
+    Runs the benchmarks selected on the command line, printing every result and saving them if asked.
+    '''
+    args = parse_args(args)
+    if args.list:
+        print('\n'.join(f"{name}: {title}" for name, (title, _) in BENCHMARKS.items()))
+        return
+    if args.compare is not None:
+        with pd.option_context('display.max_rows', None, 'display.max_columns', None, 'display.width', 200):
+            print(compare_results(args.compare, results_path=args.results_path))
+        return
+
+    commit = git_commit()
+    for name in args.benchmarks or list(BENCHMARKS):
+        title, func = BENCHMARKS[name]
+        kwargs = {'n_routes': args.routes, 'days': args.days} if name in SCALED_BENCHMARKS else {}
+        print(f"\n{title}")
+        try:
+            results = func(**kwargs)
+        except Exception:
+            print(f"{name} failed:\n{traceback.format_exc()}")
+            continue
+        with pd.option_context('display.max_rows', None, 'display.max_columns', None, 'display.width', 200):
+            print(results)
+        if args.save:
+            save_results(name, results, commit, args.results_path)
+
+if __name__ == '__main__':
+    main()
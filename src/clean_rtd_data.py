@@ -1,33 +1,306 @@
-import re
 import os
 import io
-import boto3
 import numpy as np
 import pandas as pd
-import geopy.distance as geo
+import gtfs_static
+import rtd_cache
+import rtd_schema
+import rtd_storage
+import rtd_profile
+import pyarrow.dataset as ds
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+class S3_Range_Reader(io.RawIOBase):
+
+    def __init__(self, client, bucket_name, file_name, part_size=8*1024**2, max_concurrency=4):
+        '''
+        Read-only file object over an S3 object that downloads it as a sequence of ranged GETs, prefetching
+        up to max_concurrency parts in parallel. At most max_concurrency + 1 parts are held in memory at once,
+        no matter how large the object is.
+
+        Args:
+            client (boto3 S3 client): Any object with boto3's head_object and get_object(Range=...) methods,
+                e.g. a moto or file-backed fake client in tests.
+            bucket_name (string): The name of the AWS bucket.
+            file_name (string): The key of the object in the bucket.
+            part_size (int): Number of bytes per ranged GET. Default value is 8 MiB.
+            max_concurrency (int): Number of ranged GETs in flight at once. Default value is 4.
+        '''
+        self.client = client
+        self.bucket_name = bucket_name
+        self.file_name = file_name
+        self.part_size = part_size
+        self.size = client.head_object(Bucket=bucket_name, Key=file_name)['ContentLength']
+        self.starts = iter(range(0, self.size, part_size))
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        self.pending = []
+        self.buffer = memoryview(b'')
+        for _ in range(max_concurrency):
+            self._submit_next()
+
+    def _fetch(self, start):
+        '''
+        Downloads the part of the object that begins at byte start.
+        '''
+        end = min(start + self.part_size, self.size) - 1
+        response = self.client.get_object(Bucket=self.bucket_name, Key=self.file_name, Range=f"bytes={start}-{end}")
+        return response['Body'].read()
+
+    def _submit_next(self):
+        '''
+        Queues the ranged GET of the next part, if there is one left.
+        '''
+        start = next(self.starts, None)
+        if start is not None:
+            self.pending.append(self.executor.submit(self._fetch, start))
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while (len(self.buffer) == 0) & (len(self.pending) > 0):
+            self.buffer = memoryview(self.pending.pop(0).result())
+            self._submit_next()
+        n = min(len(b), len(self.buffer))
+        b[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        return n
+
+    def close(self):
+        for future in self.pending:
+            future.cancel()
+        self.executor.shutdown(wait=False)
+        super().close()
+
+def iter_csv_chunks(client, bucket_name, file_name, chunk_rows=500000, part_size=8*1024**2, max_concurrency=4):
+    '''
+    Streams the raw csv from S3 as DataFrames of at most chunk_rows rows, parsed with rtd_schema.RAW_DTYPES.
+
+    Args:
+        client (boto3 S3 client): The client to read the object with.
+        bucket_name (string): The name of the AWS bucket.
+        file_name (string): The key of the csv in the bucket.
+        chunk_rows (int): Maximum number of rows per DataFrame. Default value is 500,000.
+        part_size (int): Number of bytes per ranged GET. Default value is 8 MiB.
+        max_concurrency (int): Number of ranged GETs in flight at once. Default value is 4.
+
+    Returns:
+        chunks (generator): Generator of pd.DataFrame chunks in file order.
+    '''
+    reader = io.BufferedReader(S3_Range_Reader(client, bucket_name, file_name, part_size, max_concurrency)
+                              ,buffer_size=part_size)
+    with reader:
+        yield from pd.read_csv(reader, encoding='utf8', dtype=rtd_schema.RAW_DTYPES, chunksize=chunk_rows)
+
+def s3_client():
+    '''
+    Creates a boto3 S3 client from the AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY environment variables.
+
+    Args: None
+
+    Returns:
+        client (boto3 S3 client): The S3 client.
+    '''
+    import boto3
+    aws_id = os.environ['AWS_ACCESS_KEY_ID']
+    aws_secret = os.environ['AWS_SECRET_ACCESS_KEY']
+    return boto3.client('s3'
+                       ,aws_access_key_id=aws_id
+                       ,aws_secret_access_key=aws_secret)
+
+# WGS84 ellipsoid, the same one geopy's geodesic distance uses
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+WGS84_B = (1 - WGS84_F) * WGS84_A
+EARTH_RADIUS = 6371008.8
+
+def haversine_distance(lat_1, lng_1, lat_2, lng_2):
+    '''
+    Vectorized great-circle distance in meters on a sphere of the earth's mean radius. Within 0.5% of the
+    geodesic distance, i.e. a few meters at most over the distances between a vehicle and its stop.
+
+    Args:
+        lat_1, lng_1, lat_2, lng_2 (np.ndarray): Arrays of latitudes and longitudes in degrees.
+
+    Returns:
+        distance (np.ndarray): Distance between each pair of points in meters.
+    '''
+    lat_1, lng_1, lat_2, lng_2 = map(np.radians, (lat_1, lng_1, lat_2, lng_2))
+    a = np.sin((lat_2 - lat_1) / 2)**2 + np.cos(lat_1) * np.cos(lat_2) * np.sin((lng_2 - lng_1) / 2)**2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+def vincenty_distance(lat_1, lng_1, lat_2, lng_2, tolerance=1e-12, max_iterations=200):
+    '''
+    Vectorized ellipsoidal (WGS84) distance in meters using Vincenty's inverse formula, iterating every pair
+    at once until all of them have converged. Agrees with geopy's geodesic distance to well under a millimeter
+    for non-antipodal points.
+
+    Args:
+        lat_1, lng_1, lat_2, lng_2 (np.ndarray): Arrays of latitudes and longitudes in degrees.
+        tolerance (float): Convergence tolerance on lambda in radians. Default value is 1e-12.
+        max_iterations (int): Maximum number of iterations. Default value is 200.
+
+    Returns:
+        distance (np.ndarray): Distance between each pair of points in meters.
+    '''
+    lat_1, lng_1, lat_2, lng_2 = map(np.radians, (lat_1, lng_1, lat_2, lng_2))
+    L = lng_2 - lng_1
+    U_1 = np.arctan((1 - WGS84_F) * np.tan(lat_1))
+    U_2 = np.arctan((1 - WGS84_F) * np.tan(lat_2))
+    sin_U1, cos_U1 = np.sin(U_1), np.cos(U_1)
+    sin_U2, cos_U2 = np.sin(U_2), np.cos(U_2)
+
+    lam = L.copy()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for _ in range(max_iterations):
+            sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+            sin_sigma = np.hypot(cos_U2 * sin_lam, cos_U1 * sin_U2 - sin_U1 * cos_U2 * cos_lam)
+            cos_sigma = sin_U1 * sin_U2 + cos_U1 * cos_U2 * cos_lam
+            sigma = np.arctan2(sin_sigma, cos_sigma)
+            sin_alpha = np.where(sin_sigma == 0, 0.0, cos_U1 * cos_U2 * sin_lam / sin_sigma)
+            cos2_alpha = 1 - sin_alpha**2
+            # Points on the equator have cos2_alpha == 0
+            cos_2sigma_m = np.where(cos2_alpha == 0, 0.0, cos_sigma - 2 * sin_U1 * sin_U2 / cos2_alpha)
+            C = WGS84_F / 16 * cos2_alpha * (4 + WGS84_F * (4 - 3 * cos2_alpha))
+            lam_prev = lam
+            lam = L + (1 - C) * WGS84_F * sin_alpha * (sigma + C * sin_sigma * (cos_2sigma_m + C * cos_sigma * (-1 + 2 * cos_2sigma_m**2)))
+            if np.nanmax(np.abs(lam - lam_prev), initial=0) < tolerance:
+                break
+
+    u2 = cos2_alpha * (WGS84_A**2 - WGS84_B**2) / WGS84_B**2
+    A = 1 + u2 / 16384 * (4096 + u2 * (-768 + u2 * (320 - 175 * u2)))
+    B = u2 / 1024 * (256 + u2 * (-128 + u2 * (74 - 47 * u2)))
+    delta_sigma = B * sin_sigma * (cos_2sigma_m + B / 4 * (cos_sigma * (-1 + 2 * cos_2sigma_m**2)
+                                   - B / 6 * cos_2sigma_m * (-3 + 4 * sin_sigma**2) * (-3 + 4 * cos_2sigma_m**2)))
+    return WGS84_B * A * (sigma - delta_sigma)
+
+def gtfs_time_to_seconds(times):
+    '''
+    Converts GTFS schedule times ('HH:MM:SS', where HH can be 24 or more for trips past midnight) to integer
+    seconds since the start of the service day. Each distinct time string is only parsed once.
+
+    Args:
+        times (pd.Series): Series of GTFS time strings. Numeric series are assumed to already be seconds 
+            and are returned unchanged.
+
+    Returns:
+        seconds (pd.Series): Seconds since the start of the service day, with NaN for missing or invalid times.
+    '''
+    if pd.api.types.is_numeric_dtype(times):
+        return times
+
+    codes, unique_times = pd.factorize(times)
+    parts = pd.Series(unique_times, dtype=object).str.extract(r'^\s*(\d+):(\d{2}):(\d{2})\s*$').astype('float64')
+    unique_seconds = (parts[0] * 3600 + parts[1] * 60 + parts[2]).to_numpy()
+    seconds = np.append(unique_seconds, np.nan)[codes]
+    return pd.Series(seconds, index=times.index, name=times.name)
+
+def shard_rows(df, n_shards, columns=('trip_id', 'vehicle_label')):
+    '''
+    Assigns each row to a shard by hashing its trip and vehicle, so every report of a vehicle on a trip (all
+    that shift_departures needs to see together) lands in the same shard.
+
+    Args:
+        df (pd.DataFrame): Raw vehicle positions.
+        n_shards (int): Number of shards.
+        columns (tuple): Columns hashed together. Default value is ('trip_id', 'vehicle_label').
+
+    Returns:
+        shards (np.ndarray): Shard number of each row.
+    '''
+    keys = df[list(columns)].astype(str)
+    return (pd.util.hash_pandas_object(keys, index=False).to_numpy() % n_shards).astype('int64')
+
+# Raw rows being cleaned in parallel, their shards and the GTFS feed to join. They are set in the parent before
+# the pool forks, so every worker reads them copy-on-write instead of having its shard pickled to it.
+_shard_input = {}
+
+def _clean_shard(shard, distance_method):
+    '''
+    Runs clean_my_data on one shard of _shard_input in a worker process.
+    '''
+    rtd_data = RTD_df.__new__(RTD_df)
+    rtd_data.gtfs_path = _shard_input['gtfs_path']
+    rtd_data.df = _shard_input['df'][_shard_input['shards'] == shard]
+    rtd_data.clean_my_data(distance_method)
+    return shard, rtd_data.df
 
 class RTD_df(object):
 
-    def __init__(self, bucket_name, file_name):
+    # Directory (or .zip) of the GTFS static feed joined onto the realtime data
+    gtfs_path = '~/Documents/dsi/repos/rtd_ontime_departure/data/google_transit'
+
+    def __init__(self, bucket_name, file_name, stream=False, max_memory=None, client=None
+                ,part_size=8*1024**2, max_concurrency=4):
         '''
         Initialize instance of a RTD_df class with the AWS bucket and filename:
 
         Args: 
             bucket_name (string): The name of an AWS bucket with the csv datafile in it.
             file_name (string): A csv filename where the RTD data is stored.
+            stream (bool): If True, the csv is streamed through parallel ranged GETs and parsed in chunks instead
+                of reading the whole object into memory first. Either way it is parsed with rtd_schema.RAW_DTYPES.
+                Default value is False.
+            max_memory (int): Memory ceiling in bytes for a streamed load, including the concat of the chunks
+                into one DataFrame, which needs as much memory again as the chunks. Chunks are sized to a fraction
+                of it and a MemoryError is raised as soon as the loaded rows exceed half of it. The ranged GETs in
+                flight (up to part_size * max_concurrency bytes) are not counted. Default value is None (no ceiling).
+            client (boto3 S3 client): S3 client to use, e.g. a moto or file-backed fake in tests. Defaults to a
+                client built from the AWS environment variables.
+            part_size (int): Number of bytes per ranged GET when streaming. Default value is 8 MiB.
+            max_concurrency (int): Number of ranged GETs in flight at once when streaming. Default value is 4.
         '''
         self.bucket_name = bucket_name
         self.file_name = file_name
 
-        aws_id = os.environ['AWS_ACCESS_KEY_ID']
-        aws_secret = os.environ['AWS_SECRET_ACCESS_KEY']
-        client = boto3.client('s3'
-                             ,aws_access_key_id=aws_id
-                             ,aws_secret_access_key=aws_secret)
+        if client is None:
+            client = s3_client()
+
+        if not stream:
+            csv_obj = client.get_object(Bucket=self.bucket_name, Key=self.file_name)
+            self.df = pd.read_csv(io.BytesIO(csv_obj['Body'].read()), encoding='utf8', dtype=rtd_schema.RAW_DTYPES)
+        else:
+            # ~100 bytes per parsed row; keep each chunk's parse buffers to a small slice of the ceiling
+            chunk_rows = 500000 if max_memory is None else max(1000, max_memory // 1000)
+            chunks = []
+            loaded_bytes = 0
+            for chunk in iter_csv_chunks(client, self.bucket_name, self.file_name, chunk_rows
+                                        ,part_size, max_concurrency):
+                chunks.append(chunk)
+                loaded_bytes += chunk.memory_usage(deep=True).sum()
+                # Half the ceiling is kept for the concat, which copies the chunks into a frame of the same size
+                if (max_memory is not None) and (loaded_bytes > max_memory // 2):
+                    raise MemoryError(f"{self.file_name} exceeds the memory ceiling of {max_memory} bytes "
+                                      f"({max_memory // 2} bytes of rows plus their concat)")
+            self.df = pd.concat(chunks, ignore_index=True)
+            del chunks
+
+    @classmethod
+    def from_parquet(cls, root, columns=None, start_date=None, end_date=None, filters=None):
+        '''
+        Initialize instance of a RTD_df class from the partitioned Parquet dataset written by 
+        pull_rtd_data.py, loading only the service dates and columns needed.
 
-        csv_obj = client.get_object(Bucket=self.bucket_name, Key=self.file_name)
-        self.df = pd.read_csv(io.BytesIO(csv_obj['Body'].read()), encoding='utf8')
+        Args:
+            root (string): Local directory or s3:// uri of the dataset, e.g. 's3://rtd-on-time-departure/rtd_data'
+            columns (list): Columns to load. Default value is None, which loads every column.
+            start_date (string): First service date to load ('YYYY-MM-DD'), inclusive. Default value is None.
+            end_date (string): Last service date to load ('YYYY-MM-DD'), inclusive. Default value is None.
+            filters (pyarrow.compute.Expression): Additional filter pushed down to the Parquet files.
+                Default value is None.
+
+        Returns:
+            rtd_data (RTD_df): The RTD_df class with the matching raw rows in self.df.
+        '''
+        rtd_data = cls.__new__(cls)
+        rtd_data.bucket_name = None
+        rtd_data.file_name = root
+        rtd_data.df = rtd_storage.read_partitioned(root, columns=columns, start_date=start_date
+                                                  ,end_date=end_date, filters=filters)
+        return rtd_data
         
+    @rtd_profile.profiled(frame='df')
     def convert_timezone_local(self, colname_list, current_timezone, local_timezone): 
         '''
         Converts the columns in colname_list to local timezone
@@ -39,8 +312,9 @@ class RTD_df(object):
             local_timezone (str): string of the timezone that the column name should be converted to.
         '''
         for column in colname_list:
-            self.df.loc[:, column] = pd.to_datetime(self.df[column], unit='s').dt.tz_localize(current_timezone).dt.tz_convert(local_timezone)
+            self.df[column] = pd.to_datetime(self.df[column], unit='s').dt.tz_localize(current_timezone).dt.tz_convert(local_timezone)
 
+    @rtd_profile.profiled(frame='df')
     def shift_departures(self, sorted_columns, grouped_columns, shifted_columns, new_column_names):
         '''
         Shift columns by -1 to account for departure data
@@ -56,10 +330,11 @@ class RTD_df(object):
             len(shifted_columns) == len(new_column_names)
             self.df = self.df.sort_values(sorted_columns)
             for new_col, shift_col in zip(new_column_names, shifted_columns):
-                self.df.loc[:, new_col] = self.df.groupby(grouped_columns)[shift_col].shift(-1)
+                self.df[new_col] = self.df.groupby(grouped_columns)[shift_col].shift(-1)
         except:
             print('Shifted Columns and New Column Names must have the same length')
 
+    @rtd_profile.profiled(frame='df', label='txt_file')
     def join_txt_file(self, txt_file, join_type, join_columns):
         '''
         Joins a txt column to a pandas DataFrame by the join_column(s) using the type of join passed ('left', 'outer')
@@ -78,9 +353,11 @@ class RTD_df(object):
             print(f'Current Columns: {self.df.columns}')
             print(f"Joined Columns: {pd.read_csv(txt_file, delimiter=',').columns}")
     
+    @rtd_profile.profiled(frame='df', label='colname')
     def parse_codes(self, colname, code_dict):
         '''
-        Converts coded integers to their real-world values given in the code_dict
+        Converts coded integers to a categorical of their real-world values given in the code_dict. Codes that
+        are not in code_dict become NaN.
 
         Args:
             colname (str): column name of dataframe that contains the coded values to be converted
@@ -88,28 +365,52 @@ class RTD_df(object):
             code_dict (dict): dictionary of code conversion where the keys are the code integers and values 
             are their corresponding real-world values.
         '''
-        self.df[colname] = self.df[colname].replace(to_replace = code_dict)
+        categories = pd.CategoricalDtype(list(dict.fromkeys(code_dict.values())))
+        self.df[colname] = self.df[colname].map(code_dict).astype(categories)
 
+    @rtd_profile.profiled(frame='df', label='new_column')
     def calculate_time(self, time_1, time_2, new_column):
         '''
-        Calculates the time in minutes between a timestamp and a string in the format %H:%M:%S
+        Calculates the time in minutes between a timestamp and a GTFS schedule time in the format %H:%M:%S.
+
+        GTFS times are measured from "noon minus 12 hours" on the service day and can run past 24:00:00 for 
+        trips that end after midnight, so the schedule time is converted to seconds and added to the start
+        of the service day (which also keeps wall-clock times right on DST transition days). The service day 
+        is whichever of the day before, the same day or the day after the timestamp gives the smallest 
+        difference. Everything is integer arithmetic on whole columns.
 
         Args:
-            time_1 (str): The name of the column with timestamp values to use for the first time
+            time_1 (str): The name of the column with tz-aware timestamp values to use for the first time
 
-            time_2 (str): The name of the column with string values in the format %H:%M:%S to use for the second time
+            time_2 (str): The name of the column with string values in the format %H:%M:%S (or integer seconds 
+                since the start of the service day) to use for the second time
 
             new_column (str): The name of the new column created from the difference in times
         '''
-        p = re.compile('00:\d{2}')
-        overnight = ((self.df[time_2].apply(lambda x: bool(p.match(x[0:5])))) & (self.df[time_1].apply(lambda x: x.hour) == 23))
-        self.df.loc[~overnight, 'day_date'] = (self.df[time_1].dt.to_period('D')).astype(str)
-        self.df.loc[overnight, 'day_date'] = (self.df[time_1].dt.to_period('D') + np.timedelta64(1,'D')).astype(str)
-        scheduled_timestamp = pd.to_datetime(self.df.day_date + ' ' + self.df[time_2])
-        time_diff = self.df[time_1].dt.tz_localize(None) - scheduled_timestamp.apply(lambda x: pd.Timestamp(x))
-        self.df[new_column] = time_diff.apply(lambda x: x.total_seconds()/60)
-
-    def calculate_distance(self, point_1_lat, point_1_lng, point_2_lat, point_2_lng, new_column):
+        observed = self.df[time_1]
+        scheduled_seconds = gtfs_time_to_seconds(self.df[time_2]).to_numpy(dtype='float64')
+
+        observed_utc = observed.dt.tz_convert('UTC').dt.tz_localize(None).to_numpy(dtype='datetime64[s]')
+        observed_seconds = observed_utc.astype('int64')
+
+        # Only a handful of distinct local dates, so find their service day starts once and broadcast them back
+        local_dates = observed.dt.tz_localize(None).dt.normalize()
+        date_codes, unique_dates = pd.factorize(local_dates)
+        candidates = []
+        for days in (-1, 0, 1):
+            noon = pd.DatetimeIndex(unique_dates) + pd.Timedelta(days=days, hours=12)
+            day_start = noon.tz_localize(observed.dt.tz) - pd.Timedelta(hours=12)
+            day_start_seconds = day_start.tz_convert('UTC').tz_localize(None).to_numpy(dtype='datetime64[s]').astype('int64')
+            candidates.append(observed_seconds - (day_start_seconds[date_codes] + scheduled_seconds))
+        candidates = np.stack(candidates)
+
+        closest = np.argmin(np.abs(np.where(np.isnan(candidates), np.inf, candidates)), axis=0)
+        time_diff = candidates[closest, np.arange(candidates.shape[1])]
+        time_diff[(date_codes < 0) | np.isnan(scheduled_seconds)] = np.nan
+        self.df[new_column] = time_diff / 60
+
+    @rtd_profile.profiled(frame='df', label='new_column')
+    def calculate_distance(self, point_1_lat, point_1_lng, point_2_lat, point_2_lng, new_column, method='geodesic'):
         '''
         Calculates the distance between two points in meters given their lat/lng
 
@@ -123,24 +424,49 @@ class RTD_df(object):
             point_2_lng (str): The name of the column with the second points longitudes
 
             new_column (str): The name of the new column created from the lat/lng points
-        '''
-        point_1 = list(zip(self.df[point_1_lat], self.df[point_1_lng]))
-        point_2 = list(zip(self.df[point_2_lat], self.df[point_2_lng]))
-        
-        self.df[new_column] = [round(geo.distance(point_1, point_2).m,2) if (~pd.isnull(point_2[0])) & (point_1[0] > 0) else np.nan for point_1, point_2 in zip(point_1, point_2)]
 
-    def clean_my_data(self):
+            method (str): How to calculate the distance. 'geodesic' calls geopy row by row, 'vincenty' is a 
+                vectorized ellipsoidal distance that matches geopy, and 'haversine' is a vectorized great-circle
+                distance. Default value is 'geodesic'.
+        '''
+        if method == 'geodesic':
+            import geopy.distance as geo
+            point_1 = list(zip(self.df[point_1_lat], self.df[point_1_lng]))
+            point_2 = list(zip(self.df[point_2_lat], self.df[point_2_lng]))
+            
+            self.df[new_column] = [round(geo.distance(point_1, point_2).m,2) if (~pd.isnull(point_2[0])) & (point_1[0] > 0) else np.nan for point_1, point_2 in zip(point_1, point_2)]
+            return
+
+        distance_functions = {'haversine': haversine_distance
+                             ,'vincenty': vincenty_distance}
+        if method not in distance_functions:
+            raise ValueError(f"method must be 'geodesic', 'vincenty' or 'haversine', not {method!r}")
+
+        lat_1 = self.df[point_1_lat].to_numpy(dtype='float64')
+        lng_1 = self.df[point_1_lng].to_numpy(dtype='float64')
+        lat_2 = self.df[point_2_lat].to_numpy(dtype='float64')
+        lng_2 = self.df[point_2_lng].to_numpy(dtype='float64')
+
+        # Same rows as the geodesic path: the second point must exist and the first must be a real position
+        valid = ~np.isnan(lat_2) & (lat_1 > 0)
+        distance = np.full(len(lat_1), np.nan)
+        distance[valid] = distance_functions[method](lat_1[valid], lng_1[valid], lat_2[valid], lng_2[valid])
+        self.df[new_column] = np.round(distance, 2)
+
+    @rtd_profile.profiled(frame='df')
+    def clean_my_data(self, distance_method='vincenty'):
         '''
         Runs the cleaning methods on an RTD_df class so that self.df returns a dataset ready for analysis. Cleaning
         functions include:
             1. convert_timezone_local()
             2. shift_departures()
-            3. join_txt_file()
+            3. GTFS_Static.join()
             4. parse_codes()
             5. calculate_time()
             5. calculate_distance()
 
-        Args: None
+        Args:
+            distance_method (str): The method calculate_distance() uses. Default value is 'vincenty'.
         '''
 
         # Remove any NaNs from the timestamp field
@@ -160,11 +486,13 @@ class RTD_df(object):
         self.df = self.df[~(self.df.stop_id == self.df.next_stop_id)]
         self.df = self.df[~self.df.next_stop_id.isnull()]
 
-        # Join the GTFS files for routes, trips, stops, and stop times
-        self.join_txt_file('~/Documents/dsi/repos/rtd_ontime_departure/data/google_transit/routes.txt', 'left', ['route_id'])
-        self.join_txt_file('~/Documents/dsi/repos/rtd_ontime_departure/data/google_transit/trips.txt', 'left', ['trip_id'])
-        self.join_txt_file('~/Documents/dsi/repos/rtd_ontime_departure/data/google_transit/stops.txt', 'left', ['stop_id'])
-        self.join_txt_file('~/Documents/dsi/repos/rtd_ontime_departure/data/google_transit/stop_times.txt', 'left', ['trip_id', 'stop_id'])
+        # Join the GTFS tables for routes, trips, stops, and stop times (parsed once per feed version). The
+        # schedule's direction_id is kept over the feed's optional one, so it is never missing on a scheduled trip.
+        gtfs = gtfs_static.GTFS_Static.load(self.gtfs_path)
+        self.df = gtfs.join(self.df, 'routes', ['route_type', 'route_long_name', 'route_short_name', 'route_desc'])
+        self.df = gtfs.join(self.df, 'trips', ['trip_headsign', 'direction_id'])
+        self.df = gtfs.join(self.df, 'stops', ['stop_name', 'stop_desc', 'stop_lat', 'stop_lon'])
+        self.df = gtfs.join(self.df, 'stop_times', ['arrival_time', 'departure_time'])
 
         # Remove NaNs from stop names because the stop.txt file is not 100% up to date
         # Remove any vehicle lat that <= 0.0 and any vehicle lng that is >= -104.8 (outside of RTD's service area)
@@ -177,6 +505,7 @@ class RTD_df(object):
                     ,'trip_id'
                     ,'trip_headsign'
                     ,'route_id'
+                    ,'direction_id_joined'
                     ,'route_type'
                     ,'route_long_name'
                     ,'route_short_name'
@@ -197,22 +526,21 @@ class RTD_df(object):
                     ,'departure_time']]
 
         # Convert the current_status and route_type values to their real-world counterparts
-        status_dict = {0: 'incoming_at'
-                    ,1: 'stopped_at'
-                    ,2: 'in_transit_to'}
-        route_dict = {0: 'light_rail'
-                    ,2: 'commuter_rail'
-                    ,3: 'bus'}
-        self.parse_codes('current_status', status_dict)
-        self.parse_codes('route_type', route_dict)
+        self.parse_codes('current_status', rtd_schema.STATUS_CODES)
+        self.parse_codes('route_type', rtd_schema.ROUTE_TYPE_CODES)
 
         # Rename the arrival columns to help differentiate them from departure columns
         self.df.rename({'timestamp': 'arrival_timestamp'
+                ,'direction_id_joined': 'direction_id'
                 ,'arrival_time': 'scheduled_arrival_time'
                 ,'departure_time': 'scheduled_departure_time'
                 ,'vehicle_lat': 'arrival_vehicle_lat'
                 ,'vehicle_lng': 'arrival_vehicle_lng'
                 ,'stop_lon': 'stop_lng'}, axis=1, inplace=True)
+
+        # Convert the scheduled times to integer seconds since the start of the service day
+        self.df['scheduled_arrival_time'] = gtfs_time_to_seconds(self.df.scheduled_arrival_time)
+        self.df['scheduled_departure_time'] = gtfs_time_to_seconds(self.df.scheduled_departure_time)
         
         # Remove any NaNs from departure times, or scheduled arrival/departure times
         self.df = self.df[(~self.df.departure_timestamp.isnull())
@@ -220,20 +548,175 @@ class RTD_df(object):
                         & (~self.df.scheduled_departure_time.isnull())
                     ]
 
-        # Fix errors in stop_times.txt where the scheduled arrival or departure time could have 24 or 25 in the hour spot
-        self.df = self.df.replace({'scheduled_arrival_time': {r'^24':'00'
-                                                             ,r'^25':'00'}
-                                  ,'scheduled_departure_time': {r'^24':'00'
-                                                               ,r'^25':'00'}
-                                  }, regex=True)
-
         # Calcuate the time between the arrival/departure timestamp and when the scheduled arrival/departure time was supposed to be
         self.calculate_time('arrival_timestamp', 'scheduled_arrival_time', 'minutes_to_arrival')
         self.calculate_time('departure_timestamp', 'scheduled_departure_time', 'minutes_since_departure')
 
         # Calculate the distance between the arrival/departure location and where the scheduled stop is located
-        self.calculate_distance('arrival_vehicle_lat', 'arrival_vehicle_lng', 'stop_lat', 'stop_lng', 'meters_to_arrival')
-        self.calculate_distance('departure_vehicle_lat', 'departure_vehicle_lng', 'stop_lat', 'stop_lng', 'meters_since_departure')
+        self.calculate_distance('arrival_vehicle_lat', 'arrival_vehicle_lng', 'stop_lat', 'stop_lng', 'meters_to_arrival', distance_method)
+        self.calculate_distance('departure_vehicle_lat', 'departure_vehicle_lng', 'stop_lat', 'stop_lng', 'meters_since_departure', distance_method)
+
+        # Categoricals for ids, codes and names, float32 coordinates and integer schedule times
+        self.df = rtd_schema.apply_schema(self.df, rtd_schema.CLEAN_DTYPES)
+
+    @rtd_profile.profiled(frame='df')
+    def clean_parallel(self, processes=None, n_shards=None, distance_method='vincenty'):
+        '''
+        Runs clean_my_data on shards of the raw data in a pool of forked worker processes. Rows are sharded by
+        trip and vehicle (see shard_rows), and every step after shift_departures works row by row, so each
+        shard cleans independently. The GTFS tables are loaded before the pool forks, so the workers share
+        them read-only. The shards are put back in the order clean_my_data returns, so self.df is the same
+        as after clean_my_data.
+
+        Args:
+            processes (int): Number of worker processes. Default value is None, which uses one per core.
+            n_shards (int): Number of shards. Default value is None, which uses one per process.
+            distance_method (str): The method calculate_distance() uses. Default value is 'vincenty'.
+        '''
+        processes = processes or os.cpu_count()
+        n_shards = n_shards or processes
+
+        labels = self.df.index
+        df = self.df.reset_index(drop=True)
+        gtfs_static.GTFS_Static.load(self.gtfs_path).build_join_indexes()
+
+        _shard_input['df'] = df
+        _shard_input['shards'] = shard_rows(df, n_shards)
+        _shard_input['gtfs_path'] = self.gtfs_path
+        try:
+            if processes == 1:
+                cleaned = [_clean_shard(shard, distance_method) for shard in range(n_shards)]
+            else:
+                # Fork so the workers inherit _shard_input and the loaded GTFS tables without pickling them
+                with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('fork')) as pool:
+                    cleaned = list(pool.map(_clean_shard, range(n_shards), [distance_method] * n_shards))
+        finally:
+            _shard_input.clear()
+
+        # clean_my_data keeps its rows sorted by vehicle_id and timestamp, ties in their raw order. The
+        # categories of each shard differ, so the schema is applied again to the combined rows.
+        cleaned = pd.concat([shard_df for _, shard_df in sorted(cleaned, key=lambda item: item[0])])
+        cleaned = cleaned.sort_index(kind='stable')
+        cleaned = cleaned.sort_values(['vehicle_id', 'arrival_timestamp'], kind='stable')
+        cleaned.index = labels[cleaned.index]
+        self.df = rtd_schema.apply_schema(cleaned.astype({col: object for col, dtype in cleaned.dtypes.items()
+                                                          if isinstance(dtype, pd.CategoricalDtype)})
+                                         ,rtd_schema.CLEAN_DTYPES)
+
+    def memory_report(self):
+        '''
+        Reports the memory used by each column of self.df, counting the contents of strings and categories.
+
+        Args: None
+
+        Returns:
+            report (pd.DataFrame): dtype, bytes and bytes per row of each column plus a 'total' row.
+        '''
+        return rtd_schema.memory_report(self.df)
+
+    @rtd_profile.profiled(frame='df')
+    def clean_incremental(self, state_path, output_root, open_trip_hours=6, distance_method='vincenty'):
+        '''
+        Cleans only the raw rows in self.df that arrived since the last call and appends them to the cleaned
+        Parquet dataset at output_root, so re-analysis after each new day costs proportional to that day. 
+        
+        The state file keeps a per-vehicle watermark of the last timestamp processed (vehicle clocks lag 
+        each other, so a single global watermark would drop late reports) and the last raw row of every 
+        trip that was still open. Those rows have no departure yet, so they are carried into the next call
+        where shift_departures() can find their departure. After the call self.df holds the newly cleaned rows.
+        A call interrupted before it saved the state can simply be repeated: it rewrites the same files.
+
+        Args:
+            state_path (str): Filepath of the pickled state, created on the first call.
+            output_root (str): Local directory or s3:// uri of the cleaned Parquet dataset.
+            open_trip_hours (float): Trips with no report for this many hours are considered finished and are
+                no longer carried over. Default value is 6.
+            distance_method (str): The method calculate_distance() uses. Default value is 'vincenty'.
+
+        Returns:
+            rows_added (int): The number of cleaned rows appended to output_root.
+        '''
+        try:
+            state = pd.read_pickle(state_path)
+        except FileNotFoundError:
+            state = {'watermarks': pd.Series(dtype='float64'), 'open_trips': None}
+
+        raw = self.df[~self.df.timestamp.isnull()]
+        last_seen = raw.vehicle_id.map(state['watermarks'])
+        raw = raw[last_seen.isnull() | (raw.timestamp > last_seen)]
+        if raw.shape[0] == 0:
+            self.df = raw
+            return 0
+
+        watermarks = pd.concat([state['watermarks'], raw.groupby('vehicle_id').timestamp.max()])
+        watermarks = watermarks.groupby(level=0).max()
+
+        combined = pd.concat([state['open_trips'], raw], ignore_index=True)
+        open_trips = combined.sort_values(['vehicle_id', 'timestamp']).groupby(['trip_id', 'vehicle_label']).tail(1)
+        open_trips = open_trips[open_trips.timestamp >= raw.timestamp.max() - open_trip_hours * 3600]
+
+        self.df = combined
+        self.clean_my_data(distance_method)
+
+        # The files are named after the new watermarks, which only depend on the state and the raw rows, so
+        # if the process dies before the state is saved, the call is repeated with the same rows and
+        # overwrites the files it wrote instead of appending them twice
+        if self.df.shape[0] > 0:
+            rtd_storage.write_partitioned(rtd_storage.add_service_date(self.df, 'arrival_timestamp'), output_root
+                                         ,basename=rtd_cache.frame_version(watermarks.to_frame()))
+
+        # Written to a temporary file and moved into place, so a crash never leaves a partial state
+        pd.to_pickle({'watermarks': watermarks, 'open_trips': open_trips}, f"{state_path}.tmp")
+        os.replace(f"{state_path}.tmp", state_path)
+        return self.df.shape[0]
+
+    @classmethod
+    @rtd_profile.profiled()
+    def clean_out_of_core(cls, root, output_root, state_path, start_date=None, end_date=None, chunk_hours=24
+                         ,open_trip_hours=6, distance_method='vincenty'):
+        '''
+        Cleans a raw Parquet dataset larger than memory by reading it in time-ordered chunks and passing each
+        one through clean_incremental, so only one chunk, its cleaned rows and the state are in memory at a
+        time. The state carries the last report of every trip still open at the end of a chunk into the
+        next one, so trips crossing chunk boundaries keep their departures, and the cleaned rows are appended
+        to the partitioned dataset at output_root as each chunk finishes. Chunks that were already cleaned
+        are skipped by the state's watermarks, so an interrupted run can be restarted with the same state_path.
+
+        Args:
+            root (str): Local directory or s3:// uri of the raw dataset written by pull_rtd_data.py.
+            output_root (str): Local directory or s3:// uri of the cleaned Parquet dataset.
+            state_path (str): Filepath of the pickled clean_incremental state, created on the first chunk.
+            start_date (str): First service date to clean ('YYYY-MM-DD'), inclusive. Default value is None.
+            end_date (str): Last service date to clean ('YYYY-MM-DD'), inclusive. Default value is None.
+            chunk_hours (float): Hours of feed time per chunk, at most one service date. Lower it to lower
+                peak memory. Default value is 24.
+            open_trip_hours (float): See clean_incremental. Default value is 6.
+            distance_method (str): The method calculate_distance() uses. Default value is 'vincenty'.
+
+        Returns:
+            rows_added (int): The number of cleaned rows appended to output_root.
+        '''
+        rows_added = 0
+        for service_date in rtd_storage.list_partitions(root):
+            if ((start_date is not None) and (service_date < start_date)) or ((end_date is not None) and (service_date > end_date)):
+                continue
+
+            day_start, day_end = rtd_storage.service_day_bounds(service_date)
+            chunk_starts = list(range(day_start, day_end, max(1, int(chunk_hours * 3600))))
+            for idx, chunk_start in enumerate(chunk_starts):
+                # The first and last chunks are open-ended, so no row of the partition falls outside them
+                chunk_filter = None
+                if idx > 0:
+                    chunk_filter = ds.field('timestamp') >= chunk_start
+                if idx < len(chunk_starts) - 1:
+                    chunk_filter = rtd_storage.and_filters(chunk_filter, ds.field('timestamp') < chunk_starts[idx + 1])
+
+                rtd_data = cls.from_parquet(root, start_date=service_date, end_date=service_date, filters=chunk_filter)
+                rows_added += rtd_data.clean_incremental(state_path, output_root, open_trip_hours, distance_method)
+                print(f"{service_date} chunk {idx + 1}/{len(chunk_starts)} cleaned: {rows_added} rows so far")
+                del rtd_data
+
+        return rows_added
 
 if __name__ == '__main__':
 
@@ -0,0 +1,282 @@
+#!/opt/anaconda3/bin/python3
+
+import os
+import io
+import glob
+import hashlib
+import zipfile
+import pandas as pd
+import rtd_cache
+import rtd_profile
+
+# Columns read from each GTFS static file, their dtypes and the key each table is indexed by. GTFS ids are
+# strings, so every id is read as one and the realtime data is normalized to match before joining.
+GTFS_TABLES = {'routes': {'index': ['route_id']
+                         ,'dtypes': {'route_id': str
+                                    ,'route_type': 'int8'
+                                    ,'route_long_name': str
+                                    ,'route_short_name': str
+                                    ,'route_desc': str}}
+              ,'trips': {'index': ['trip_id']
+                        ,'dtypes': {'trip_id': str
+                                   ,'route_id': str
+                                   ,'service_id': str
+                                   ,'direction_id': 'int8'
+                                   ,'trip_headsign': str}}
+              ,'stops': {'index': ['stop_id']
+                        ,'dtypes': {'stop_id': str
+                                   ,'stop_name': str
+                                   ,'stop_desc': str
+                                   ,'stop_lat': 'float64'
+                                   ,'stop_lon': 'float64'}}
+              ,'stop_times': {'index': ['trip_id', 'stop_id']
+                             ,'dtypes': {'trip_id': str
+                                        ,'stop_id': str
+                                        ,'stop_sequence': 'int32'
+                                        ,'arrival_time': str
+                                        ,'departure_time': str}}}
+
+def normalize_ids(ids):
+    '''
+    Converts a column of ids to strings the way GTFS writes them, e.g. 113621307.0 (an id read from a csv
+    with missing values) becomes '113621307'.
+
+    Args:
+        ids (pd.Series): Column of ids of any dtype.
+
+    Returns:
+        ids (pd.Series): The ids as strings, with NaN where the id was missing.
+    '''
+    if pd.api.types.is_numeric_dtype(ids):
+        ids = ids.astype('Int64')
+    strings = ids.astype(str)
+    return strings.where(ids.notnull())
+
+def stat_signature(filepaths):
+    '''
+    The name, size and modification time of files, which change whenever one of the files is replaced or
+    rewritten, so a hash of their contents can be reused until then.
+
+    Args:
+        filepaths (list): Paths of the files.
+
+    Returns:
+        signature (tuple): One (name, size, mtime in ns) tuple per file.
+    '''
+    signature = []
+    for filepath in filepaths:
+        stat = os.stat(filepath)
+        signature.append((os.path.basename(filepath), stat.st_size, stat.st_mtime_ns))
+    return tuple(signature)
+
+class GTFS_Static(object):
+
+    # Stores already loaded in this process, keyed by feed version
+    _loaded = {}
+
+    # Feed versions already hashed in this process: gtfs_path -> (stat signature of its files, version)
+    _versions = {}
+
+    def __init__(self, gtfs_path, cache_dir=None):
+        '''
+        Parses a GTFS static feed once and keeps its tables indexed by their keys so joins are index lookups.
+        The parsed tables are persisted as Parquet in cache_dir/<feed version>/, so later runs skip parsing
+        the text files entirely until the feed changes.
+
+        Args:
+            gtfs_path (str): Directory of GTFS .txt files or the GTFS .zip.
+            cache_dir (str): Directory for the parsed tables. Default value is a .gtfs_cache directory next to
+                gtfs_path.
+        '''
+        self.gtfs_path = os.path.expanduser(gtfs_path)
+        if cache_dir is None:
+            cache_dir = os.path.join(os.path.dirname(os.path.abspath(self.gtfs_path)), '.gtfs_cache')
+        self.version = self.feed_version()
+        self.cache_dir = os.path.join(os.path.expanduser(cache_dir), self.version)
+
+        for table, spec in GTFS_TABLES.items():
+            setattr(self, table, self._load_table(table).set_index(spec['index']).sort_index())
+
+    @classmethod
+    def load(cls, gtfs_path, cache_dir=None):
+        '''
+        Returns the GTFS_Static for gtfs_path, reusing the one already loaded in this process when the feed
+        version has not changed.
+
+        Args:
+            gtfs_path (str): Directory of GTFS .txt files or the GTFS .zip.
+            cache_dir (str): Directory for the parsed tables. Default value is None (see __init__).
+
+        Returns:
+            gtfs (GTFS_Static): The loaded feed.
+        '''
+        version = cls.feed_version_of(gtfs_path)
+        if version not in cls._loaded:
+            cls._loaded[version] = cls(gtfs_path, cache_dir)
+        return cls._loaded[version]
+
+    @classmethod
+    def feed_version_of(cls, gtfs_path):
+        '''
+        The version of the feed at gtfs_path (see feed_version), without parsing or loading its tables.
+
+        Args:
+            gtfs_path (str): Directory of GTFS .txt files or the GTFS .zip.
+
+        Returns:
+            version (str): Hex digest identifying the feed.
+        '''
+        store = cls.__new__(cls)
+        store.gtfs_path = os.path.expanduser(gtfs_path)
+        return store.feed_version()
+
+    def _files(self):
+        '''
+        Returns the names of the .txt files in the feed.
+        '''
+        if zipfile.is_zipfile(self.gtfs_path):
+            with zipfile.ZipFile(self.gtfs_path) as z:
+                return sorted(name for name in z.namelist() if name.endswith('.txt'))
+        return sorted(name for name in os.listdir(self.gtfs_path) if name.endswith('.txt'))
+
+    def _open(self, name):
+        '''
+        Opens one of the feed's .txt files for reading in binary mode.
+        '''
+        if zipfile.is_zipfile(self.gtfs_path):
+            with zipfile.ZipFile(self.gtfs_path) as z:
+                return io.BytesIO(z.read(name))
+        return open(os.path.join(self.gtfs_path, name), 'rb')
+
+    def feed_version(self):
+        '''
+        Hashes the contents of the feed's files, so any change to the feed gives it a new version. The hash
+        is kept for the rest of the process and only recomputed when the name, size or modification time of
+        one of the files changes, so loading an unchanged feed again does not re-read it.
+
+        Args: None
+
+        Returns:
+            version (str): Hex digest identifying the feed.
+        '''
+        if zipfile.is_zipfile(self.gtfs_path):
+            files = [self.gtfs_path]
+        else:
+            files = [os.path.join(self.gtfs_path, name) for name in self._files()]
+        signature = stat_signature(files)
+        cached = GTFS_Static._versions.get(os.path.abspath(self.gtfs_path))
+        if (cached is not None) and (cached[0] == signature):
+            return cached[1]
+
+        digest = hashlib.sha1()
+        for filepath in files:
+            digest.update(os.path.basename(filepath).encode())
+            with open(filepath, 'rb') as f:
+                for block in iter(lambda: f.read(1024**2), b''):
+                    digest.update(block)
+        version = digest.hexdigest()[:16]
+        GTFS_Static._versions[os.path.abspath(self.gtfs_path)] = (signature, version)
+        return version
+
+    def _load_table(self, table):
+        '''
+        Reads a table from the Parquet cache, or parses the .txt file with GTFS_TABLES dtypes and caches it.
+        '''
+        cache_file = os.path.join(self.cache_dir, f"{table}.parquet")
+        if os.path.exists(cache_file):
+            return pd.read_parquet(cache_file)
+
+        dtypes = GTFS_TABLES[table]['dtypes']
+        with self._open(f"{table}.txt") as f:
+            df = pd.read_csv(f, usecols=lambda col: col in dtypes, dtype=dtypes)
+        for col in GTFS_TABLES[table]['index']:
+            df[col] = df[col].str.strip()
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        df.to_parquet(cache_file, index=False)
+        return df
+
+    def stop_neighborhoods(self, shapes_path, id_column='NBHD_ID'):
+        '''
+        Indexes which polygon of a shapefile (e.g. Denver's statistical neighborhoods) every stop falls in, so
+        aggregating by neighborhood is an integer join instead of a spatial join of every observation. Stops
+        are matched once with an STRtree and the index is cached with the parsed tables, so it is rebuilt only
+        when the feed or the shapefile changes.
+
+        Args:
+            shapes_path (str): Path of the polygon shapefile.
+            id_column (str): Column of the shapefile identifying each polygon. Default value is 'NBHD_ID'.
+
+        Returns:
+            stop_neighborhoods (pd.Series): The id_column of each stop's polygon indexed by stop_id. Stops
+                outside every polygon are left out.
+        '''
+        import shapely
+        import geopandas as gpd
+
+        shapes_path = os.path.expanduser(shapes_path)
+        # The polygons are in the .shp but id_column is in the .dbf, so every file of the shapefile is versioned
+        shapes_stem = os.path.splitext(shapes_path)[0]
+        shapes_version = rtd_cache.file_version(glob.glob(f"{glob.escape(shapes_stem)}.*"))[:8]
+        cache_file = os.path.join(self.cache_dir, f"stop_{id_column.lower()}_{shapes_version}.parquet")
+        if os.path.exists(cache_file):
+            return pd.read_parquet(cache_file)[id_column]
+
+        shapes = gpd.read_file(shapes_path)
+        points = gpd.points_from_xy(self.stops.stop_lon, self.stops.stop_lat, crs='EPSG:4326').to_crs(shapes.crs)
+        stop_idx, shape_idx = shapely.STRtree(shapes.geometry.values).query(points, predicate='intersects')
+
+        # intersects (unlike within) keeps stops on a border, which match every polygon sharing it; such a stop
+        # is assigned to the first of them in the shapefile
+        first = pd.Series(shape_idx, index=stop_idx).groupby(level=0).min()
+        stop_neighborhoods = pd.Series(shapes[id_column].to_numpy()[first.to_numpy()]
+                                      ,index=self.stops.index[first.index]
+                                      ,name=id_column)
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        stop_neighborhoods.to_frame().to_parquet(cache_file)
+        return stop_neighborhoods
+
+    def build_join_indexes(self):
+        '''
+        Builds the hash table of every table's index up front instead of on the first join of each table,
+        so worker processes forked afterwards share the hash tables instead of each building its own.
+
+        Args: None
+        '''
+        for table in GTFS_TABLES:
+            index = getattr(self, table).index
+            if index.is_unique:
+                index.get_indexer(index[:1])
+
+    @rtd_profile.profiled(label='table')
+    def join(self, df, table, columns=None):
+        '''
+        Left joins columns of a GTFS table onto df by looking up the table's index with df's key columns.
+        Columns that df already has are suffixed with '_joined', like RTD_df.join_txt_file.
+
+        Args:
+            df (pd.DataFrame): DataFrame with the table's key column(s), e.g. trip_id and stop_id for stop_times.
+            table (str): 'routes', 'trips', 'stops' or 'stop_times'.
+            columns (list): Columns of the table to join. Default value is None, which joins every column.
+
+        Returns:
+            df (pd.DataFrame): df with the table's columns added.
+        '''
+        lookup = getattr(self, table)
+        if columns is not None:
+            lookup = lookup[columns]
+        keys = GTFS_TABLES[table]['index']
+        df = df.assign(**{key: normalize_ids(df[key]) for key in keys})
+        if not lookup.index.is_unique:
+            return df.join(lookup, on=keys, how='left', rsuffix='_joined')
+
+        # Looking the keys up in the table's index reuses its hash table, which DataFrame.join rebuilds on
+        # every call, so joining a small frame (e.g. one live snapshot) costs milliseconds
+        if len(keys) > 1:
+            key_index = pd.MultiIndex.from_arrays([df[key] for key in keys])
+        else:
+            key_index = pd.Index(df[keys[0]])
+        joined = lookup.reindex(key_index).set_axis(df.index, axis=0)
+        joined.columns = [f"{col}_joined" if col in df.columns else col for col in joined.columns]
+        return pd.concat([df, joined], axis=1)
@@ -1,25 +1,46 @@
 #!/opt/anaconda3/bin/python3
 
 from rtd_feed import RTD_Feed
-import pandas as pd
+from rtd_archive import RTD_Archive, feed_content
+import os
+import json
 from datetime import datetime
 
 if __name__ == '__main__':
 
     vehicle_position_url = 'https://www.rtd-denver.com/files/gtfs-rt/VehiclePosition.pb'
 
-    rtd_feed_data = RTD_Feed(vehicle_position_url)
-    rtd_df = rtd_feed_data.parse_to_df()
-
-    filepath = '~/Documents/dsi/repos/rtd_on_time_departure/data/rtd_data.csv'
+    dataset_root = os.path.expanduser('~/Documents/dsi/repos/rtd_on_time_departure/data/rtd_data')
+    archive_root = '~/Documents/dsi/repos/rtd_on_time_departure/data/raw_archive'
+    state_filepath = os.path.expanduser('~/Documents/dsi/repos/rtd_on_time_departure/data/rtd_feed_state.json')
     today_date = datetime.today()
     update_string = today_date.strftime('%Y-%m-%d %H:%M:%S')
 
+    # Validators of the last ingested snapshot so unchanged feeds are neither downloaded nor appended again
     try:
-        rtd_df.to_csv(filepath, mode='a', header=False, index=False)
-        print(f"Feed Updated at: {update_string}. {rtd_df.shape[0]} rows added.")
-    except:
-        print('Somthing went wrong...')   
-    
+        with open(state_filepath) as f:
+            feed_state = json.load(f)
+    except (OSError, ValueError):
+        feed_state = {}
+
+    rtd_feed_data = RTD_Feed(vehicle_position_url, **feed_state)
+
+    if not rtd_feed_data.updated:
+        print(f"Feed Unchanged at: {update_string}. 0 rows added.")
+    else:
+        # Imported only once the feed has changed, so an unchanged poll never loads pandas or pyarrow
+        import rtd_storage
+        rtd_df = rtd_feed_data.parse_to_df()
+
+        try:
+            # The raw snapshot is archived too, so the dataset can be rebuilt if the parsed columns change
+            RTD_Archive(archive_root).append(feed_content(rtd_feed_data), rtd_feed_data.feed.header.timestamp)
+            rtd_storage.write_partitioned(rtd_df, dataset_root)
+            with open(state_filepath, 'w') as f:
+                json.dump(rtd_feed_data.conditional_state(), f)
+            print(f"Feed Updated at: {update_string}. {rtd_df.shape[0]} rows added.")
+        except:
+            print('Somthing went wrong...')
+
 # Crontab
-# */2 * 10-22 2 * cd ~/Documents/dsi/repos/rtd_on_time_departure/src && /opt/anaconda3/bin/python3 pull_rtd_data.py >> ~/Documents/dsi/repos/rtd_on_time_departure/cron_files/pull_cron.rtf 2>&1
\ No newline at end of file
+# */2 * 10-22 2 * cd ~/Documents/dsi/repos/rtd_on_time_departure/src && /opt/anaconda3/bin/python3 pull_rtd_data.py >> ~/Documents/dsi/repos/rtd_on_time_departure/cron_files/pull_cron.rtf 2>&1
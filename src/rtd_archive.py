@@ -0,0 +1,319 @@
+#!/opt/anaconda3/bin/python3
+
+import os
+import time
+import zlib
+import struct
+from datetime import datetime, timezone
+from rtd_feed import RTD_Feed, parse_header
+
+# One index entry per archived snapshot: the feed header timestamp, and the offset and length of the
+# compressed FeedMessage in the segment file. Entries are written with struct, so archiving a snapshot never
+# imports numpy or pandas; readers load the index as a numpy array of index_dtype().
+INDEX_FORMAT = '<qQI'
+INDEX_FIELDS = ['timestamp', 'offset', 'length']
+
+def index_dtype():
+    '''
+    The numpy dtype of an index entry, matching INDEX_FORMAT.
+    '''
+    import numpy as np
+    return np.dtype(list(zip(INDEX_FIELDS, ['<i8', '<u8', '<u4'])))
+
+def encode_varint(value):
+    '''
+    Encodes a non-negative integer as a protobuf base 128 varint.
+
+    Args:
+        value (int): The integer to encode.
+
+    Returns:
+        varint (bytes): The encoded integer.
+    '''
+    varint = bytearray()
+    while value > 0x7f:
+        varint.append((value & 0x7f) | 0x80)
+        value >>= 7
+    varint.append(value)
+    return bytes(varint)
+
+def decode_varint(buffer, pos):
+    '''
+    Decodes a protobuf base 128 varint.
+
+    Args:
+        buffer (bytes): The bytes holding the varint.
+        pos (int): Position of the first byte of the varint.
+
+    Returns:
+        value (int): The decoded integer.
+        pos (int): Position of the first byte after the varint.
+    '''
+    value, shift = 0, 0
+    while True:
+        if pos >= len(buffer):
+            raise EOFError('Truncated varint')
+        byte = buffer[pos]
+        value |= (byte & 0x7f) << shift
+        pos += 1
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+def scan_segment(filepath):
+    '''
+    Reads every complete record of a segment file without its index, e.g. to rebuild a lost index. A
+    record cut short by a crash mid-write ends the scan.
+
+    Args:
+        filepath (str): Path of the .seg file.
+
+    Returns:
+        index (np.ndarray): One index_dtype() entry per complete record, in file order.
+    '''
+    import numpy as np
+    with open(filepath, 'rb') as f:
+        buffer = f.read()
+
+    entries = []
+    pos = 0
+    while pos < len(buffer):
+        try:
+            length, start = decode_varint(buffer, pos)
+        except EOFError:
+            break
+        if start + length > len(buffer):
+            break
+        header = parse_header(zlib.decompress(buffer[start:start + length]))
+        entries.append((header.timestamp, start, length))
+        pos = start + length
+
+    return np.array(entries, dtype=index_dtype())
+
+def feed_content(rtd_feed):
+    '''
+    The serialized FeedMessage of a snapshot, exactly as it was downloaded when it came from a request.
+
+    Args:
+        rtd_feed (RTD_Feed): The snapshot.
+
+    Returns:
+        content (bytes): The serialized FeedMessage.
+    '''
+    if rtd_feed.response is not None:
+        return rtd_feed.response.content
+    return rtd_feed.feed.SerializeToString()
+
+class RTD_Archive(object):
+
+    def __init__(self, root, feed_name='vehicle_position', compression_level=6):
+        '''
+        Archive of raw GTFS-realtime snapshots, so the parsed columns can be changed and the data rebuilt
+        (or a live load reproduced) without collecting it again. Snapshots are stored as length-delimited
+        records (a varint length followed by the zlib-compressed FeedMessage) in one segment file per UTC
+        hour of feed time, e.g. root/vehicle_position/2021-02-09/05.seg. Each segment has an index
+        (05.idx) of the feed timestamp, offset and length of every record, so a time range is read by
+        seeking straight to its records.
+
+        Args:
+            root (str): Directory of the archive.
+            feed_name (str): Name of the feed, one archive directory per feed. Default value is
+                'vehicle_position'.
+            compression_level (int): zlib compression level of each record. Default value is 6.
+        '''
+        self.root = os.path.expanduser(root)
+        self.feed_name = feed_name
+        self.compression_level = compression_level
+        self.feed_dir = os.path.join(self.root, feed_name)
+
+    def _segment(self, timestamp):
+        hour = datetime.fromtimestamp(timestamp, tz=timezone.utc)
+        return os.path.join(self.feed_dir, hour.strftime('%Y-%m-%d'), hour.strftime('%H'))
+
+    def append(self, content, timestamp=None):
+        '''
+        Archives one snapshot in the segment of its feed hour.
+
+        Args:
+            content (bytes): The serialized FeedMessage.
+            timestamp (int): Feed header timestamp of the snapshot. Default value is None, which parses it
+                from the header.
+
+        Returns:
+            segment (str): Path of the segment file the snapshot was written to.
+        '''
+        if timestamp is None:
+            timestamp = parse_header(content).timestamp
+        record = zlib.compress(content, self.compression_level)
+
+        segment = self._segment(timestamp)
+        os.makedirs(os.path.dirname(segment), exist_ok=True)
+        with open(f"{segment}.seg", 'ab') as f:
+            f.write(encode_varint(len(record)))
+            offset = f.tell()
+            f.write(record)
+        # The index entry is written after its record, so the index never points at a partial record
+        with open(f"{segment}.idx", 'ab') as f:
+            f.write(struct.pack(INDEX_FORMAT, timestamp, offset, len(record)))
+        return f"{segment}.seg"
+
+    def handler(self):
+        '''
+        Creates an RTD_Collector handler that archives every new snapshot.
+
+        Args: None
+
+        Returns:
+            handler (callable): A handler to pass to RTD_Collector.
+        '''
+        def handler(name, rtd_feed):
+            self.append(feed_content(rtd_feed), rtd_feed.feed.header.timestamp)
+
+        return handler
+
+    def segments(self, start=None, end=None):
+        '''
+        Lists the segments that can hold snapshots between start and end, in time order.
+
+        Args:
+            start (int): First feed timestamp (POSIX seconds), inclusive. Default value is None.
+            end (int): Last feed timestamp (POSIX seconds), inclusive. Default value is None.
+
+        Returns:
+            segments (list): Paths of the segments without their .seg/.idx extension.
+        '''
+        first = None if start is None else self._segment(start)
+        last = None if end is None else self._segment(end)
+        segments = []
+        if not os.path.isdir(self.feed_dir):
+            return segments
+        for date in sorted(os.listdir(self.feed_dir)):
+            date_dir = os.path.join(self.feed_dir, date)
+            for name in sorted(os.listdir(date_dir)):
+                if not name.endswith('.seg'):
+                    continue
+                segment = os.path.join(date_dir, name[:-4])
+                if ((first is None) or (segment >= first)) and ((last is None) or (segment <= last)):
+                    segments.append(segment)
+        return segments
+
+    def index(self, segment):
+        '''
+        Loads the index of a segment, rebuilding it from the segment file if it is missing.
+
+        Args:
+            segment (str): Path of the segment without its extension.
+
+        Returns:
+            index (np.ndarray): One index_dtype() entry per record.
+        '''
+        import numpy as np
+        dtype = index_dtype()
+        if not os.path.exists(f"{segment}.idx"):
+            index = scan_segment(f"{segment}.seg")
+            index.tofile(f"{segment}.idx")
+            return index
+        # A crash between writing the two files can leave a partial trailing entry
+        with open(f"{segment}.idx", 'rb') as f:
+            buffer = f.read()
+        return np.frombuffer(buffer[:len(buffer) - len(buffer) % dtype.itemsize], dtype=dtype)
+
+    def timestamps(self, start=None, end=None):
+        '''
+        Feed timestamps of the archived snapshots between start and end, read from the indexes only.
+
+        Args:
+            start (int): First feed timestamp (POSIX seconds), inclusive. Default value is None.
+            end (int): Last feed timestamp (POSIX seconds), inclusive. Default value is None.
+
+        Returns:
+            timestamps (np.ndarray): The sorted feed timestamps.
+        '''
+        import numpy as np
+        timestamps = [self.index(segment)['timestamp'] for segment in self.segments(start, end)]
+        timestamps = np.sort(np.concatenate(timestamps)) if timestamps else np.array([], dtype='int64')
+        lower = np.searchsorted(timestamps, start, 'left') if start is not None else 0
+        upper = np.searchsorted(timestamps, end, 'right') if end is not None else len(timestamps)
+        return timestamps[lower:upper]
+
+    def read(self, start=None, end=None):
+        '''
+        Reads the archived snapshots between start and end in feed order.
+
+        Args:
+            start (int): First feed timestamp (POSIX seconds), inclusive. Default value is None.
+            end (int): Last feed timestamp (POSIX seconds), inclusive. Default value is None.
+
+        Yields:
+            timestamp (int): Feed header timestamp of the snapshot.
+            content (bytes): The serialized FeedMessage.
+        '''
+        import numpy as np
+        for segment in self.segments(start, end):
+            index = np.sort(self.index(segment), order='timestamp', kind='stable')
+            if start is not None:
+                index = index[index['timestamp'] >= start]
+            if end is not None:
+                index = index[index['timestamp'] <= end]
+            if not len(index):
+                continue
+
+            with open(f"{segment}.seg", 'rb') as f:
+                for timestamp, offset, length in index.tolist():
+                    f.seek(offset)
+                    yield timestamp, zlib.decompress(f.read(length))
+
+    def replay(self, start=None, end=None, speed=None):
+        '''
+        Feeds the archived snapshots between start and end back through RTD_Feed in feed order, as fast as
+        they can be read or paced to reproduce the collector's load.
+
+        Args:
+            start (int): First feed timestamp (POSIX seconds), inclusive. Default value is None.
+            end (int): Last feed timestamp (POSIX seconds), inclusive. Default value is None.
+            speed (float): Multiple of real time to replay at, e.g. 10 plays an hour of snapshots in 6
+                minutes. Default value is None, which does not wait between snapshots.
+
+        Yields:
+            rtd_feed (RTD_Feed): Each snapshot, as RTD_Feed.from_content returns it.
+        '''
+        first_timestamp, replay_start = None, time.perf_counter()
+        for timestamp, content in self.read(start, end):
+            if speed is not None:
+                if first_timestamp is None:
+                    first_timestamp = timestamp
+                delay = (timestamp - first_timestamp) / speed - (time.perf_counter() - replay_start)
+                if delay > 0:
+                    time.sleep(delay)
+            yield RTD_Feed.from_content(content)
+
+    def read_df(self, start=None, end=None):
+        '''
+        Parses the archived snapshots between start and end into one DataFrame, e.g. to rebuild the
+        rtd_data dataset after changing the parsed columns.
+
+        Args:
+            start (int): First feed timestamp (POSIX seconds), inclusive. Default value is None.
+            end (int): Last feed timestamp (POSIX seconds), inclusive. Default value is None.
+
+        Returns:
+            rtd_df (pd.DataFrame): The rows of every snapshot, as RTD_Feed.parse_to_df returns them.
+        '''
+        import pandas as pd
+        frames = [rtd_feed.parse_to_df() for rtd_feed in self.replay(start, end)]
+        if not frames:
+            return pd.DataFrame()
+        return pd.concat(frames, ignore_index=True)
+
+if __name__ == '__main__':
+
+    archive_root = '~/Documents/dsi/repos/rtd_on_time_departure/data/raw_archive'
+    dataset_root = '~/Documents/dsi/repos/rtd_on_time_departure/data/rtd_data_rebuilt'
+
+    # Rebuild the parsed dataset from the raw archive, one segment at a time
+    import rtd_storage
+    archive = RTD_Archive(archive_root)
+    for segment in archive.segments():
+        timestamps = archive.index(segment)['timestamp']
+        rtd_storage.write_partitioned(archive.read_df(int(timestamps.min()), int(timestamps.max())), dataset_root)
+        print(f"{segment} rebuilt: {len(timestamps)} snapshots")
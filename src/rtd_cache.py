@@ -0,0 +1,164 @@
+#!/opt/anaconda3/bin/python3
+
+import os
+import json
+import uuid
+import shutil
+import hashlib
+import pandas as pd
+
+def frame_version(df):
+    '''
+    Hashes the contents, column names and dtypes of a DataFrame, so any change to the data gives it a new
+    version.
+
+    Args:
+        df (pd.DataFrame): The DataFrame to hash.
+
+    Returns:
+        version (str): Hex digest identifying the data.
+    '''
+    digest = hashlib.sha1()
+    digest.update(json.dumps([[str(col), str(dtype)] for col, dtype in df.dtypes.items()]).encode())
+    digest.update(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+    return digest.hexdigest()[:16]
+
+def code_version(modules):
+    '''
+    Hashes the source files of modules, so editing any of them gives the code a new version.
+
+    Args:
+        modules (list): Imported modules whose code the cached outputs depend on.
+
+    Returns:
+        version (str): Hex digest identifying the code.
+    '''
+    digest = hashlib.sha1()
+    for module in sorted(modules, key=lambda module: module.__name__):
+        digest.update(module.__name__.encode())
+        with open(module.__file__, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+def file_version(filepaths):
+    '''
+    Hashes the names and contents of files, e.g. a shapefile and its sidecar files, so replacing any of them
+    gives the files a new version.
+
+    Args:
+        filepaths (list): Paths of the files.
+
+    Returns:
+        version (str): Hex digest identifying the files.
+    '''
+    digest = hashlib.sha1()
+    for filepath in sorted(filepaths):
+        digest.update(os.path.basename(filepath).encode())
+        with open(filepath, 'rb') as f:
+            for block in iter(lambda: f.read(1024**2), b''):
+                digest.update(block)
+    return digest.hexdigest()[:16]
+
+class Artifact_Cache(object):
+
+    def __init__(self, cache_dir, max_bytes=1024**3):
+        '''
+        Content-addressed cache of output files (figures, maps and tables). Each entry is keyed on a hash of
+        everything that produced it, so an entry is reused only when the data, parameters and code are all
+        unchanged and stale entries simply stop being read. The least recently used entries are evicted once
+        the cache is over max_bytes.
+
+        Args:
+            cache_dir (str): Directory holding one subdirectory per entry.
+            max_bytes (int): Disk budget of the cache. Default value is 1 GiB.
+        '''
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(*parts):
+        '''
+        Builds an entry key from the versions and parameters that produced the outputs.
+
+        Args:
+            *parts: JSON-serializable values, e.g. the data version, code version, artifact name and its
+                parameters.
+
+        Returns:
+            key (str): Hex digest of the parts.
+        '''
+        return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def restore(self, key, outputs):
+        '''
+        Copies the cached files of key to their output paths and marks the entry as recently used.
+
+        Args:
+            key (str): The entry key.
+            outputs (list): Paths the entry's files are restored to, in the order they were stored.
+
+        Returns:
+            hit (bool): True if the entry existed and was restored, False otherwise.
+        '''
+        entry = self._entry(key)
+        stored = [os.path.join(entry, f"{idx}_{os.path.basename(path)}") for idx, path in enumerate(outputs)]
+        if not all(os.path.exists(path) for path in stored):
+            return False
+        for cached_path, path in zip(stored, outputs):
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            shutil.copy2(cached_path, path)
+        os.utime(entry)
+        return True
+
+    def store(self, key, outputs):
+        '''
+        Copies output files into the cache under key, then evicts least recently used entries until the
+        cache fits in max_bytes.
+
+        Args:
+            key (str): The entry key.
+            outputs (list): Paths of the files to cache.
+        '''
+        entry = self._entry(key)
+        # Written to a temporary directory and renamed, so a concurrent reader never sees half an entry
+        tmp_entry = os.path.join(self.cache_dir, f".tmp-{uuid.uuid4().hex}")
+        os.makedirs(tmp_entry)
+        for idx, path in enumerate(outputs):
+            shutil.copy2(path, os.path.join(tmp_entry, f"{idx}_{os.path.basename(path)}"))
+        try:
+            os.replace(tmp_entry, entry)
+        except OSError:
+            # Another process stored the same key first
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        '''
+        Removes the least recently used entries until the cache fits in max_bytes.
+
+        Args: None
+
+        Returns:
+            removed (list): Keys of the removed entries.
+        '''
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            entry = self._entry(key)
+            if key.startswith('.') or not os.path.isdir(entry):
+                continue
+            size = sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+            entries.append((os.path.getmtime(entry), size, key))
+
+        total = sum(size for _, size, _ in entries)
+        removed = []
+        for _, size, key in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(self._entry(key), ignore_errors=True)
+            total -= size
+            removed.append(key)
+        return removed
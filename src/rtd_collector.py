@@ -0,0 +1,250 @@
+#!/opt/anaconda3/bin/python3
+
+import os
+import math
+import signal
+import random
+import asyncio
+import argparse
+import requests
+from datetime import datetime
+from rtd_feed import RTD_Feed
+from rtd_archive import RTD_Archive
+
+class RTD_Collector(object):
+
+    def __init__(self, feeds, interval=10, jitter=0.1, max_backoff=300, timeout=10):
+        '''
+        Creates a long-running collector that polls one or more GTFS-realtime feeds on a fixed schedule,
+        replacing the cron invocation of pull_rtd_data.py. Each feed keeps its own keep-alive session so the
+        interpreter, imports and HTTP connection are paid for once instead of on every poll.
+
+        Args:
+            feeds (dict): A dictionary where the key is a name for the feed and the value is a tuple of
+                (url, handler). The handler is called as handler(feed_name, rtd_feed) after every
+                poll that returned a new snapshot, e.g. {'vehicle_position': (vehicle_position_url, append_to_parquet(dataset_root))}
+            interval (float): Number of seconds between polls of each feed. Default value is 10.
+            jitter (float): Fraction of the interval used to randomly offset each poll so multiple collectors
+                do not hit the server at the same instant. The offset never accumulates into the schedule.
+                Default value is 0.1.
+            max_backoff (float): Maximum number of seconds to wait between retries after consecutive failures.
+                Default value is 300.
+            timeout (float): Number of seconds to wait for the server on each request. Default value is 10.
+        '''
+        self.feeds = feeds
+        self.interval = interval
+        self.jitter = jitter
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.sessions = {name: requests.Session() for name in self.feeds}
+        self._stop_event = None
+
+    def stop(self):
+        '''
+        Requests a graceful shutdown. Polls already in flight are allowed to finish and be handled before
+        the collector exits.
+
+        Args: None
+        '''
+        if self._stop_event is not None:
+            self._stop_event.set()
+
+    def _next_poll(self, scheduled, now):
+        '''
+        Advances the poll schedule by whole intervals from the previous scheduled time rather than from
+        the time the poll finished, so slow requests do not cause the schedule to drift. Slots that were
+        missed entirely are skipped instead of being fired back to back.
+
+        Args:
+            scheduled (float): The loop time the previous poll was scheduled for.
+            now (float): The current loop time.
+
+        Returns:
+            next_poll (float): The loop time of the next poll.
+        '''
+        missed = max(0, math.floor((now - scheduled) / self.interval))
+        return scheduled + (missed + 1) * self.interval
+
+    async def _sleep_until(self, loop, deadline):
+        '''
+        Sleeps until the deadline (plus jitter) or until stop() is called, whichever comes first.
+
+        Args:
+            loop (asyncio loop): The running event loop.
+            deadline (float): The loop time to wake up at.
+        '''
+        offset = random.uniform(-self.jitter, self.jitter) * self.interval
+        delay = max(0, deadline + offset - loop.time())
+        try:
+            await asyncio.wait_for(self._stop_event.wait(), timeout=delay)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _poll_feed(self, name, url, handler):
+        '''
+        Polls a single feed until stop() is called, backing off exponentially while the feed is failing.
+        Requests are made conditionally on the previous snapshot and the handler is skipped when the feed
+        has not changed.
+
+        Args:
+            name (str): The name of the feed.
+            url (str): The url of the protocol buffer file.
+            handler (callable): Called as handler(name, rtd_feed) after each poll that returned a new snapshot.
+        '''
+        loop = asyncio.get_running_loop()
+        session = self.sessions[name]
+        scheduled = loop.time()
+        failures = 0
+        state = {}
+
+        while not self._stop_event.is_set():
+            try:
+                rtd_feed = await asyncio.to_thread(RTD_Feed, url, session=session, timeout=self.timeout, **state)
+                if rtd_feed.updated:
+                    await asyncio.to_thread(handler, name, rtd_feed)
+                state = rtd_feed.conditional_state()
+                failures = 0
+                scheduled = self._next_poll(scheduled, loop.time())
+            except Exception as e:
+                failures += 1
+                backoff = min(self.max_backoff, self.interval * 2 ** failures)
+                print(f"{name} poll failed ({failures} in a row): {e!r}. Retrying in {backoff:.0f}s.")
+                scheduled = loop.time() + backoff
+
+            await self._sleep_until(loop, scheduled)
+
+    async def run(self):
+        '''
+        Runs the collector until SIGINT/SIGTERM is received or stop() is called, then closes every session.
+
+        Args: None
+        '''
+        loop = asyncio.get_running_loop()
+        self._stop_event = asyncio.Event()
+
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self.stop)
+            except (NotImplementedError, RuntimeError):
+                # Signal handlers are only available on the main thread of Unix event loops
+                pass
+
+        try:
+            await asyncio.gather(*[self._poll_feed(name, url, handler)
+                                   for name, (url, handler) in self.feeds.items()])
+        finally:
+            for session in self.sessions.values():
+                session.close()
+
+def append_to_csv(filepath):
+    '''
+    Creates a handler that parses a Vehicle Position feed and appends the rows to a csv in the
+    original rtd_data.csv layout.
+
+    Args:
+        filepath (str): Filepath of the csv to append to.
+
+    Returns:
+        handler (callable): A handler to pass to RTD_Collector.
+    '''
+    def handler(name, rtd_feed):
+        rtd_df = rtd_feed.parse_to_df()
+        rtd_df.to_csv(filepath, mode='a', header=False, index=False)
+        update_string = datetime.today().strftime('%Y-%m-%d %H:%M:%S')
+        print(f"{name} updated at: {update_string}. {rtd_df.shape[0]} rows added.")
+
+    return handler
+
+def append_to_parquet(root, partition_cols=('service_date',)):
+    '''
+    Creates a handler that parses a Vehicle Position feed and appends the rows to the partitioned
+    Parquet dataset, the same way pull_rtd_data.py does.
+
+    Args:
+        root (str): Local directory or s3:// uri of the dataset.
+        partition_cols (tuple): Columns to partition by. Default value is ('service_date',).
+
+    Returns:
+        handler (callable): A handler to pass to RTD_Collector.
+    '''
+    # Imported here so a collector that only archives or saves raw feeds never loads pandas or pyarrow
+    import rtd_storage
+    root = os.path.expanduser(root)
+
+    def handler(name, rtd_feed):
+        rtd_df = rtd_feed.parse_to_df()
+        rtd_storage.write_partitioned(rtd_df, root, partition_cols=partition_cols)
+        update_string = datetime.today().strftime('%Y-%m-%d %H:%M:%S')
+        print(f"{name} updated at: {update_string}. {rtd_df.shape[0]} rows added.")
+
+    return handler
+
+def chain_handlers(*handlers):
+    '''
+    Combines handlers so one feed can be handled several ways, e.g. parsed to Parquet and archived raw.
+
+    Args:
+        *handlers (callable): Handlers to call in order.
+
+    Returns:
+        handler (callable): A handler to pass to RTD_Collector.
+    '''
+    def handler(name, rtd_feed):
+        for feed_handler in handlers:
+            feed_handler(name, rtd_feed)
+
+    return handler
+
+def save_raw_feed(directory):
+    '''
+    Creates a handler that saves the raw protocol buffer of any feed (e.g. Trip Updates or Alerts) to a
+    directory, named by feed and feed header timestamp.
+
+    Args:
+        directory (str): Directory to write the .pb files to.
+
+    Returns:
+        handler (callable): A handler to pass to RTD_Collector.
+    '''
+    directory = os.path.expanduser(directory)
+    os.makedirs(directory, exist_ok=True)
+
+    def handler(name, rtd_feed):
+        filepath = os.path.join(directory, f"{name}_{rtd_feed.feed.header.timestamp}.pb")
+        with open(filepath, 'wb') as f:
+            f.write(rtd_feed.response.content)
+
+    return handler
+
+if __name__ == '__main__':
+
+    vehicle_position_url = 'https://www.rtd-denver.com/files/gtfs-rt/VehiclePosition.pb'
+    trip_update_url = 'https://www.rtd-denver.com/files/gtfs-rt/TripUpdate.pb'
+    alerts_url = 'https://www.rtd-denver.com/files/gtfs-rt/Alerts.pb'
+
+    dataset_root = '~/Documents/dsi/repos/rtd_on_time_departure/data/rtd_data'
+    raw_directory = '~/Documents/dsi/repos/rtd_on_time_departure/data/raw_feeds'
+    archive_root = '~/Documents/dsi/repos/rtd_on_time_departure/data/raw_archive'
+
+    parser = argparse.ArgumentParser(description='Polls the RTD feeds and stores every new snapshot.')
+    parser.add_argument('--archive-only', action='store_true'
+                       ,help='Only archive the raw snapshots, without parsing them into the Parquet dataset, so '
+                             'the collector never loads pandas. The dataset can be rebuilt with rtd_archive.py.')
+    args = parser.parse_args()
+
+    if args.archive_only:
+        vehicle_position_handler = RTD_Archive(archive_root).handler()
+    else:
+        vehicle_position_handler = chain_handlers(append_to_parquet(dataset_root), RTD_Archive(archive_root).handler())
+    feeds = {'vehicle_position': (vehicle_position_url, vehicle_position_handler)
+            # Optional feeds, uncomment to collect them alongside vehicle positions
+            # ,'trip_update': (trip_update_url, save_raw_feed(raw_directory))
+            # ,'alerts': (alerts_url, save_raw_feed(raw_directory))
+            }
+
+    collector = RTD_Collector(feeds, interval=10)
+    asyncio.run(collector.run())
+
+# Run in place of the pull_rtd_data.py crontab entry
+# (add --archive-only to only archive the raw snapshots)
+# cd ~/Documents/dsi/repos/rtd_on_time_departure/src && nohup /opt/anaconda3/bin/python3 rtd_collector.py >> ~/Documents/dsi/repos/rtd_on_time_departure/cron_files/pull_cron.rtf 2>&1 &
@@ -3,61 +3,202 @@
 # Documentation: https://developers.google.com/transit/gtfs-realtime
 from google.transit import gtfs_realtime_pb2
 import requests
-import pandas as pd
+
+def parse_header(content):
+    '''
+    Parses only the FeedHeader out of a serialized FeedMessage without decoding any of the entities. 
+    The header is field 1 and is written first by every GTFS-realtime producer; if it is not, the full 
+    message is parsed instead.
+
+    Args:
+        content (bytes): The serialized FeedMessage.
+
+    Returns:
+        header (gtfs_realtime_pb2.FeedHeader): The header of the feed.
+    '''
+    # Field 1, wire type 2 (length-delimited) followed by a varint length
+    if content[:1] == b'\x0a':
+        length, shift, pos = 0, 0, 1
+        while pos < len(content):
+            byte = content[pos]
+            length |= (byte & 0x7f) << shift
+            pos += 1
+            if not byte & 0x80:
+                header = gtfs_realtime_pb2.FeedHeader()
+                header.ParseFromString(content[pos:pos + length])
+                return header
+            shift += 7
+
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.ParseFromString(content)
+    return feed.header
 
 class RTD_Feed(object):
 
-    def __init__(self, url):
+    def __init__(self, url, session=None, timeout=None, etag=None, last_modified=None, last_timestamp=None):
         '''
-        Creates a class of RTD Feed that pulls in the data from the protocol buffer file.
+        Creates a class of RTD Feed that pulls in the data from the protocol buffer file. When any of etag, 
+        last_modified or last_timestamp are passed (see conditional_state()), the request is made conditionally
+        and the feed is only parsed if it changed since the last snapshot. Check RTD_Feed.updated before
+        parsing or writing the feed.
         
         Args:
             URL (str): url of the GTFS feed that points to the protocol buffer file.
             e.g. RTD Vehicle Position feed: 'https://www.rtd-denver.com/files/gtfs-rt/VehiclePosition.pb'
+            session (requests.Session): Optional keep-alive session so repeated polls reuse a pooled 
+                connection. Defaults to a one-off requests.get call.
+            timeout (float): Optional number of seconds to wait for the server before giving up.
+            etag (str): ETag header returned with the last snapshot, sent as If-None-Match.
+            last_modified (str): Last-Modified header returned with the last snapshot, sent as If-Modified-Since.
+            last_timestamp (int): FeedHeader.timestamp of the last ingested snapshot. A feed whose header
+                timestamp is not newer than this is treated as unchanged.
         '''
         self.feed = gtfs_realtime_pb2.FeedMessage()
-        self.response = requests.get(url)
+        requester = requests if session is None else session
+
+        headers = {}
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        if last_modified is not None:
+            headers['If-Modified-Since'] = last_modified
+
+        self.response = requester.get(url, headers=headers, timeout=timeout)
+        self.etag = self.response.headers.get('ETag', etag)
+        self.last_modified = self.response.headers.get('Last-Modified', last_modified)
+        self.header_timestamp = last_timestamp
+        self.updated = False
+
+        # 304 Not Modified: nothing was sent, so there is nothing to parse
+        if self.response.status_code == 304:
+            return
+
+        self.response.raise_for_status()
+
+        # Only the header is needed to tell whether the snapshot is new, so skip the entities until it is
+        header = parse_header(self.response.content)
+        if (last_timestamp is not None) and (header.timestamp <= last_timestamp):
+            return
+
         self.feed.ParseFromString(self.response.content)
-    
-    def parse_to_df(self):
+        self.header_timestamp = self.feed.header.timestamp
+        self.updated = True
+
+    @classmethod
+    def from_content(cls, content):
         '''
-        Parses the feed from the protocol buffer and pulls the values passed in from dict_of_values
+        Creates a class of RTD Feed from an already downloaded protocol buffer instead of requesting a url,
+        e.g. for recorded snapshots or synthetic feeds.
 
         Args:
-            dict_of_values (dict): A dictionary where the key is a string that will refer to the 
-            column name in the passed dataframe and the value is the entity.vehicle.trip | position 
-            | current_status | timestamp | stop | vehicle info.
+            content (bytes): The serialized FeedMessage.
 
         Returns:
-            pandas DataFrame (pd.DataFrame): where the column titles are the keys from dict_of_values 
-            and the values are the values for each entity pulled from the feed.
+            rtd_feed (RTD_Feed): The parsed feed.
         '''
-        vehicle_dict = {}
-
-        for entity in self.feed.entity:
-            if (entity.HasField('id')) & (entity.vehicle.HasField('trip')):
-                vehicle_dict[entity.id] = {}
-                vehicle_dict[entity.id]['trip_id'] = entity.vehicle.trip.trip_id
-                vehicle_dict[entity.id]['schedule_relationship'] = entity.vehicle.trip.schedule_relationship
-                vehicle_dict[entity.id]['route_id'] = entity.vehicle.trip.route_id
-                vehicle_dict[entity.id]['direction_id'] = entity.vehicle.trip.direction_id
-                vehicle_dict[entity.id]['vehicle_lat'] = entity.vehicle.position.latitude
-                vehicle_dict[entity.id]['vehicle_lng'] = entity.vehicle.position.longitude
-                vehicle_dict[entity.id]['bearing'] = round(entity.vehicle.position.bearing)
-                vehicle_dict[entity.id]['current_status'] = entity.vehicle.current_status
-                vehicle_dict[entity.id]['timestamp'] = entity.vehicle.timestamp
-                vehicle_dict[entity.id]['stop_id'] = entity.vehicle.stop_id
-                vehicle_dict[entity.id]['vehicle_id'] = entity.vehicle.vehicle.id
-                vehicle_dict[entity.id]['vehicle_label'] = entity.vehicle.vehicle.label
-        
-        # Debugging
-        # for k,v in vehicle_dict.items():
-        #     print(f'{k}: {v}')
+        rtd_feed = cls.__new__(cls)
+        rtd_feed.feed = gtfs_realtime_pb2.FeedMessage()
+        rtd_feed.feed.ParseFromString(content)
+        rtd_feed.response = None
+        rtd_feed.etag = None
+        rtd_feed.last_modified = None
+        rtd_feed.header_timestamp = rtd_feed.feed.header.timestamp
+        rtd_feed.updated = True
+        return rtd_feed
+
+    def conditional_state(self):
+        '''
+        Returns the validators of this snapshot so they can be passed to the next RTD_Feed,
+        e.g. RTD_Feed(url, **rtd_feed.conditional_state())
+
+        Args: None
+
+        Returns:
+            state (dict): etag, last_modified and last_timestamp of the most recent snapshot.
+        '''
+        return {'etag': self.etag
+               ,'last_modified': self.last_modified
+               ,'last_timestamp': self.header_timestamp}
     
-        return pd.DataFrame.from_dict(vehicle_dict, orient='index').rename_axis('entity_id').reset_index()
+    def parse_to_df(self, output='pandas'):
+        '''
+        Parses the vehicle positions from the protocol buffer in a single pass, filling one preallocated 
+        typed array per column (see FEED_COLUMNS) and building the output directly from those columns.
+
+        Args:
+            output (str): The type of object to return. Can be 'pandas' for a DataFrame, 'numpy' for a 
+                NumPy structured array or 'arrow' for a pyarrow Table. 'numpy' and 'arrow' never touch pandas.
+                Default value is 'pandas'.
+
+        Returns:
+            pandas DataFrame (pd.DataFrame) | numpy structured array (np.ndarray) | pyarrow Table (pa.Table): 
+            where the column titles are the names in FEED_COLUMNS and the values are the values for each 
+            vehicle entity pulled from the feed.
+        '''
+        # Imported here so fetching, conditional requests and archiving snapshots never load numpy or pandas
+        import numpy as np
+        import pandas as pd
+        from rtd_schema import FEED_COLUMNS
+
+        entities = self.feed.entity
+        n = len(entities)
+
+        dtypes = dict(FEED_COLUMNS)
+        entity_id = np.empty(n, dtype=dtypes['entity_id'])
+        trip_id = np.empty(n, dtype=dtypes['trip_id'])
+        schedule_relationship = np.empty(n, dtype=dtypes['schedule_relationship'])
+        route_id = np.empty(n, dtype=dtypes['route_id'])
+        direction_id = np.empty(n, dtype=dtypes['direction_id'])
+        vehicle_lat = np.empty(n, dtype=dtypes['vehicle_lat'])
+        vehicle_lng = np.empty(n, dtype=dtypes['vehicle_lng'])
+        bearing = np.empty(n, dtype=dtypes['bearing'])
+        current_status = np.empty(n, dtype=dtypes['current_status'])
+        timestamp = np.empty(n, dtype=dtypes['timestamp'])
+        stop_id = np.empty(n, dtype=dtypes['stop_id'])
+        vehicle_id = np.empty(n, dtype=dtypes['vehicle_id'])
+        vehicle_label = np.empty(n, dtype=dtypes['vehicle_label'])
+
+        i = 0
+        for entity in entities:
+            vehicle = entity.vehicle
+            if (entity.HasField('id')) & (vehicle.HasField('trip')):
+                trip = vehicle.trip
+                position = vehicle.position
+                descriptor = vehicle.vehicle
+                entity_id[i] = entity.id
+                trip_id[i] = trip.trip_id
+                schedule_relationship[i] = trip.schedule_relationship
+                route_id[i] = trip.route_id
+                direction_id[i] = trip.direction_id
+                vehicle_lat[i] = position.latitude
+                vehicle_lng[i] = position.longitude
+                bearing[i] = round(position.bearing)
+                current_status[i] = vehicle.current_status
+                timestamp[i] = vehicle.timestamp
+                stop_id[i] = vehicle.stop_id
+                vehicle_id[i] = descriptor.id
+                vehicle_label[i] = descriptor.label
+                i += 1
+
+        columns = dict(zip([name for name, _ in FEED_COLUMNS]
+                          ,[entity_id, trip_id, schedule_relationship, route_id, direction_id, vehicle_lat
+                           ,vehicle_lng, bearing, current_status, timestamp, stop_id, vehicle_id, vehicle_label]))
+
+        if output == 'pandas':
+            return pd.DataFrame({name: column[:i] for name, column in columns.items()})
+        elif output == 'numpy':
+            records = np.empty(i, dtype=FEED_COLUMNS)
+            for name, column in columns.items():
+                records[name] = column[:i]
+            return records
+        elif output == 'arrow':
+            import pyarrow as pa
+            return pa.table({name: column[:i] for name, column in columns.items()})
+        else:
+            raise ValueError(f"output must be 'pandas', 'numpy' or 'arrow', not {output!r}")
 
 if __name__ == '__main__':
-    
+
+    import pandas as pd
     vehicle_position_url = 'https://www.rtd-denver.com/files/gtfs-rt/VehiclePosition.pb'
 
     rtd_feed = RTD_Feed(vehicle_position_url)
@@ -0,0 +1,253 @@
+#!/opt/anaconda3/bin/python3
+
+import os
+import time
+import asyncio
+import pandas as pd
+import rtd_schema
+import gtfs_static
+import clean_rtd_data
+import analyze_rtd_data
+from rtd_feed import RTD_Feed, parse_header
+from rtd_collector import RTD_Collector
+
+# Columns of the last report of each vehicle on a trip (keyed by 'trip_id|vehicle_label'), which is all the
+# live engine remembers between snapshots
+STATE_COLUMNS = {'timestamp': 'int64'
+                ,'route_id': object
+                ,'stop_id': object
+                ,'vehicle_lat': 'float32'
+                ,'vehicle_lng': 'float32'}
+
+class RTD_Live(object):
+
+    def __init__(self, gtfs_path=None, window_minutes=60, stale_hours=6, levels=analyze_rtd_data.STATS_LEVELS
+                ,thresholds=analyze_rtd_data.ONTIME_THRESHOLDS):
+        '''
+        Computes on-time departure metrics live from Vehicle Position snapshots instead of from a batch of
+        cleaned data. Each snapshot is compared with the last report of every vehicle on its trip to find the
+        stops it just departed (what RTD_df.shift_departures does in batch), the departures are joined to the
+        GTFS schedule and classified, and their counts are added to per-minute counters of the last
+        window_minutes.
+
+        Args:
+            gtfs_path (str): Directory (or .zip) of the GTFS static feed. Default value is None, which uses
+                RTD_df.gtfs_path.
+            window_minutes (int): Length of the rolling window metrics are computed over, in minutes of feed
+                time. Default value is 60.
+            stale_hours (int): Hours after which a vehicle that stopped reporting is forgotten. Default value
+                is 6.
+            levels (dict): Levels of the metrics, see analyze_rtd_data.ontime_stats. Default value is
+                STATS_LEVELS.
+            thresholds (dict): On-time thresholds of each mode. Default value is ONTIME_THRESHOLDS.
+        '''
+        self.gtfs = gtfs_static.GTFS_Static.load(gtfs_path or clean_rtd_data.RTD_df.gtfs_path)
+        self.window_minutes = window_minutes
+        self.stale_hours = stale_hours
+        self.levels = levels
+        self.thresholds = thresholds
+        self.keys = list(dict.fromkeys(col for columns in levels.values() for col in columns))
+
+        self.state = pd.DataFrame({col: pd.Series(dtype=dtype) for col, dtype in STATE_COLUMNS.items()}
+                                 ,index=pd.Index([], dtype=object, name='vehicle_trip'))
+        self.counters = {}
+        self.feed_timestamp = None
+
+    def detect_departures(self, snapshot):
+        '''
+        Finds the stops vehicles departed since their last report and updates the per-vehicle state. A
+        departure is a newer report on the same trip with a different stop_id; it keeps the stop, time and
+        position of the last report at the stop (the arrival) and the time and position of the first report
+        after it (the departure), like the rows clean_my_data keeps.
+
+        Args:
+            snapshot (pd.DataFrame): A Vehicle Position snapshot as returned by RTD_Feed.parse_to_df().
+
+        Returns:
+            departures (pd.DataFrame): One row per departure with trip_id, vehicle_label, route_id, stop_id,
+                vehicle_lat, vehicle_lng, timestamp, departure_vehicle_lat, departure_vehicle_lng and
+                departure_timestamp. Timestamps are POSIX seconds.
+        '''
+        snapshot = snapshot[snapshot.trip_id.notnull() & snapshot.stop_id.notnull() & (snapshot.timestamp > 0)]
+        snapshot = snapshot.assign(trip_id=gtfs_static.normalize_ids(snapshot.trip_id)
+                                  ,vehicle_label=snapshot.vehicle_label.astype(str)
+                                  ,stop_id=gtfs_static.normalize_ids(snapshot.stop_id))
+        # One flat string key per vehicle and trip keeps the state lookups and updates cheap
+        snapshot = (snapshot.assign(vehicle_trip=snapshot.trip_id + '|' + snapshot.vehicle_label)
+                            .sort_values('timestamp')
+                            .drop_duplicates('vehicle_trip', keep='last')
+                            .set_index('vehicle_trip'))
+
+        joined = snapshot.join(self.state, rsuffix='_prev', how='left')
+        newer = joined.timestamp_prev.isnull() | (joined.timestamp > joined.timestamp_prev)
+        departed = newer & joined.timestamp_prev.notnull() & (joined.stop_id != joined.stop_id_prev)
+
+        departures = joined[departed]
+        departures = pd.DataFrame({'route_id': departures.route_id
+                                  ,'stop_id': departures.stop_id_prev
+                                  ,'vehicle_lat': departures.vehicle_lat_prev
+                                  ,'vehicle_lng': departures.vehicle_lng_prev
+                                  ,'timestamp': departures.timestamp_prev.astype('int64')
+                                  ,'departure_vehicle_lat': departures.vehicle_lat
+                                  ,'departure_vehicle_lng': departures.vehicle_lng
+                                  ,'departure_timestamp': departures.timestamp}).reset_index(drop=True)
+        departures.insert(0, 'trip_id', joined.trip_id[departed].to_numpy())
+        departures.insert(1, 'vehicle_label', joined.vehicle_label[departed].to_numpy())
+
+        # Newer reports replace the vehicle's state, and vehicles silent for stale_hours are forgotten
+        updated = snapshot.loc[newer, list(STATE_COLUMNS)].astype(STATE_COLUMNS)
+        self.state = pd.concat([self.state[~self.state.index.isin(updated.index)], updated])
+        latest = self.state.timestamp.max() if len(self.state) else 0
+        self.state = self.state[self.state.timestamp >= latest - self.stale_hours * 3600]
+        return departures
+
+    def classify(self, departures):
+        '''
+        Joins departures to the GTFS schedule, drops the ones clean_my_data would drop and classifies them
+        as early, on_time or late.
+
+        Args:
+            departures (pd.DataFrame): Departures as returned by detect_departures.
+
+        Returns:
+            departures (pd.DataFrame): The departures with route_type, route_short_name, direction_id,
+                stop_name, scheduled_departure_time, local departure_timestamp, minutes_since_departure and
+                departure_status.
+        '''
+        departures = self.gtfs.join(departures, 'routes', ['route_type', 'route_short_name'])
+        departures = self.gtfs.join(departures, 'trips', ['direction_id'])
+        departures = self.gtfs.join(departures, 'stops', ['stop_name'])
+        departures = self.gtfs.join(departures, 'stop_times', ['departure_time'])
+
+        # Same filters as clean_my_data: known stops inside RTD's service area with a scheduled departure
+        departures = departures[departures.stop_name.notnull() & (departures.vehicle_lat > 0.0)
+                              & (departures.vehicle_lng < -104.8)]
+        departures = departures.rename(columns={'departure_time': 'scheduled_departure_time'})
+        departures['scheduled_departure_time'] = clean_rtd_data.gtfs_time_to_seconds(departures.scheduled_departure_time)
+        departures = departures[departures.scheduled_departure_time.notnull()]
+        departures['route_type'] = departures.route_type.map(rtd_schema.ROUTE_TYPE_CODES)
+        departures['direction_id'] = departures.direction_id.astype('int8')
+
+        rtd_data = clean_rtd_data.RTD_df.__new__(clean_rtd_data.RTD_df)
+        rtd_data.df = departures.assign(departure_epoch=departures.departure_timestamp)
+        rtd_data.convert_timezone_local(['departure_timestamp'], 'UTC', 'US/Mountain')
+        rtd_data.calculate_time('departure_timestamp', 'scheduled_departure_time', 'minutes_since_departure')
+        departures = rtd_data.df
+        departures['departure_status'] = analyze_rtd_data.classify_departures(departures.route_type
+                                                                             ,departures.minutes_since_departure
+                                                                             ,self.thresholds)
+        return departures
+
+    def count(self, departures):
+        '''
+        Adds classified departures to the counters of the minute they departed in and drops the counters
+        that have left the rolling window.
+
+        Args:
+            departures (pd.DataFrame): Departures as returned by classify.
+        '''
+        counts = departures.loc[:, self.keys].assign(minute=departures.departure_epoch // 60
+                                                     ,total_stops=departures.departure_status.notnull()
+                                                     ,ontime_stops=departures.departure_status == 'on_time')
+        for minute, minute_counts in counts.groupby('minute'):
+            minute_counts = minute_counts.drop(columns='minute')
+            if minute in self.counters:
+                minute_counts = pd.concat([self.counters[minute], minute_counts])
+            self.counters[minute] = minute_counts.groupby(self.keys, dropna=False).sum().reset_index()
+
+        if self.feed_timestamp is not None:
+            oldest = self.feed_timestamp // 60 - self.window_minutes
+            for minute in [minute for minute in self.counters if minute <= oldest]:
+                del self.counters[minute]
+
+    def update(self, rtd_feed):
+        '''
+        Processes one Vehicle Position snapshot: detects departures, classifies them and counts them.
+
+        Args:
+            rtd_feed (RTD_Feed): The snapshot.
+
+        Returns:
+            departures (pd.DataFrame): The snapshot's classified departures, see classify.
+        '''
+        self.feed_timestamp = max(self.feed_timestamp or 0, rtd_feed.feed.header.timestamp)
+        departures = self.classify(self.detect_departures(rtd_feed.parse_to_df()))
+        self.count(departures)
+        return departures
+
+    def metrics(self, null_percent=0.86, alpha=0.05, power=0.8):
+        '''
+        On-time departure metrics of every level over the rolling window.
+
+        Args:
+            null_percent (float): Null Hypothesis on-time probability each group is tested against. Default
+                value is 0.86.
+            alpha (float): Significance level of the tests. Default value is 0.05.
+            power (float): Target power used to solve each group's p_null. Default value is 0.8.
+
+        Returns:
+            stats_df (pd.DataFrame): The table described in analyze_rtd_data.ontime_stats.
+        '''
+        if not self.counters:
+            # Typed like the counters, so the first snapshot or a window without departures gives empty metrics
+            columns = dict.fromkeys(self.keys, object) | {'total_stops': 'int64', 'ontime_stops': 'int64'}
+            counts = pd.DataFrame({col: pd.Series(dtype=dtype) for col, dtype in columns.items()})
+        else:
+            counts = pd.concat(self.counters.values()).groupby(self.keys, dropna=False).sum().reset_index()
+        return analyze_rtd_data.rollup_ontime_stats(counts, self.levels, null_percent, alpha, power)
+
+    def replay(self, paths):
+        '''
+        Feeds recorded Vehicle Position snapshots (e.g. saved by rtd_collector.save_raw_feed) through update
+        in feed order.
+
+        Args:
+            paths (list): Paths of the .pb files.
+
+        Yields:
+            timestamp (int): Feed header timestamp of the snapshot.
+            departures (pd.DataFrame): The snapshot's classified departures.
+        '''
+        timestamps = {}
+        for path in paths:
+            with open(path, 'rb') as f:
+                timestamps[path] = parse_header(f.read()).timestamp
+
+        for path in sorted(paths, key=timestamps.get):
+            with open(path, 'rb') as f:
+                rtd_feed = RTD_Feed.from_content(f.read())
+            yield timestamps[path], self.update(rtd_feed)
+
+    def handler(self, metrics_path=None):
+        '''
+        Creates an RTD_Collector handler that updates the live metrics after every new snapshot, prints
+        the on-time rate of each route type and optionally writes every metric to a csv.
+
+        Args:
+            metrics_path (str): csv overwritten with the latest metrics. Default value is None.
+
+        Returns:
+            handler (callable): A handler to pass to RTD_Collector.
+        '''
+        def handler(name, rtd_feed):
+            start = time.perf_counter()
+            departures = self.update(rtd_feed)
+            metrics = self.metrics()
+            if metrics_path is not None:
+                metrics.to_csv(os.path.expanduser(metrics_path), index=False)
+
+            rates = metrics[metrics.level == 'route_type'].set_index('route_type').ontime_departure_rate
+            rates_string = ', '.join(f"{route_type}: {rate:.1%}" for route_type, rate in rates.items())
+            print(f"{len(departures)} departures at {rtd_feed.feed.header.timestamp}, last {self.window_minutes} "
+                  f"minutes on-time {rates_string} ({time.perf_counter() - start:.2f}s)")
+
+        return handler
+
+if __name__ == '__main__':
+
+    vehicle_position_url = 'https://www.rtd-denver.com/files/gtfs-rt/VehiclePosition.pb'
+    metrics_path = '~/Documents/dsi/repos/rtd_on_time_departure/data/live_metrics.csv'
+
+    live = RTD_Live(window_minutes=60)
+    collector = RTD_Collector({'vehicle_position': (vehicle_position_url, live.handler(metrics_path))}, interval=10)
+    asyncio.run(collector.run())
@@ -0,0 +1,323 @@
+#!/opt/anaconda3/bin/python3
+
+import os
+import re
+import json
+import time
+import inspect
+import cProfile
+import functools
+import contextlib
+import tracemalloc
+import pandas as pd
+
+# The profiler stages record into while profiling is enabled, None while it is disabled
+_active = None
+
+# Shared by every stage while profiling is disabled, so a disabled stage costs one global lookup
+_DISABLED_STAGE = contextlib.nullcontext()
+
+def _rows(obj):
+    '''
+    Number of rows of a DataFrame or Series, None for anything else.
+    '''
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        return len(obj)
+    return None
+
+class _Stage_Run(object):
+
+    def __init__(self, path, rows_in):
+        '''
+        Measurements of one run of a stage while it is on the profiler's stack.
+        '''
+        self.path = path
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        self.start_memory = 0
+        self.peak_memory = 0
+        self.profiler = None
+
+class Stage_Profiler(object):
+
+    def __init__(self, memory=True, profile_dir=None, profile_stages=None, profiler='cprofile'):
+        '''
+        Records the wall time, CPU time, rows in and out and peak memory of every stage run while it is
+        enabled (see enable()). Stages nest: a stage run inside another is recorded under its path, e.g.
+        'RTD_df.clean_my_data/RTD_df.shift_departures', and runs of the same path are summed.
+
+        Args:
+            memory (bool): If True, peak memory is traced with tracemalloc, which slows the profiled code
+                down. Default value is True.
+            profile_dir (str): Directory to write a cProfile (.prof) or pyinstrument (.html) dump of each
+                profiled stage to. Default value is None, which writes none.
+            profile_stages (list): Names of the stages to dump. Stages inside a dumped stage are part of its
+                dump instead of getting their own. Default value is None, which dumps every outermost stage.
+            profiler (str): 'cprofile' or 'pyinstrument' (if installed). Default value is 'cprofile'.
+        '''
+        if profiler not in ('cprofile', 'pyinstrument'):
+            raise ValueError(f"profiler must be 'cprofile' or 'pyinstrument', not {profiler!r}")
+        self.memory = memory
+        self.profile_dir = None if profile_dir is None else os.path.expanduser(profile_dir)
+        self.profile_stages = profile_stages
+        self.profiler = profiler
+        self.records = {}
+        self._stack = []
+        self._dumps = 0
+        # True if enable() started tracemalloc, so disable() leaves tracing started by other code running
+        self._started_tracing = False
+
+    def _start_profiler(self, run, name):
+        '''
+        Starts a cProfile/pyinstrument profiler for the stage run if it should be dumped.
+        '''
+        if self.profile_dir is None or any(parent.profiler is not None for parent in self._stack[:-1]):
+            return
+        if (self.profile_stages is not None) and (name not in self.profile_stages):
+            return
+        if self.profiler == 'pyinstrument':
+            from pyinstrument import Profiler
+            run.profiler = Profiler()
+            run.profiler.start()
+        else:
+            run.profiler = cProfile.Profile()
+            run.profiler.enable()
+
+    def _dump_profiler(self, run):
+        '''
+        Stops the stage run's profiler and writes its dump to profile_dir.
+        '''
+        os.makedirs(self.profile_dir, exist_ok=True)
+        self._dumps += 1
+        filename = f"{self._dumps:03d}_{re.sub(r'[^A-Za-z0-9_.-]+', '_', run.path)}"
+        if self.profiler == 'pyinstrument':
+            run.profiler.stop()
+            with open(os.path.join(self.profile_dir, f"{filename}.html"), 'w') as f:
+                f.write(run.profiler.output_html())
+        else:
+            run.profiler.disable()
+            run.profiler.dump_stats(os.path.join(self.profile_dir, f"{filename}.prof"))
+
+    def start(self, name, rows_in=None):
+        '''
+        Starts a run of a stage inside the stage currently running, if any.
+
+        Args:
+            name (str): Name of the stage.
+            rows_in (int): Number of rows the stage starts with. Default value is None.
+
+        Returns:
+            run (_Stage_Run): The run, to pass to stop().
+        '''
+        path = name if not self._stack else f"{self._stack[-1].path}/{name}"
+        run = _Stage_Run(path, rows_in)
+        # Created here rather than in stop(), so stages are reported in the order they started
+        self.records.setdefault(path, {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'rows_in': None
+                                      ,'rows_out': None, 'peak_memory_mb': None})
+        if self.memory and tracemalloc.is_tracing():
+            # The peak of the parent so far is kept before the traced peak is reset for this stage
+            current, peak = tracemalloc.get_traced_memory()
+            if self._stack:
+                self._stack[-1].peak_memory = max(self._stack[-1].peak_memory, peak)
+            tracemalloc.reset_peak()
+            run.start_memory = run.peak_memory = current
+        self._stack.append(run)
+        self._start_profiler(run, name)
+        return run
+
+    def stop(self, run, rows_out=None):
+        '''
+        Ends a run of a stage and adds its measurements to the stage's record.
+
+        Args:
+            run (_Stage_Run): The run returned by start().
+            rows_out (int): Number of rows the stage ends with. Default value is None, which keeps
+                run.rows_out.
+        '''
+        if run.profiler is not None:
+            self._dump_profiler(run)
+        wall = time.perf_counter() - run.wall
+        cpu = time.process_time() - run.cpu
+        self._stack.pop()
+        if self.memory and tracemalloc.is_tracing():
+            run.peak_memory = max(run.peak_memory, tracemalloc.get_traced_memory()[1])
+            if self._stack:
+                self._stack[-1].peak_memory = max(self._stack[-1].peak_memory, run.peak_memory)
+            tracemalloc.reset_peak()
+
+        rows_out = run.rows_out if rows_out is None else rows_out
+        record = self.records[run.path]
+        record['calls'] += 1
+        record['wall_seconds'] += wall
+        record['cpu_seconds'] += cpu
+        if run.rows_in is not None:
+            record['rows_in'] = (record['rows_in'] or 0) + run.rows_in
+        if rows_out is not None:
+            record['rows_out'] = (record['rows_out'] or 0) + rows_out
+        if self.memory and tracemalloc.is_tracing():
+            peak = (run.peak_memory - run.start_memory) / 1024**2
+            record['peak_memory_mb'] = max(record['peak_memory_mb'] or 0.0, peak)
+
+    def report(self):
+        '''
+        The recorded stages in the order they first ran.
+
+        Args: None
+
+        Returns:
+            report (pd.DataFrame): calls, wall_seconds, cpu_seconds, rows_in, rows_out and peak_memory_mb (the
+                most memory allocated above the stage's starting point, as traced by tracemalloc) of each
+                stage path, plus the percent of its parent's wall time it took.
+        '''
+        report = pd.DataFrame.from_dict(self.records, orient='index')
+        if report.empty:
+            return report
+        report.index.name = 'stage'
+        report = report.astype({'calls': 'int64', 'rows_in': 'Int64', 'rows_out': 'Int64'})
+        parents = [path.rsplit('/', 1)[0] if '/' in path else None for path in report.index]
+        parent_wall = [report.wall_seconds[parent] if parent in self.records else float('nan') for parent in parents]
+        report['percent_of_parent'] = 100 * report.wall_seconds / parent_wall
+        return report
+
+    def table(self):
+        '''
+        The report as an indented table for the terminal.
+
+        Args: None
+
+        Returns:
+            table (str): One line per stage, nested stages indented under their parent.
+        '''
+        report = self.report()
+        if report.empty:
+            return 'No stages recorded.'
+        report.index = ['  ' * path.count('/') + path.rsplit('/', 1)[-1] for path in report.index]
+        return report.to_string(float_format=lambda x: f"{x:,.3f}", na_rep='')
+
+    def to_json(self, filepath=None):
+        '''
+        The report as JSON, optionally written to a file.
+
+        Args:
+            filepath (str): File to write the JSON to. Default value is None, which only returns it.
+
+        Returns:
+            report_json (str): A JSON list with one object per stage.
+        '''
+        report = self.report().reset_index()
+        report_json = json.dumps(json.loads(report.to_json(orient='records')), indent=2)
+        if filepath is not None:
+            with open(os.path.expanduser(filepath), 'w') as f:
+                f.write(report_json)
+        return report_json
+
+def enable(memory=True, profile_dir=None, profile_stages=None, profiler='cprofile'):
+    '''
+    Starts recording stages into a new Stage_Profiler. Until disable() is called every stage() and @profiled
+    function records into it. Stages run in worker processes (clean_parallel, rtd_report's jobs) are not
+    recorded.
+
+    Args: See Stage_Profiler.
+
+    Returns:
+        profiler (Stage_Profiler): The profiler being recorded into.
+    '''
+    global _active
+    _active = Stage_Profiler(memory, profile_dir, profile_stages, profiler)
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _active._started_tracing = True
+    return _active
+
+def disable():
+    '''
+    Stops recording stages, and tracemalloc if enable() started it.
+
+    Args: None
+
+    Returns:
+        profiler (Stage_Profiler): The profiler that was recording, with everything it recorded.
+    '''
+    global _active
+    profiler, _active = _active, None
+    if (profiler is not None) and profiler._started_tracing and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    return profiler
+
+@contextlib.contextmanager
+def _stage(profiler, name, rows_in):
+    run = profiler.start(name, rows_in)
+    try:
+        yield run
+    finally:
+        profiler.stop(run)
+
+def stage(name, rows_in=None):
+    '''
+    Context manager recording a block of code as a stage, e.g.
+
+        with rtd_profile.stage('filter stops', len(df)) as run:
+            df = df[df.stop_name.notnull()]
+            if run is not None:
+                run.rows_out = len(df)
+
+    Args:
+        name (str): Name of the stage.
+        rows_in (int): Number of rows the stage starts with. Default value is None.
+
+    Returns:
+        stage (context manager): Yields the _Stage_Run, or None while profiling is disabled.
+    '''
+    if _active is None:
+        return _DISABLED_STAGE
+    return _stage(_active, name, rows_in)
+
+def profiled(frame=None, label=None):
+    '''
+    Decorator recording every call of a function or method as a stage named after its qualified name. While
+    profiling is disabled the only added cost is one global lookup per call.
+
+    Args:
+        frame (str): Attribute of the method's instance holding the DataFrame it transforms, e.g. 'df' for
+            RTD_df, counted before and after the call. Default value is None, which counts the first
+            DataFrame argument and the DataFrame returned.
+        label (str): Argument whose value is appended to the stage name to tell calls apart, e.g.
+            'new_column' names calculate_time's stages 'RTD_df.calculate_time[minutes_to_arrival]'.
+            Default value is None.
+
+    Returns:
+        decorator (callable): The decorator.
+    '''
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            profiler = _active
+            if profiler is None:
+                return func(*args, **kwargs)
+
+            name = func.__qualname__
+            if label is not None:
+                bound = signature.bind(*args, **kwargs)
+                bound.apply_defaults()
+                name = f"{name}[{bound.arguments[label]}]"
+            if frame is not None:
+                rows_in = _rows(getattr(args[0], frame, None))
+            else:
+                rows_in = next((_rows(arg) for arg in args if _rows(arg) is not None), None)
+
+            run = profiler.start(name, rows_in)
+            result = None
+            try:
+                result = func(*args, **kwargs)
+                return result
+            finally:
+                rows_out = _rows(getattr(args[0], frame, None)) if frame is not None else _rows(result)
+                profiler.stop(run, rows_out)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,317 @@
+#!/opt/anaconda3/bin/python3
+
+import os
+import sys
+import glob
+import time
+import argparse
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import rtd_cache
+import rtd_schema
+import rtd_profile
+import gtfs_static
+import clean_rtd_data
+import analyze_rtd_data
+from analyze_rtd_data import RTD_analyze, ontime_stats
+
+# Read-only inputs of the report jobs. They are set in the parent before the pool forks, so every worker
+# shares the cleaned data copy-on-write instead of having it pickled to it.
+_report = {}
+
+def prepare_report(rtd_data):
+    '''
+    Runs the analysis every artifact depends on once, in the parent process: on-time departures for all
+    routes, light rail and bus, their p_null at the target power and the on-time statistics of every group.
+
+    Args:
+        rtd_data (RTD_df): The cleaned RTD_df to report on.
+    '''
+    _report.clear()
+    _report['rtd_data'] = rtd_data
+    _report['alpha'] = 0.01/3
+    _report['top_10_alpha'] = 0.01/10
+
+    for name, route_type in [('all_routes', 'All'), ('light_rail', 'light_rail'), ('bus', 'bus')]:
+        analysis = RTD_analyze(rtd_data, route_type=route_type)
+        analysis.calculate_ontime_departure()
+        analysis.calculate_p_null(_report['alpha'])
+        _report[name] = analysis
+
+    _report['route_stats'] = ontime_stats(rtd_data.df, null_percent=0.86, alpha=_report['top_10_alpha'])
+
+def departure_time_histogram():
+    '''
+    Plots the histogram of minutes before/after the scheduled departure of all routes.
+    '''
+    import matplotlib.pyplot as plt
+    fig, ax = plt.subplots(figsize=(15,10))
+    ax.hist(_report['all_routes'].data.minutes_since_departure, bins=250)
+    ax.set_xlabel('Minutes Before/After Schedule')
+    ax.set_title('Histogram of Departure Time Before/After Schedule ')
+    ax.set_xlim((-20,20))
+    fig.savefig('images/departure_time_histogram.png')
+    return 'images/departure_time_histogram.png'
+
+def hypothesis_figure(filepath, plot, modified, legend_loc=None):
+    '''
+    Plots the null (or null and alternate) hypotheses of all routes, light rail and bus on three stacked axes.
+
+    Args:
+        filepath (str): Where to save the figure.
+        plot (str): 'null' or 'alt', for plot_null_hypothesis or plot_alt_hypothesis.
+        modified (bool): If True, each Null Hypothesis is the p_null with 80% power, otherwise it is the
+            original 86% (90% for light rail).
+        legend_loc (str): Legend location of plot_alt_hypothesis. Default value is None.
+
+    Returns:
+        filepath (str): The saved figure.
+    '''
+    if modified:
+        null_percents = [_report[name].p_null for name in ['all_routes', 'light_rail', 'bus']]
+    else:
+        null_percents = [0.86, 0.90, 0.86]
+    import matplotlib.pyplot as plt
+
+    with plt.rc_context({'xtick.labelsize': 25, 'ytick.labelsize': 25}):
+        fig, axs = plt.subplots(3,1,figsize=(20,30), constrained_layout=True)
+        for ax, name, null_percent in zip(axs, ['all_routes', 'light_rail', 'bus'], null_percents):
+            if plot == 'null':
+                _report[name].plot_null_hypothesis(ax=ax, alpha_value=_report['alpha'], null_percent=null_percent)
+            else:
+                _report[name].plot_alt_hypothesis(ax=ax, alpha_value=_report['alpha'], null_percent=null_percent
+                                                 ,legend_loc=legend_loc)
+        if plot == 'null':
+            fig.suptitle(f"Binomial Distributions of Null Hypotheses", fontsize=35)
+        else:
+            fig.suptitle(f"Binomial Distributions of Null and Alternate Hypotheses", fontsize=35)
+        fig.savefig(filepath)
+    return filepath
+
+def top_10_routes_figure(filepath, plot):
+    '''
+    Plots the null (or null and alternate) hypothesis of the 10 routes with the most departures, from the
+    ontime_stats computed by prepare_report.
+
+    Args:
+        filepath (str): Where to save the figure.
+        plot (str): 'null' or 'alt', for plot_null_hypothesis or plot_alt_hypothesis.
+
+    Returns:
+        filepath (str): The saved figure.
+    '''
+    import matplotlib.pyplot as plt
+    route_stats = _report['route_stats']
+    top_10_routes = route_stats[route_stats.level == 'route'].nlargest(10, 'total_stops')
+    alpha_value = _report['top_10_alpha']
+
+    with plt.rc_context({'xtick.labelsize': 15, 'ytick.labelsize': 15}):
+        fig, axs = plt.subplots(10,1, figsize=(20,70), constrained_layout=True)
+        for idx, (_, row) in enumerate(top_10_routes.iterrows()):
+            route_data = RTD_analyze.from_stats(row, route_label=row.route_short_name)
+            if plot == 'null':
+                route_data.plot_null_hypothesis(ax=axs[idx], alpha_value=alpha_value, null_percent=0.86)
+            else:
+                legend_loc = 'upper right' if row.route_short_name == '40' else 'upper center'
+                route_data.plot_alt_hypothesis(ax=axs[idx], alpha_value=alpha_value, null_percent=0.86
+                                              ,legend_loc=legend_loc)
+        if plot == 'null':
+            fig.suptitle(f"Binomial Distributions of Null Hypotheses", fontsize=35)
+        else:
+            fig.suptitle(f"Binomial Distributions of Null and Alternate Hypotheses", fontsize=35)
+        fig.savefig(filepath)
+    return filepath
+
+def ontime_stats_csv():
+    '''
+    Saves the on-time statistics of every route, mode, stop and direction.
+    '''
+    _report['route_stats'].to_csv('data/ontime_stats.csv', index=False)
+    return 'data/ontime_stats.csv'
+
+def route_type_map(name, map_type):
+    '''
+    Saves the cluster_map or neighborhood_map of all routes, light rail or bus.
+    '''
+    analysis = _report[name]
+    getattr(analysis, map_type)()
+    return f"html/{analysis.route_type}_{map_type}.html"
+
+# Every artifact of the report as (function, args, output paths). Each one only reads _report, so they can
+# be built in any order and in parallel.
+ARTIFACTS = {'departure_time_histogram': (departure_time_histogram, (), ['images/departure_time_histogram.png'])
+            ,'original_null_hypothesis': (hypothesis_figure, ('images/original_null_hypothesis.png', 'null', False), ['images/original_null_hypothesis.png'])
+            ,'original_alt_hypothesis': (hypothesis_figure, ('images/original_alt_hypothesis.png', 'alt', False, 'upper center'), ['images/original_alt_hypothesis.png'])
+            ,'modified_null_hypothesis': (hypothesis_figure, ('images/modified_null_hypothesis.png', 'null', True), ['images/modified_null_hypothesis.png'])
+            ,'modified_alt_hypothesis': (hypothesis_figure, ('images/modified_alt_hypothesis.png', 'alt', True, 'upper right'), ['images/modified_alt_hypothesis.png'])
+            ,'top_10_routes_null_hypothesis': (top_10_routes_figure, ('images/top_10_routes_null_hypothesis.png', 'null'), ['images/top_10_routes_null_hypothesis.png'])
+            ,'top_10_routes_alt_hypothesis': (top_10_routes_figure, ('images/top_10_routes_alt_hypothesis.png', 'alt'), ['images/top_10_routes_alt_hypothesis.png'])
+            ,'ontime_stats': (ontime_stats_csv, (), ['data/ontime_stats.csv'])}
+for _name, _route_type in [('all_routes', 'All'), ('light_rail', 'light_rail'), ('bus', 'bus')]:
+    for _map_type in ['cluster_map', 'neighborhood_map']:
+        ARTIFACTS[f"{_name}_{_map_type}"] = (route_type_map, (_name, _map_type), [f"html/{_route_type}_{_map_type}.html"])
+
+# Modules whose code the artifacts depend on. Editing any of them invalidates every cached artifact.
+REPORT_MODULES = [clean_rtd_data, gtfs_static, rtd_schema, analyze_rtd_data, sys.modules[__name__]]
+
+def report_version(rtd_data):
+    '''
+    Versions the inputs of the report: the data in rtd_data.df, the GTFS feed it is joined with, the
+    neighborhood shapefile the neighborhood maps are drawn from and the code of REPORT_MODULES. Artifacts are
+    cached under this version plus their own name and parameters.
+
+    Args:
+        rtd_data (RTD_df): The RTD_df the report is built from, cleaned or not.
+
+    Returns:
+        version (str): Hex digest identifying the inputs.
+    '''
+    gtfs_path = os.path.expanduser(rtd_data.gtfs_path)
+    # Only the feed's version is needed, so its tables are neither parsed nor loaded
+    gtfs_version = gtfs_static.GTFS_Static.feed_version_of(gtfs_path) if os.path.exists(gtfs_path) else None
+    # The .shp holds the polygons and the .dbf their names, so every file of the shapefile is versioned
+    shapes_stem = os.path.splitext(analyze_rtd_data.NEIGHBORHOOD_SHAPES)[0]
+    shapes_version = rtd_cache.file_version(glob.glob(f"{glob.escape(shapes_stem)}.*"))
+    return rtd_cache.Artifact_Cache.key(rtd_cache.frame_version(rtd_data.df), gtfs_version, shapes_version
+                                       ,rtd_cache.code_version(REPORT_MODULES))
+
+def build_artifact(name):
+    '''
+    Builds one artifact in a worker and closes its figures, returning (name, path, seconds, error).
+    '''
+    import matplotlib.pyplot as plt
+    start = time.perf_counter()
+    func, args, _ = ARTIFACTS[name]
+    try:
+        path, error = func(*args), None
+    except Exception:
+        path, error = None, traceback.format_exc()
+    plt.close('all')
+    return name, path, time.perf_counter() - start, error
+
+def build_report(rtd_data, artifacts=None, processes=None, cache=None, clean=False):
+    '''
+    Builds the report's figures, maps and tables as independent jobs in a pool of forked worker processes,
+    so wall time scales with the number of cores instead of the number of artifacts. With a cache, artifacts
+    whose data, parameters and code are unchanged are restored instead of rebuilt, and when every artifact 
+    is cached the data is not even cleaned or analyzed.
+
+    Args:
+        rtd_data (RTD_df): The RTD_df to report on.
+        artifacts (list): Names of the ARTIFACTS to build. Default value is None, which builds all of them.
+        processes (int): Number of worker processes. Default value is None, which uses one per core.
+        cache (rtd_cache.Artifact_Cache): Cache of previously built artifacts. Default value is None.
+        clean (bool): If True, rtd_data holds raw data that is cleaned with clean_parallel (on the same
+            number of processes) before any artifact is built. Default value is False.
+
+    Returns:
+        results (dict): Dictionary of artifact name to (path, seconds, error, cached), where error is the 
+            traceback of a failed artifact or None and cached is True if it was restored from the cache.
+    '''
+    artifacts = list(ARTIFACTS) if artifacts is None else artifacts
+
+    results = {}
+    if cache is not None:
+        version = report_version(rtd_data)
+        keys = {name: cache.key(version, name, ARTIFACTS[name][1]) for name in artifacts}
+        for name in artifacts:
+            if cache.restore(keys[name], ARTIFACTS[name][2]):
+                results[name] = (ARTIFACTS[name][2][0], 0.0, None, True)
+    missing = [name for name in artifacts if name not in results]
+    if not missing:
+        return results
+
+    if clean:
+        rtd_data.clean_parallel(processes)
+    prepare_report(rtd_data)
+    # matplotlib is loaded only once something has to be drawn, and before the fork so workers share it
+    analyze_rtd_data.set_plot_style('Agg')
+
+    built = []
+    if processes == 1:
+        built = [build_artifact(name) for name in missing]
+    else:
+        # Fork so the workers inherit _report without pickling the cleaned data
+        with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('fork')) as pool:
+            built = [future.result() for future in as_completed([pool.submit(build_artifact, name) for name in missing])]
+
+    for name, path, seconds, error in built:
+        results[name] = (path, seconds, error, False)
+        if cache is not None and error is None:
+            cache.store(keys[name], ARTIFACTS[name][2])
+    return results
+
+def parse_args(args=None):
+    '''
+    Parses the command line of the report builder.
+    '''
+    parser = argparse.ArgumentParser(description='Builds the on-time departure report: figures in images/, '
+                                                 'maps in html/ and data/ontime_stats.csv.')
+    parser.add_argument('artifacts', nargs='*'
+                       ,help='Artifacts to build (see --list). Default is all of them.')
+    parser.add_argument('--processes', type=int, default=None
+                       ,help='Number of worker processes. Default is one per core.')
+    parser.add_argument('--parquet', default=None
+                       ,help='Read the raw data from this partitioned Parquet dataset instead of the S3 csv.')
+    parser.add_argument('--start-date', default=None, help='First service date (YYYY-MM-DD) read from --parquet.')
+    parser.add_argument('--end-date', default=None, help='Last service date (YYYY-MM-DD) read from --parquet.')
+    parser.add_argument('--cache-dir', default='data/.report_cache'
+                       ,help='Directory of the artifact cache. Default is data/.report_cache.')
+    parser.add_argument('--cache-budget-mb', type=float, default=1024
+                       ,help='Disk budget of the artifact cache in MB. Default is 1024.')
+    parser.add_argument('--no-cache', action='store_true', help='Rebuild every artifact without the cache.')
+    parser.add_argument('--profile', default=None
+                       ,help='Record the time, rows and memory of each cleaning/analysis stage, print them and '
+                             'write them to this JSON file. Stages run in worker processes are not recorded, so '
+                             'everything runs in the main process unless --processes is given.')
+    parser.add_argument('--profile-dir', default=None
+                       ,help='With --profile, also write a cProfile dump of each outermost stage to this directory.')
+    parser.add_argument('--list', action='store_true', help='List the artifacts and exit.')
+    args = parser.parse_args(args)
+    unknown = [name for name in args.artifacts if name not in ARTIFACTS]
+    if unknown:
+        parser.error(f"unknown artifacts: {', '.join(unknown)}. Use --list to see the artifacts.")
+    return args
+
+def main(args=None):
+    '''
+    Builds the artifacts selected on the command line, cleaning the RTD data only if some are not cached.
+    '''
+    args = parse_args(args)
+    if args.list:
+        print('\n'.join(ARTIFACTS))
+        return
+
+    if args.parquet is None:
+        rtd_data = clean_rtd_data.RTD_df(bucket_name='rtd-on-time-departure', file_name='rtd_data.csv')
+    else:
+        rtd_data = clean_rtd_data.RTD_df.from_parquet(args.parquet, start_date=args.start_date, end_date=args.end_date)
+    cache = None
+    if not args.no_cache:
+        cache = rtd_cache.Artifact_Cache(args.cache_dir, max_bytes=int(args.cache_budget_mb * 1024**2))
+
+    processes = args.processes
+    if args.profile is not None:
+        rtd_profile.enable(profile_dir=args.profile_dir)
+        # The profiler only sees the main process, so the cleaning and every artifact run there
+        processes = 1 if processes is None else processes
+
+    start = time.perf_counter()
+    results = build_report(rtd_data, artifacts=args.artifacts or None, processes=processes, cache=cache, clean=True)
+    for name, (path, seconds, error, cached) in results.items():
+        if error is not None:
+            print(f"{name} failed:\n{error}")
+        elif cached:
+            print(f"{name}: {path} (cached)")
+        else:
+            print(f"{name}: {path} ({seconds:.1f}s)")
+    print(f"Built {len(results)} artifacts in {time.perf_counter() - start:.1f}s")
+
+    if args.profile is not None:
+        profiler = rtd_profile.disable()
+        print(profiler.table())
+        profiler.to_json(args.profile)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+#!/opt/anaconda3/bin/python3
+
+import numpy as np
+import pandas as pd
+import rtd_profile
+
+# Real-world values of the coded columns, in code order
+STATUS_CODES = {0: 'incoming_at'
+               ,1: 'stopped_at'
+               ,2: 'in_transit_to'}
+ROUTE_TYPE_CODES = {0: 'light_rail'
+                   ,2: 'commuter_rail'
+                   ,3: 'bus'}
+
+# Columns (and their dtypes) returned by RTD_Feed.parse_to_df, in order. Positions are float32 in the
+# GTFS-realtime protobuf itself, so nothing is lost by keeping them that way.
+FEED_COLUMNS = [('entity_id', object)
+               ,('trip_id', object)
+               ,('schedule_relationship', np.int8)
+               ,('route_id', object)
+               ,('direction_id', np.int8)
+               ,('vehicle_lat', np.float32)
+               ,('vehicle_lng', np.float32)
+               ,('bearing', np.int16)
+               ,('current_status', np.int8)
+               ,('timestamp', np.int64)
+               ,('stop_id', object)
+               ,('vehicle_id', object)
+               ,('vehicle_label', object)]
+
+# Dtypes of the raw csv written by pull_rtd_data.py. Every chunk of a streamed read must agree on its dtypes,
+# and the init row of empty strings means numeric columns have to allow NaN.
+RAW_DTYPES = {'entity_id': str
+             ,'trip_id': str
+             ,'schedule_relationship': 'float32'
+             ,'route_id': str
+             ,'direction_id': 'float32'
+             ,'vehicle_lat': 'float32'
+             ,'vehicle_lng': 'float32'
+             ,'bearing': 'float32'
+             ,'current_status': 'float32'
+             ,'timestamp': 'float64'
+             ,'stop_id': str
+             ,'vehicle_id': str
+             ,'vehicle_label': str}
+
+# Dtypes of the cleaned RTD_df.df. Ids stay GTFS strings (every join is on them) but are stored as
+# categoricals, codes and names are categoricals, coordinates are float32 and schedule times are integer
+# seconds since the start of the service day.
+CLEAN_DTYPES = {'entity_id': 'category'
+               ,'vehicle_id': 'category'
+               ,'vehicle_label': 'category'
+               ,'trip_id': 'category'
+               ,'trip_headsign': 'category'
+               ,'route_id': 'category'
+               ,'direction_id': 'int8'
+               ,'route_type': pd.CategoricalDtype(ROUTE_TYPE_CODES.values())
+               ,'route_long_name': 'category'
+               ,'route_short_name': 'category'
+               ,'route_desc': 'category'
+               ,'current_status': pd.CategoricalDtype(STATUS_CODES.values())
+               ,'stop_id': 'category'
+               ,'stop_name': 'category'
+               ,'stop_desc': 'category'
+               ,'arrival_vehicle_lat': 'float32'
+               ,'arrival_vehicle_lng': 'float32'
+               ,'stop_lat': 'float32'
+               ,'stop_lng': 'float32'
+               ,'departure_vehicle_lat': 'float32'
+               ,'departure_vehicle_lng': 'float32'
+               ,'scheduled_arrival_time': 'int32'
+               ,'scheduled_departure_time': 'int32'
+               ,'minutes_to_arrival': 'float32'
+               ,'minutes_since_departure': 'float32'
+               ,'meters_to_arrival': 'float32'
+               ,'meters_since_departure': 'float32'}
+
+@rtd_profile.profiled()
+def apply_schema(df, dtypes):
+    '''
+    Casts the columns of df that appear in dtypes, leaving any other column as it is.
+
+    Args:
+        df (pd.DataFrame): The DataFrame to cast.
+        dtypes (dict): Dictionary of column name to dtype, e.g. RAW_DTYPES or CLEAN_DTYPES.
+
+    Returns:
+        df (pd.DataFrame): The DataFrame with the schema applied.
+    '''
+    return df.astype({col: dtype for col, dtype in dtypes.items() if col in df.columns})
+
+def memory_report(df):
+    '''
+    Reports the memory each column of a DataFrame uses, counting the contents of strings and categories.
+
+    Args:
+        df (pd.DataFrame): The DataFrame to profile.
+
+    Returns:
+        report (pd.DataFrame): dtype, bytes and bytes per row of each column plus a 'total' row, largest first.
+    '''
+    usage = df.memory_usage(index=True, deep=True)
+    report = pd.DataFrame({'dtype': [str(df[col].dtype) if col in df.columns else 'index' for col in usage.index]
+                          ,'bytes': usage.values}
+                         ,index=usage.index).sort_values('bytes', ascending=False)
+    report.loc['total'] = ['', usage.sum()]
+    report['bytes_per_row'] = report.bytes / max(1, df.shape[0])
+    return report
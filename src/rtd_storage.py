@@ -0,0 +1,167 @@
+#!/opt/anaconda3/bin/python3
+
+import os
+import uuid
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+# Hour (local time) at which one service date rolls over to the next, so trips running past midnight
+# stay in the partition of the day they started
+SERVICE_DAY_START_HOUR = 3
+
+def add_service_date(df, timestamp_column='timestamp', local_timezone='US/Mountain'):
+    '''
+    Adds a service_date column ('YYYY-MM-DD') to a DataFrame of vehicle positions.
+
+    Args:
+        df (pd.DataFrame): DataFrame with a column of POSIX timestamps (or tz-aware datetimes).
+        timestamp_column (str): The name of the timestamp column. Default value is 'timestamp'.
+        local_timezone (str): Timezone the service day is defined in. Default value is 'US/Mountain'.
+
+    Returns:
+        df (pd.DataFrame): The DataFrame with a service_date column added.
+    '''
+    timestamps = df[timestamp_column]
+    if not isinstance(timestamps.dtype, pd.DatetimeTZDtype):
+        timestamps = pd.to_datetime(timestamps, unit='s', utc=True)
+    local_time = timestamps.dt.tz_convert(local_timezone) - pd.Timedelta(hours=SERVICE_DAY_START_HOUR)
+    return df.assign(service_date=local_time.dt.strftime('%Y-%m-%d'))
+
+def write_partitioned(df, root, partition_cols=('service_date',), compression='zstd', basename=None):
+    '''
+    Appends a DataFrame to a compressed Parquet dataset partitioned hive-style (e.g.
+    root/service_date=2021-02-09/part-<uuid>-0.parquet). Every call writes new files, so existing
+    partitions are never rewritten; use compact_partition() to merge the small files of a finished day.
+    Given a basename, the files are named after it instead, so writing the same rows again replaces them
+    rather than appending a second copy.
+
+    Args:
+        df (pd.DataFrame): The rows to write. A service_date column is added if it is missing.
+        root (str): Local directory or s3:// uri of the dataset.
+        partition_cols (tuple): Columns to partition by, e.g. ('service_date', 'route_id') for raw feed
+            data or ('service_date', 'route_type') for cleaned data. Default value is ('service_date',).
+        compression (str): Parquet compression codec. Default value is 'zstd'.
+        basename (str): Name of the files written, e.g. a hash of the rows. Default value is None, which uses
+            a new uuid.
+    '''
+    if ('service_date' in partition_cols) & ('service_date' not in df.columns):
+        df = add_service_date(df)
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    # Categoricals get the smallest index type that fits their categories, so files written from chunks
+    # with different numbers of categories could not be read back as one dataset without a common one
+    table = table.cast(pa.schema([pa.field(field.name, pa.dictionary(pa.int32(), field.type.value_type, field.type.ordered))
+                                  if pa.types.is_dictionary(field.type) else field for field in table.schema]
+                                 ,metadata=table.schema.metadata))
+    partition_schema = pa.schema([table.schema.field(col) for col in partition_cols])
+
+    ds.write_dataset(table
+                    ,root
+                    ,format='parquet'
+                    ,partitioning=ds.partitioning(partition_schema, flavor='hive')
+                    ,basename_template=f"part-{basename or uuid.uuid4().hex}-{{i}}.parquet"
+                    ,existing_data_behavior='overwrite_or_ignore'
+                    ,file_options=ds.ParquetFileFormat().make_write_options(compression=compression))
+
+def read_partitioned(root, columns=None, start_date=None, end_date=None, filters=None):
+    '''
+    Reads a partitioned Parquet dataset, only opening the partitions between start_date and end_date and
+    only decoding the columns asked for. Any extra filters are pushed down to the Parquet row groups.
+
+    Args:
+        root (str): Local directory or s3:// uri of the dataset.
+        columns (list): Columns to load. Default value is None, which loads every column.
+        start_date (str): First service date to load ('YYYY-MM-DD'), inclusive. Default value is None.
+        end_date (str): Last service date to load ('YYYY-MM-DD'), inclusive. Default value is None.
+        filters (pyarrow.compute.Expression): Additional filter, e.g. ds.field('route_type') == 'bus'.
+            Default value is None.
+
+    Returns:
+        df (pd.DataFrame): The matching rows.
+    '''
+    dataset = ds.dataset(root, format='parquet', partitioning='hive')
+
+    expression = filters
+    if start_date is not None:
+        expression = and_filters(expression, ds.field('service_date') >= start_date)
+    if end_date is not None:
+        expression = and_filters(expression, ds.field('service_date') <= end_date)
+
+    return dataset.to_table(columns=columns, filter=expression).to_pandas()
+
+def list_partitions(root, column='service_date'):
+    '''
+    Lists the values of a partition column in a hive-style dataset from its file paths, without reading
+    any data.
+
+    Args:
+        root (str): Local directory or s3:// uri of the dataset.
+        column (str): The partition column. Default value is 'service_date'.
+
+    Returns:
+        values (list): The sorted partition values, e.g. ['2021-02-09', '2021-02-10'].
+    '''
+    dataset = ds.dataset(root, format='parquet', partitioning='hive')
+    values = set()
+    for path in dataset.files:
+        for part in path.split('/'):
+            if part.startswith(f"{column}="):
+                values.add(part[len(column) + 1:])
+    return sorted(values)
+
+def service_day_bounds(service_date, local_timezone='US/Mountain'):
+    '''
+    POSIX timestamps of the start of a service date and of the next one (23 to 25 hours later across daylight
+    saving changes).
+
+    Args:
+        service_date (str): The service date ('YYYY-MM-DD').
+        local_timezone (str): Timezone the service day is defined in. Default value is 'US/Mountain'.
+
+    Returns:
+        start (int): First second of the service date.
+        end (int): First second of the next service date.
+    '''
+    day = pd.Timestamp(service_date)
+    start, end = [(date + pd.Timedelta(hours=SERVICE_DAY_START_HOUR)).tz_localize(local_timezone)
+                  for date in (day, day + pd.Timedelta(days=1))]
+    return int(start.timestamp()), int(end.timestamp())
+
+def compact_partition(root, partition, compression='zstd'):
+    '''
+    Merges the many small files written to one partition by repeated polls into a single file.
+
+    Args:
+        root (str): Local directory of the dataset.
+        partition (str): The partition directory relative to root, e.g. 'service_date=2021-02-09'.
+        compression (str): Parquet compression codec. Default value is 'zstd'.
+    '''
+    partition_dir = os.path.join(root, partition)
+    files = sorted(os.path.join(partition_dir, f) for f in os.listdir(partition_dir) if f.endswith('.parquet'))
+    if len(files) <= 1:
+        return
+
+    table = pa.concat_tables([pq.read_table(f, partitioning=None) for f in files], promote_options='default')
+    pq.write_table(table, os.path.join(partition_dir, f"part-{uuid.uuid4().hex}-0.parquet"), compression=compression)
+    for f in files:
+        os.remove(f)
+
+def and_filters(expression, other):
+    '''
+    Combines two pyarrow filter expressions, either of which may be None, e.g. to build the filters passed to
+    read_partitioned one condition at a time.
+
+    Args:
+        expression (pyarrow.compute.Expression): The filter so far, or None.
+        other (pyarrow.compute.Expression): The filter to add, or None.
+
+    Returns:
+        expression (pyarrow.compute.Expression): Both filters, or whichever is not None.
+    '''
+    if other is None:
+        return expression
+    if expression is None:
+        return other
+    return expression & other
@@ -0,0 +1,304 @@
+#!/opt/anaconda3/bin/python3
+
+import os
+import random
+import numpy as np
+import pandas as pd
+import rtd_schema
+from google.transit import gtfs_realtime_pb2
+
+def make_vehicle_feed(n_vehicles, timestamp=1612900000, seed=0):
+    '''
+    Creates a synthetic GTFS-realtime Vehicle Position feed shaped like RTD's, with vehicles scattered
+    around the Denver metro area.
+
+    Args:
+        n_vehicles (int): Number of vehicle entities in the feed.
+        timestamp (int): POSIX timestamp used for the feed header and every vehicle. Default value is
+            1612900000 (2021-02-09).
+        seed (int): Seed for the random number generator so feeds are reproducible. Default value is 0.
+
+    Returns:
+        feed (gtfs_realtime_pb2.FeedMessage): The synthetic feed.
+    '''
+    rng = random.Random(seed)
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.header.gtfs_realtime_version = '2.0'
+    feed.header.timestamp = timestamp
+
+    for vehicle in range(n_vehicles):
+        entity = feed.entity.add()
+        entity.id = f"{1612900000 + vehicle}_{vehicle}"
+        entity.vehicle.trip.trip_id = str(113600000 + rng.randrange(100000))
+        entity.vehicle.trip.schedule_relationship = 0
+        entity.vehicle.trip.route_id = str(rng.randrange(1, 200))
+        entity.vehicle.trip.direction_id = rng.randrange(2)
+        entity.vehicle.position.latitude = rng.uniform(39.5, 40.1)
+        entity.vehicle.position.longitude = rng.uniform(-105.3, -104.6)
+        entity.vehicle.position.bearing = rng.uniform(0, 360)
+        entity.vehicle.current_status = rng.randrange(3)
+        entity.vehicle.timestamp = timestamp - rng.randrange(60)
+        entity.vehicle.stop_id = str(10000 + rng.randrange(30000))
+        entity.vehicle.vehicle.id = f"{vehicle:032X}"
+        entity.vehicle.vehicle.label = str(1000 + vehicle)
+
+    return feed
+
+def make_cleaned_frame(n_rows, n_routes=150, n_trips=37000, n_stops=7000, n_vehicles=1000, seed=0):
+    '''
+    Creates a frame shaped like RTD_df.df after clean_my_data, with the dtypes the pipeline produced before
+    rtd_schema (object strings, float64 coordinates and %H:%M:%S schedule times) and RTD-like cardinalities.
+
+    Args:
+        n_rows (int): Number of cleaned departures. A month of RTD data is a few million.
+        n_routes (int): Number of distinct routes. Default value is 150.
+        n_trips (int): Number of distinct trips. Default value is 37,000.
+        n_stops (int): Number of distinct stops. Default value is 7,000.
+        n_vehicles (int): Number of distinct vehicles. Default value is 1,000.
+        seed (int): Seed for the random number generator. Default value is 0.
+
+    Returns:
+        df (pd.DataFrame): The synthetic cleaned frame.
+    '''
+    rng = np.random.default_rng(seed)
+    route = rng.integers(0, n_routes, n_rows)
+    trip = rng.integers(0, n_trips, n_rows)
+    stop = rng.integers(0, n_stops, n_rows)
+    vehicle = rng.integers(0, n_vehicles, n_rows)
+    route_type = np.array(['bus', 'light_rail', 'commuter_rail'])[np.minimum(route % 10, 2)]
+    stop_lat = 39.5 + stop / n_stops * 0.6
+    stop_lng = -105.3 + stop / n_stops * 0.7
+    arrival = pd.Timestamp('2021-02-01', tz='US/Mountain') + pd.to_timedelta(rng.integers(0, 28 * 86400, n_rows), unit='s')
+    scheduled = rng.integers(4 * 3600, 26 * 3600, n_rows)
+
+    def hms(seconds):
+        return pd.Series(seconds // 3600).astype(str).str.zfill(2) + ':' + pd.Series(seconds % 3600 // 60).astype(str).str.zfill(2) + ':00'
+
+    df = pd.DataFrame({'entity_id': pd.Series(vehicle).astype(str).radd('1612900000_')
+                      ,'vehicle_id': pd.Series(vehicle).map('{:032X}'.format)
+                      ,'vehicle_label': pd.Series(vehicle + 1000).astype(str)
+                      ,'trip_id': pd.Series(trip + 113600000).astype(str)
+                      ,'trip_headsign': pd.Series(route).map('Headsign {}'.format)
+                      ,'route_id': pd.Series(route).astype(str)
+                      ,'direction_id': trip % 2
+                      ,'route_type': route_type
+                      ,'route_long_name': pd.Series(route).map('Route {} Long Name'.format)
+                      ,'route_short_name': pd.Series(route).astype(str)
+                      ,'route_desc': 'This Route Travels Northbound & Southbound'
+                      ,'current_status': np.array(['incoming_at', 'stopped_at', 'in_transit_to'])[rng.integers(0, 3, n_rows)]
+                      ,'stop_id': pd.Series(stop + 10000).astype(str)
+                      ,'stop_name': pd.Series(stop).map('Street {} & Avenue'.format)
+                      ,'stop_desc': 'Vehicles Travelling North'
+                      ,'arrival_vehicle_lat': stop_lat + rng.normal(0, 1e-4, n_rows)
+                      ,'arrival_vehicle_lng': stop_lng + rng.normal(0, 1e-4, n_rows)
+                      ,'stop_lat': stop_lat
+                      ,'stop_lng': stop_lng
+                      ,'departure_vehicle_lat': stop_lat + rng.normal(0, 1e-3, n_rows)
+                      ,'departure_vehicle_lng': stop_lng + rng.normal(0, 1e-3, n_rows)
+                      ,'arrival_timestamp': arrival
+                      ,'scheduled_arrival_time': hms(scheduled).astype(object)
+                      ,'departure_timestamp': arrival + pd.Timedelta(minutes=1)
+                      ,'scheduled_departure_time': hms(scheduled).astype(object)
+                      ,'minutes_to_arrival': rng.normal(1, 3, n_rows)
+                      ,'minutes_since_departure': rng.normal(2, 3, n_rows)
+                      ,'meters_to_arrival': rng.exponential(30, n_rows)
+                      ,'meters_since_departure': rng.exponential(200, n_rows)})
+    string_columns = df.select_dtypes(exclude=['number', 'datetimetz']).columns
+    return df.astype({col: object for col in string_columns})
+
+def make_gtfs_static(gtfs_path, n_routes=150, trips_per_route=40, stops_per_route=30, seed=0):
+    '''
+    Writes a synthetic GTFS static feed (routes, trips, stops and stop_times .txt files) shaped like RTD's,
+    so the cleaning pipeline can run offline. Every 10th route is light rail and every 25th commuter rail,
+    each route has its own line of stops across the Denver metro area and trips alternate direction and
+    run between 05:00 and 23:00.
+
+    Args:
+        gtfs_path (str): Directory to write the .txt files to.
+        n_routes (int): Number of routes. Default value is 150.
+        trips_per_route (int): Number of trips of each route per service day. Default value is 40.
+        stops_per_route (int): Number of stops of each route. Default value is 30.
+        seed (int): Seed for the random number generator. Default value is 0.
+
+    Returns:
+        gtfs (dict): The routes, trips, stops and stop_times DataFrames that were written.
+    '''
+    rng = np.random.default_rng(seed)
+    os.makedirs(gtfs_path, exist_ok=True)
+
+    route = np.arange(n_routes)
+    route_type = np.where(route % 25 == 24, 2, np.where(route % 10 == 9, 0, 3))
+    routes = pd.DataFrame({'route_id': (route + 1).astype(str)
+                          ,'route_short_name': (route + 1).astype(str)
+                          ,'route_long_name': [f"Route {idx + 1} Long Name" for idx in route]
+                          ,'route_desc': 'This Route Travels Northbound & Southbound'
+                          ,'route_type': route_type})
+
+    # Each route is a straight line of evenly spaced stops between two random points in the service area
+    start_lat, end_lat = rng.uniform(39.55, 39.95, (2, n_routes))
+    start_lng, end_lng = rng.uniform(-105.15, -104.85, (2, n_routes))
+    fraction = np.tile(np.linspace(0, 1, stops_per_route), n_routes)
+    stop_route = np.repeat(route, stops_per_route)
+    stops = pd.DataFrame({'stop_id': (10000 + np.arange(n_routes * stops_per_route)).astype(str)
+                         ,'stop_name': [f"Street {idx} & Avenue" for idx in range(n_routes * stops_per_route)]
+                         ,'stop_desc': 'Vehicles Travelling North'
+                         ,'stop_lat': start_lat[stop_route] + fraction * (end_lat - start_lat)[stop_route]
+                         ,'stop_lon': start_lng[stop_route] + fraction * (end_lng - start_lng)[stop_route]})
+
+    trip_route = np.repeat(route, trips_per_route)
+    trip_number = np.tile(np.arange(trips_per_route), n_routes)
+    trips = pd.DataFrame({'route_id': (trip_route + 1).astype(str)
+                         ,'service_id': 'WK'
+                         ,'trip_id': (113600000 + np.arange(n_routes * trips_per_route)).astype(str)
+                         ,'direction_id': trip_number % 2
+                         ,'trip_headsign': [f"Headsign {idx + 1}" for idx in trip_route]})
+
+    # Trips start evenly through the service day and take 1.5-4 minutes between stops, visiting their
+    # route's stops in reverse on direction 1
+    n_trips = len(trips)
+    first_departure = 5 * 3600 + trip_number * (18 * 3600 // trips_per_route) + rng.integers(0, 300, n_trips)
+    travel = rng.integers(90, 240, (n_trips, stops_per_route))
+    travel[:, 0] = 0
+    departure = first_departure[:, None] + travel.cumsum(axis=1)
+    sequence = np.tile(np.arange(stops_per_route), (n_trips, 1))
+    stop_index = np.where((trip_number % 2 == 0)[:, None], sequence, stops_per_route - 1 - sequence)
+    stop_index += (trip_route * stops_per_route)[:, None]
+
+    def hms(seconds):
+        return [f"{second // 3600:02d}:{second % 3600 // 60:02d}:{second % 60:02d}" for second in seconds]
+
+    departure = departure.ravel()
+    stop_times = pd.DataFrame({'trip_id': np.repeat(trips.trip_id.to_numpy(), stops_per_route)
+                              ,'arrival_time': hms(departure - 30)
+                              ,'departure_time': hms(departure)
+                              ,'stop_id': stops.stop_id.to_numpy()[stop_index.ravel()]
+                              ,'stop_sequence': sequence.ravel() + 1})
+
+    gtfs = {'routes': routes, 'trips': trips, 'stops': stops, 'stop_times': stop_times}
+    for table, df in gtfs.items():
+        df.to_csv(os.path.join(gtfs_path, f"{table}.txt"), index=False)
+    return gtfs
+
+def _simulate_vehicles(gtfs, days=1, poll_seconds=60, start_date='2021-02-09', delay_minutes=(-1.5, 6.0), seed=0):
+    '''
+    Simulates the vehicles running every trip of a synthetic GTFS feed on each day. Each trip run gets one
+    delay, and at every poll its vehicle reports the next stop it has not yet departed (at its delayed time)
+    and a position between that stop and the previous one.
+
+    Returns:
+        df (pd.DataFrame): The reports in RTD_Feed.parse_to_df's layout.
+        polls (np.ndarray): Feed timestamp of the poll each report belongs to.
+    '''
+    rng = np.random.default_rng(seed)
+    trips = gtfs['trips']
+    stops = gtfs['stops'].set_index('stop_id')
+    stop_times = gtfs['stop_times'].merge(trips.loc[:, ['trip_id']].reset_index().rename(columns={'index': 'trip'}), on='trip_id')
+    stop_times = stop_times.sort_values(['trip', 'stop_sequence'])
+    departure = pd.to_timedelta(stop_times.departure_time).dt.total_seconds().to_numpy().astype('int64')
+    stop_lat = stops.stop_lat.reindex(stop_times.stop_id).to_numpy()
+    stop_lng = stops.stop_lon.reindex(stop_times.stop_id).to_numpy()
+    stop_trip = stop_times.trip.to_numpy()
+    n_trips = len(trips)
+    # Each route runs a fleet of 8 vehicles taking its trips in turn, so no vehicle is on two trips at once
+    vehicle_of_trip = (trips.route_id.astype('int64') * 8 + trips.groupby('route_id').cumcount() % 8).to_numpy()
+    first = np.searchsorted(stop_trip, np.arange(n_trips))
+    last = np.searchsorted(stop_trip, np.arange(n_trips), 'right') - 1
+
+    frames, polls = [], []
+    for day in range(days):
+        midnight = int(pd.Timestamp(start_date, tz='US/Mountain').timestamp()) + day * 86400
+        delay = (rng.uniform(*delay_minutes, n_trips) * 60).astype('int64')
+
+        # Polls from 5 minutes before each trip's first departure to 5 minutes after its last one
+        poll_first = (midnight + departure[first] - 300) // poll_seconds * poll_seconds
+        poll_last = midnight + departure[last] + delay + 300
+        n_polls = (poll_last - poll_first) // poll_seconds + 1
+        trip = np.repeat(np.arange(n_trips), n_polls)
+        poll = poll_first[trip] + (np.arange(n_polls.sum()) - np.repeat(n_polls.cumsum() - n_polls, n_polls)) * poll_seconds
+
+        # Next stop not yet departed: one searchsorted over (trip, delayed departure) keys for every trip
+        offset = 10 ** 7
+        delayed = stop_trip * offset + (departure + delay[stop_trip])
+        target = np.searchsorted(delayed, trip * offset + (poll - midnight))
+        target = np.clip(target, first[trip], last[trip])
+        previous = np.maximum(target - 1, first[trip])
+        span = np.maximum(departure[target] - departure[previous], 1)
+        progress = np.clip((poll - midnight - delay[trip] - departure[previous]) / span, 0, 1)
+        lat = stop_lat[previous] + progress * (stop_lat[target] - stop_lat[previous])
+        lng = stop_lng[previous] + progress * (stop_lng[target] - stop_lng[previous])
+
+        vehicle = vehicle_of_trip[trip]
+        n_rows = len(trip)
+        frames.append(pd.DataFrame({'entity_id': [f"{stamp}_{idx}" for stamp, idx in zip(poll, vehicle)]
+                                   ,'trip_id': trips.trip_id.to_numpy()[trip]
+                                   ,'schedule_relationship': np.zeros(n_rows, dtype='int8')
+                                   ,'route_id': trips.route_id.to_numpy()[trip]
+                                   ,'direction_id': trips.direction_id.to_numpy()[trip].astype('int8')
+                                   ,'vehicle_lat': (lat + rng.normal(0, 2e-5, n_rows)).astype('float32')
+                                   ,'vehicle_lng': (lng + rng.normal(0, 2e-5, n_rows)).astype('float32')
+                                   ,'bearing': rng.integers(0, 360, n_rows).astype('int16')
+                                   ,'current_status': np.where(progress < 1, 2, 1).astype('int8')
+                                   ,'timestamp': poll - rng.integers(0, min(poll_seconds, 30), n_rows)
+                                   ,'stop_id': stop_times.stop_id.to_numpy()[target]
+                                   ,'vehicle_id': [f"{idx:032X}" for idx in vehicle]
+                                   ,'vehicle_label': (vehicle + 1000).astype(str).astype(object)}))
+        polls.append(poll)
+
+    df = pd.concat(frames, ignore_index=True)
+    return df.astype({col: dtype for col, dtype in rtd_schema.FEED_COLUMNS}), np.concatenate(polls)
+
+def make_raw_frame(gtfs, days=1, poll_seconds=60, start_date='2021-02-09', delay_minutes=(-1.5, 6.0), seed=0):
+    '''
+    Creates the raw vehicle positions a collector polling every poll_seconds would have recorded while the
+    trips of a synthetic GTFS feed (see make_gtfs_static) ran for a number of days, in the layout of
+    RTD_Feed.parse_to_df, so clean_my_data joins every row to the schedule.
+
+    Args:
+        gtfs (dict): The tables returned by make_gtfs_static.
+        days (int): Number of service days. Default value is 1.
+        poll_seconds (int): Seconds between polls. Default value is 60.
+        start_date (str): First service date ('YYYY-MM-DD'). Default value is '2021-02-09'.
+        delay_minutes (tuple): Range of each trip's delay in minutes; departures between 1 minute early and
+            5 minutes late are on-time. Default value is (-1.5, 6.0).
+        seed (int): Seed for the random number generator. Default value is 0.
+
+    Returns:
+        df (pd.DataFrame): The raw vehicle positions, sorted by poll.
+    '''
+    df, polls = _simulate_vehicles(gtfs, days, poll_seconds, start_date, delay_minutes, seed)
+    return df.iloc[np.argsort(polls, kind='stable')].reset_index(drop=True)
+
+def make_vehicle_feeds(gtfs, days=1, poll_seconds=60, start_date='2021-02-09', delay_minutes=(-1.5, 6.0), seed=0):
+    '''
+    Creates the GTFS-realtime Vehicle Position snapshots behind make_raw_frame, one FeedMessage per poll,
+    e.g. to replay through RTD_Live or archive with RTD_Archive.
+
+    Args: See make_raw_frame.
+
+    Yields:
+        feed (gtfs_realtime_pb2.FeedMessage): The snapshot of each poll, in poll order.
+    '''
+    df, polls = _simulate_vehicles(gtfs, days, poll_seconds, start_date, delay_minutes, seed)
+    order = np.argsort(polls, kind='stable')
+    df, polls = df.iloc[order], polls[order]
+    bounds = np.flatnonzero(np.diff(polls)) + 1
+    for rows in np.split(np.arange(len(polls)), bounds):
+        feed = gtfs_realtime_pb2.FeedMessage()
+        feed.header.gtfs_realtime_version = '2.0'
+        feed.header.timestamp = int(polls[rows[0]])
+        for row in df.iloc[rows].itertuples(index=False):
+            entity = feed.entity.add()
+            entity.id = row.entity_id
+            entity.vehicle.trip.trip_id = row.trip_id
+            entity.vehicle.trip.schedule_relationship = row.schedule_relationship
+            entity.vehicle.trip.route_id = row.route_id
+            entity.vehicle.trip.direction_id = row.direction_id
+            entity.vehicle.position.latitude = row.vehicle_lat
+            entity.vehicle.position.longitude = row.vehicle_lng
+            entity.vehicle.position.bearing = row.bearing
+            entity.vehicle.current_status = row.current_status
+            entity.vehicle.timestamp = row.timestamp
+            entity.vehicle.stop_id = row.stop_id
+            entity.vehicle.vehicle.id = row.vehicle_id
+            entity.vehicle.vehicle.label = row.vehicle_label
+        yield feed